@@ -0,0 +1,167 @@
+###############################################################################
+# Copyright (C) 2025 Habana Labs, Ltd. an Intel Company
+#
+# This source code is licensed under the Apache 2.0 license found in the
+# LICENSE file in the root directory of this source tree.
+###############################################################################
+
+import argparse
+import time
+
+import torch
+
+import vllm_hpu_extension.runtime as runtime
+import vllm_hpu_extension.ops as ops
+from vllm_hpu_extension.config import Config
+
+
+COPY_OPS = ('aten::copy_', 'aten::clone', 'aten::contiguous')
+
+
+def fetch(cache, blocks):
+    return cache.index_select(0, blocks)
+
+
+def make_inputs(args):
+    num_blocks = args.batch_size * args.blocks_per_seq
+    key_cache = torch.randn(num_blocks * args.block_size, args.kv_heads, args.head_size, dtype=args.dtype)
+    value_cache = torch.randn(num_blocks * args.block_size, args.kv_heads, args.head_size, dtype=args.dtype)
+    query = torch.randn(args.batch_size, 1, args.q_heads * args.head_size, dtype=args.dtype)
+    block_groups = torch.arange(args.batch_size).repeat_interleave(args.blocks_per_seq)
+    metadata = dict(
+        block_list=torch.randperm(num_blocks),
+        block_groups=block_groups,
+        block_mapping=torch.nn.functional.one_hot(block_groups, args.batch_size).to(args.dtype),
+        block_bias=torch.zeros(num_blocks, args.block_size, dtype=args.dtype),
+    )
+    return query, key_cache, value_cache, metadata
+
+
+def to_head_major(key_cache, value_cache, block_size):
+    key_cache = key_cache.unflatten(0, (-1, block_size)).permute(0, 2, 3, 1).contiguous()
+    value_cache = value_cache.unflatten(0, (-1, block_size)).transpose(1, 2).contiguous()
+    return key_cache, value_cache
+
+
+def bench_cascade(args):
+    query, key_cache, value_cache, _ = make_inputs(args)
+    # All sequences share the first `shared_blocks` blocks, e.g. a common system prompt
+    shared = list(range(args.shared_blocks))
+    own = torch.arange(args.shared_blocks, key_cache.size(0) // args.block_size).tolist()
+    num_own = args.blocks_per_seq - args.shared_blocks
+    block_tables = [shared + own[i * num_own:(i + 1) * num_own] for i in range(args.batch_size)]
+    seq_lens = [len(bt) * args.block_size for bt in block_tables]
+    cascade = ops.make_cascade_metadata(block_tables, seq_lens, args.block_size, dtype=args.dtype)
+    block_groups = torch.arange(args.batch_size).repeat_interleave(args.blocks_per_seq)
+    regular = dict(
+        block_list=torch.tensor(sum(block_tables, [])),
+        block_groups=block_groups,
+        block_mapping=torch.nn.functional.one_hot(block_groups, args.batch_size).to(args.dtype),
+        block_bias=torch.zeros(block_groups.numel(), args.block_size, dtype=args.dtype),
+    )
+    outputs = {}
+    for name, metadata in [('regular', regular), ('cascade', cascade)]:
+        def fn():
+            return run(args, query, key_cache, value_cache, metadata)
+        outputs[name] = fn()
+        num_blocks = metadata['block_list'].numel() + metadata.get('prefix_block_list', torch.empty(0)).numel()
+        print(f'{name}: {measure(fn, args.iters):8.3f} ms, fetched blocks: {num_blocks}')
+    max_diff = (outputs['regular'] - outputs['cascade']).abs().max().item()
+    print(f'max abs diff: {max_diff:.3e}')
+
+
+def bench_topk(args):
+    query, key_cache, value_cache, metadata = make_inputs(args)
+    block_tables = metadata['block_list'].view(args.batch_size, args.blocks_per_seq)
+    seq_lens = torch.full((args.batch_size,), args.blocks_per_seq * args.block_size)
+    # Plant a few blocks per sequence with keys correlated with the query, as retrieval-heavy
+    # prompts tend to concentrate attention on a handful of blocks
+    direction = query.view(args.batch_size, args.kv_heads, -1, args.head_size).sum(2)
+    blocked_keys = key_cache.view(-1, args.block_size, args.kv_heads, args.head_size)
+    for i in range(args.batch_size):
+        needles = block_tables[i, torch.randperm(args.blocks_per_seq - 1)[:args.num_needles]]
+        blocked_keys[needles] += args.needle_strength * direction[i] / direction[i].norm(dim=-1, keepdim=True)
+    block_summary = torch.stack([blocked_keys.amin(1), blocked_keys.amax(1)], dim=1)
+
+    def fn():
+        return run(args, query, key_cache, value_cache, metadata, block_summary=block_summary,
+                   block_tables=block_tables, seq_lens=seq_lens)
+    exact = fn()
+    print(f'exact: {measure(fn, args.iters):8.3f} ms, blocks/seq: {args.blocks_per_seq}')
+    for topk in args.topk:
+        runtime.RUNTIME_CONFIG = Config(runtime.RUNTIME_CONFIG.get_all(), decode_topk_blocks=topk)
+        out = fn()
+        rel_err = ((out - exact).norm() / exact.norm()).item()
+        blocks = min(topk + args.recent, args.blocks_per_seq)
+        print(f'topk={topk:4d}: {measure(fn, args.iters):8.3f} ms, blocks/seq: {blocks}, rel error: {rel_err:.3e}')
+
+
+def run(args, query, key_cache, value_cache, metadata, **kwargs):
+    return ops.flat_pa(query=query, key_cache=key_cache, value_cache=value_cache,
+                       block_size=args.block_size, scale=args.head_size ** -0.5,
+                       matmul_qk_op=torch.matmul, position_bias=None, matmul_av_op=torch.matmul,
+                       batch2block_matmul_op=torch.matmul, block2batch_matmul_op=torch.matmul,
+                       keys_fetch_func=fetch, values_fetch_func=fetch, **metadata, **kwargs)
+
+
+def count_copies(fn):
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU]) as prof:
+        fn()
+    return sum(e.count for e in prof.key_averages() if e.key in COPY_OPS)
+
+
+def measure(fn, iters):
+    fn()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def bench_layouts(args):
+    query, key_cache, value_cache, metadata = make_inputs(args)
+    caches = {
+        'nhd': (key_cache, value_cache),
+        'hnd': to_head_major(key_cache, value_cache, args.block_size),
+    }
+    outputs = {}
+    for layout, (k, v) in caches.items():
+        def fn():
+            return run(args, query, k, v, metadata)
+        outputs[layout] = fn()
+        print(f'{layout}: {measure(fn, args.iters):8.3f} ms, copy ops: {count_copies(fn)}')
+    max_diff = (outputs['nhd'] - outputs['hnd']).abs().max().item()
+    print(f'max abs diff: {max_diff:.3e}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark flat_pa decode attention on CPU")
+    parser.add_argument("--mode", choices=['layouts', 'cascade', 'topk'], default='layouts')
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--blocks-per-seq", type=int, default=32)
+    parser.add_argument("--block-size", type=int, default=128)
+    parser.add_argument("--q-heads", type=int, default=32)
+    parser.add_argument("--kv-heads", type=int, default=8)
+    parser.add_argument("--head-size", type=int, default=128)
+    parser.add_argument("--dtype", type=lambda x: getattr(torch, x), default=torch.float32)
+    parser.add_argument("--shared-blocks", type=int, default=24, help="prefix blocks shared by all sequences (cascade)")
+    parser.add_argument("--topk", type=int, nargs='+', default=[4, 8, 16], help="selected blocks (topk)")
+    parser.add_argument("--recent", type=int, default=2, help="recent blocks always attended to (topk)")
+    parser.add_argument("--num-needles", type=int, default=4, help="blocks with keys aligned to query (topk)")
+    parser.add_argument("--needle-strength", type=float, default=16.0, help="norm of needle key offset (topk)")
+    parser.add_argument("--iters", type=int, default=10)
+    args = parser.parse_args()
+
+    runtime.RUNTIME_CONFIG = Config(fp32_softmax=False,
+                                    fused_block_softmax=False,
+                                    fused_block_softmax_adjustment=False,
+                                    use_contiguous_pa=False,
+                                    decode_topk_blocks=0,
+                                    decode_recent_blocks=args.recent)
+    torch.manual_seed(0)
+    modes = {
+        'layouts': bench_layouts,
+        'cascade': bench_cascade,
+        'topk': bench_topk,
+    }
+    modes[args.mode](args)
@@ -0,0 +1,66 @@
+###############################################################################
+# Copyright (C) 2025 Habana Labs, Ltd. an Intel Company
+#
+# This source code is licensed under the Apache 2.0 license found in the
+# LICENSE file in the root directory of this source tree.
+###############################################################################
+
+import argparse
+import time
+
+import torch
+
+import vllm_hpu_extension.ops as ops
+
+
+def make_mask(lora_indices, max_loras, rank, dtype):
+    mask = torch.zeros(lora_indices.numel(), max_loras * rank, dtype=dtype)
+    cols = lora_indices.clamp(min=0).unsqueeze(-1) * rank + torch.arange(rank)
+    mask.scatter_(1, cols, 1)
+    return mask.masked_fill_((lora_indices < 0).unsqueeze(-1), 0)
+
+
+def measure(fn, iters):
+    fn()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def bench(args, max_loras):
+    x = torch.randn(args.num_tokens, args.hidden_size, dtype=args.dtype)
+    wa_t_all = torch.randn(max_loras, 1, args.rank, args.hidden_size, dtype=args.dtype)
+    wb_t_all = torch.randn(max_loras, 1, args.hidden_size, args.rank, dtype=args.dtype)
+    active = torch.randperm(max_loras)[:min(args.active, max_loras)]
+    lora_indices = active[torch.randint(0, active.numel(), (args.num_tokens,))]
+    ops.LoraMask.setLoraMask(make_mask(lora_indices, max_loras, args.rank, args.dtype))
+    y_bgmv = torch.zeros(args.num_tokens, args.hidden_size, dtype=args.dtype)
+    y_sgmv = torch.zeros(args.num_tokens, args.hidden_size, dtype=args.dtype)
+
+    def bgmv():
+        ops.dispatch_bgmv_linear(y_bgmv.zero_(), x, wa_t_all, wb_t_all, 0, 1.0)
+
+    def sgmv():
+        ops.dispatch_sgmv_linear(y_sgmv.zero_(), x, wa_t_all, wb_t_all, lora_indices, 0, 1.0)
+
+    t_bgmv, t_sgmv = measure(bgmv, args.iters), measure(sgmv, args.iters)
+    max_diff = (y_bgmv - y_sgmv).abs().max().item()
+    print(f'max_loras={max_loras:4d} active={active.numel():3d}: bgmv {t_bgmv:8.3f} ms, '
+          f'sgmv {t_sgmv:8.3f} ms, max abs diff: {max_diff:.3e}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark mask-based vs segmented LoRA dispatch on CPU")
+    parser.add_argument("--max-loras", type=int, nargs='+', default=[8, 32, 128])
+    parser.add_argument("--active", type=int, default=4, help="number of adapters used in the batch")
+    parser.add_argument("--num-tokens", type=int, default=256)
+    parser.add_argument("--hidden-size", type=int, default=4096)
+    parser.add_argument("--rank", type=int, default=16)
+    parser.add_argument("--dtype", type=lambda x: getattr(torch, x), default=torch.float32)
+    parser.add_argument("--iters", type=int, default=10)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    for max_loras in args.max_loras:
+        bench(args, max_loras)
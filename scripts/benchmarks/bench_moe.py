@@ -0,0 +1,163 @@
+###############################################################################
+# Copyright (C) 2025 Habana Labs, Ltd. an Intel Company
+#
+# This source code is licensed under the Apache 2.0 license found in the
+# LICENSE file in the root directory of this source tree.
+###############################################################################
+
+import argparse
+import time
+
+import torch
+
+import vllm_hpu_extension.expert_cache as expert_cache
+import vllm_hpu_extension.ops as ops
+import vllm_hpu_extension.runtime as runtime
+from vllm_hpu_extension.config import Config
+
+
+def measure(fn, iters):
+    fn()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def make_op(op_cls, args, stacked, w13, w2, w13_scale=None, w2_scale=None):
+    op = op_cls(args.num_experts)
+    if stacked:
+        op.set_stacked_weights(w13, w2, w13_scale, w2_scale)
+    else:
+        for i in range(args.num_experts):
+            op.w13_list[i].set_weight(w13[i])
+            op.w2_list[i].set_weight(w2[i])
+            if w13_scale is not None:
+                op.w13_list[i].set_scale_inv_fp8(w13_scale[i])
+                op.w2_list[i].set_scale_inv_fp8(w2_scale[i])
+    return op
+
+
+def bench_host_overhead(args):
+    """ Host time spent on preparing expert weight lists for mixture_of_experts per forward """
+    w13 = torch.randn(args.num_experts, 2 * args.intermediate_size, args.hidden_size, dtype=torch.bfloat16)
+    w2 = torch.randn(args.num_experts, args.hidden_size, args.intermediate_size, dtype=torch.bfloat16)
+    for stacked in [False, True]:
+        op = make_op(ops.VllmMixtureOfExpertsOp, args, stacked, w13, w2)
+        name = 'stacked' if stacked else 'modules'
+        print(f'bf16 {name}: {measure(op.get_expert_weights, args.iters) * 1000:8.1f} us per layer')
+
+
+def make_fp8_weights(args, block_size):
+    w13 = torch.randn(args.num_experts, 2 * args.intermediate_size, args.hidden_size).to(torch.float8_e4m3fn)
+    w2 = torch.randn(args.num_experts, args.hidden_size, args.intermediate_size).to(torch.float8_e4m3fn)
+    w13_scale = torch.rand(args.num_experts, w13.size(1) // block_size[0], w13.size(2) // block_size[1])
+    w2_scale = torch.rand(args.num_experts, w2.size(1) // block_size[0], w2.size(2) // block_size[1])
+    return w13, w2, w13_scale, w2_scale
+
+
+def bench_fp8_dequant(args):
+    """ Time of dequantizing all block-fp8 experts per forward """
+    weights = make_fp8_weights(args, (128, 128))
+    for stacked in [False, True]:
+        op = make_op(ops.VllmMixtureOfExpertsOpFP8, args, stacked, *weights)
+        name = 'stacked' if stacked else 'modules'
+        print(f'fp8 block dequant {name}: {measure(op.get_dequant_expert_weights, args.iters):8.3f} ms per layer')
+
+
+def bench_dequant_cache(args):
+    """ Memory vs. latency of caching dequantized block-fp8 experts under zipf-skewed routing """
+    weights = make_fp8_weights(args, (128, 128))
+    op = make_op(ops.VllmMixtureOfExpertsOpFP8, args, True, *weights)
+    for m in [*op.w13_list, *op.w2_list]:
+        m.set_weight_block_size((128, 128))
+    expert_bytes = 3 * args.intermediate_size * args.hidden_size * torch.bfloat16.itemsize
+    full_mb = args.num_experts * expert_bytes / 2**20
+    popularity = torch.arange(1, args.num_experts + 1, dtype=torch.float).pow(-args.zipf)
+    prev = runtime.RUNTIME_CONFIG
+    for fraction in [0.0, 0.25, 0.5, 1.0]:
+        budget_mb = max(1, round(fraction * full_mb)) if fraction else 0
+        num_pinned = int(fraction * args.num_experts)
+        runtime.RUNTIME_CONFIG = Config(moe_dequant_cache_mb=budget_mb, moe_dequant_cache_pinned=num_pinned)
+        expert_cache._EXPERT_DEQUANT_CACHE = None
+        op.num_forwards, op.expert_counts = 0, None
+
+        def forward():
+            topk_ids = torch.multinomial(popularity.expand(args.num_tokens, -1), args.topk)
+            if expert_cache.get_expert_dequant_cache() is not None:
+                op.update_hot_experts(topk_ids)
+            op.get_dequant_expert_weights()
+        ms = measure(forward, args.iters)
+        cache = expert_cache.get_expert_dequant_cache()
+        if cache is None:
+            print(f'dequant cache off:  {ms:8.3f} ms per layer, 0.0 MB cached')
+            continue
+        hit_rate = cache.hits / max(1, cache.hits + cache.misses)
+        print(f'dequant cache {budget_mb:4d} MB ({fraction:.0%} of {full_mb:.0f} MB): {ms:8.3f} ms per layer, '
+              f'hit rate {hit_rate:.2f}, {cache.used_bytes / 2**20:.1f} MB cached')
+    runtime.RUNTIME_CONFIG = prev
+    expert_cache._EXPERT_DEQUANT_CACHE = None
+
+
+def bench_routing_imbalance(args):
+    """ Pure torch grouped MoE under increasingly skewed routing """
+    w13 = torch.randn(args.num_experts, 2 * args.intermediate_size, args.hidden_size, dtype=torch.bfloat16)
+    w2 = torch.randn(args.num_experts, args.hidden_size, args.intermediate_size, dtype=torch.bfloat16)
+    w13_list, w2_list = list(w13.unbind(0)), list(w2.unbind(0))
+    hidden_states = torch.randn(args.num_tokens, args.hidden_size, dtype=torch.bfloat16)
+    for zipf in [0.0, 1.0, 2.0]:
+        popularity = torch.arange(1, args.num_experts + 1, dtype=torch.float).pow(-zipf)
+        topk_ids = torch.multinomial(popularity.expand(args.num_tokens, -1), args.topk)
+        topk_weights = torch.rand(args.num_tokens, args.topk, dtype=torch.bfloat16)
+        load = torch.bincount(topk_ids.flatten(), minlength=args.num_experts)
+        ms = measure(lambda: ops.reference_mixture_of_experts(hidden_states, topk_ids, topk_weights,
+                                                              w13_list, w2_list), args.iters)
+        print(f'reference moe zipf={zipf:.1f}: {ms:8.3f} ms, active experts {(load > 0).sum().item():4d}, '
+              f'max/mean load {load.max().item() / load.float().mean().item():6.2f}')
+        scores = popularity.log().expand(args.num_tokens, -1)
+        for policy in ['drop', 'reroute']:
+            capped_weights, capped_ids, num_dropped, num_rerouted = ops.apply_expert_capacity(
+                topk_weights, topk_ids, args.num_experts, args.capacity_factor, policy, scores)
+            ms = measure(lambda: ops.reference_mixture_of_experts(hidden_states, capped_ids, capped_weights,
+                                                                  w13_list, w2_list), args.iters)
+            load = torch.bincount(capped_ids.flatten() + 1, minlength=args.num_experts + 1)[1:]
+            print(f'  capacity {args.capacity_factor} {policy:7s}: {ms:8.3f} ms, '
+                  f'max/mean load {load.max().item() / load.float().mean().item():6.2f}, '
+                  f'dropped {num_dropped.item()}, rerouted {num_rerouted.item()}')
+
+
+def bench_slicing(args):
+    """ Executed slices and experts of fixed vs. routing based slicing """
+    max_per_slice = args.max_experts_per_slice
+    num_slices = args.num_experts // max_per_slice
+    popularity = torch.arange(1, args.num_experts + 1, dtype=torch.float).pow(-args.zipf)
+    popularity = popularity[torch.randperm(args.num_experts)]
+    fixed = [(i * max_per_slice, (i + 1) * max_per_slice) for i in range(num_slices)]
+    for num_tokens in [1, 4, 16, 64]:
+        topk_ids = torch.multinomial(popularity.expand(num_tokens, -1), args.topk)
+        load = torch.bincount(topk_ids.flatten(), minlength=args.num_experts).tolist()
+        adaptive = ops.partition_experts(load, max_per_slice)
+        for name, slices in [('fixed', fixed), ('adaptive', adaptive)]:
+            num_experts = sum(end - start for start, end in slices)
+            print(f'slicing {num_tokens:3d} tokens {name:8s}: {len(slices):3d} slices, {num_experts:4d} experts')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark MoE op weight preparation on CPU")
+    parser.add_argument("--num-experts", type=int, default=256)
+    parser.add_argument("--hidden-size", type=int, default=512)
+    parser.add_argument("--intermediate-size", type=int, default=128)
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--num-tokens", type=int, default=64)
+    parser.add_argument("--topk", type=int, default=8)
+    parser.add_argument("--zipf", type=float, default=1.0)
+    parser.add_argument("--max-experts-per-slice", type=int, default=32)
+    parser.add_argument("--capacity-factor", type=float, default=2.0)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    bench_host_overhead(args)
+    bench_fp8_dequant(args)
+    bench_dequant_cache(args)
+    bench_routing_imbalance(args)
+    bench_slicing(args)
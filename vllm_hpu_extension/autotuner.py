@@ -0,0 +1,131 @@
+###############################################################################
+# Copyright (C) 2025 Habana Labs, Ltd. an Intel Company
+#
+# This source code is licensed under the Apache 2.0 license found in the
+# LICENSE file in the root directory of this source tree.
+###############################################################################
+
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Optional
+
+import habana_frameworks.torch as htorch
+import torch
+
+from vllm_hpu_extension.logger import logger
+from vllm_hpu_extension.runtime import get_config
+
+
+Bucket = tuple[int, int, int]
+
+PROMPT_ATTN_IMPLS = ['flex_impl', 'fsdpa_impl', 'naive_impl']
+
+
+def _synchronize(device: torch.device):
+    if device.type == 'hpu':
+        htorch.core.mark_step()
+        torch.hpu.synchronize()
+
+
+class PromptAttnAutotuner:
+    """ Keeps track of the fastest prompt attention implementation for each prompt bucket """
+
+    def __init__(self, impls: list[str], path: Optional[str] = None, num_iters: int = 3):
+        self.impls = impls
+        self.path = path
+        self.num_iters = num_iters
+        self.table: dict[Bucket, str] = {}
+        self.is_tuning = False
+        if self.path is not None and os.path.exists(self.path):
+            self.load(self.path)
+
+    @staticmethod
+    def get_bucket(args: dict[str, Any]) -> Bucket:
+        """ Extract (batch_size, seq_len, num_context_blocks) from prompt_attention arguments """
+        query = args['query']
+        batch_size, seq_len = query.size(0), query.size(1)
+        block_list = args.get('block_list')
+        ctx = block_list.numel() // batch_size if block_list is not None else 0
+        return (batch_size, seq_len, ctx)
+
+    def lookup(self, bucket: Bucket, default: str) -> str:
+        """ Return tuned implementation for bucket or default one if not tuned """
+        impl = self.table.get(bucket)
+        if impl is None or impl not in self.impls:
+            return default
+        return impl
+
+    def measure(self, fn: Callable[[], torch.Tensor], device: torch.device) -> float:
+        """ Return average execution time of fn in seconds """
+        fn()
+        _synchronize(device)
+        start = time.perf_counter()
+        for _ in range(self.num_iters):
+            fn()
+        _synchronize(device)
+        return (time.perf_counter() - start) / self.num_iters
+
+    def tune(self, bucket: Bucket, impl_fns: dict[str, Callable[[], torch.Tensor]],
+             device: torch.device) -> Optional[str]:
+        """ Time all available implementations for given bucket and record the fastest one """
+        timings = {}
+        for impl in self.impls:
+            if impl not in impl_fns:
+                continue
+            try:
+                timings[impl] = self.measure(impl_fns[impl], device)
+            except Exception as e:
+                logger().warning(f'Autotuner: {impl} failed for bucket {bucket}: {e}')
+        if not timings:
+            return None
+        best = min(timings, key=timings.get)
+        self.table[bucket] = best
+        logger().debug(f'Autotuner: bucket {bucket} timings: {timings}, selected: {best}')
+        return best
+
+    def select(self, default: str, args: dict[str, Any],
+               impl_fns: dict[str, Callable[[], torch.Tensor]]) -> str:
+        """ Return implementation to use, tuning the bucket first if needed """
+        bucket = self.get_bucket(args)
+        if self.is_tuning and bucket not in self.table:
+            self.tune(bucket, impl_fns, args['query'].device)
+        return self.lookup(bucket, default)
+
+    @contextmanager
+    def tuning(self):
+        """ Enable tuning of not yet seen buckets, e.g. for the duration of warmup """
+        self.is_tuning = True
+        try:
+            yield self
+        finally:
+            self.is_tuning = False
+            if self.path is not None:
+                self.save(self.path)
+
+    def load(self, path: str):
+        with open(path) as f:
+            data = json.load(f)
+        self.table = {tuple(int(x) for x in k.split(',')): v for k, v in data.items()}
+        logger().info(f'Autotuner: loaded {len(self.table)} prompt attention buckets from {path}')
+
+    def save(self, path: str):
+        data = {','.join(str(x) for x in k): v for k, v in sorted(self.table.items())}
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
+
+
+_PROMPT_ATTN_AUTOTUNER = None
+
+
+def get_prompt_attn_autotuner() -> Optional[PromptAttnAutotuner]:
+    """ Return global autotuner or None if prompt attention autotuning is disabled """
+    global _PROMPT_ATTN_AUTOTUNER
+    config = get_config()
+    if not config.prompt_attn_autotune:
+        return None
+    if _PROMPT_ATTN_AUTOTUNER is None:
+        impls = [impl for impl in PROMPT_ATTN_IMPLS if config.get(impl)]
+        _PROMPT_ATTN_AUTOTUNER = PromptAttnAutotuner(impls, config.VLLM_PROMPT_ATTN_TUNING_FILE)
+    return _PROMPT_ATTN_AUTOTUNER
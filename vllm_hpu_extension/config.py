@@ -150,12 +150,14 @@ class Env:
 class Value:
     """A callable that returns the value calculated through its dependencies or overriden by an associated experimental flag"""
 
-    def __init__(self, name: str, dependencies: Any, env_var: Optional[str] = None, env_var_type: Constructor = boolean, check: Checker = skip_validation):
+    def __init__(self, name: str, dependencies: Any, env_var: Optional[str] = None, env_var_type: Constructor = boolean, check: Checker = skip_validation,
+                 requires: Optional[ValueFn] = None):
         self.name = name
         self.env_var = env_var if env_var is not None else 'VLLM_' + name.upper()
         self.env_var_type = env_var_type
         self.dependencies = dependencies
         self.check = check
+        self.requires = requires
 
     def to_env_flag(self) -> Env:
         """ Return associated experimental flag """
@@ -175,6 +177,8 @@ class Value:
             result = self.dependencies(config)
         else:
             result = self.dependencies
+        if result and self.requires is not None and not self.requires(config):
+            raise RuntimeError(f'{self.name}: enabled, but its requirements are not met by current configuration!')
         return self._validate(result)
 
 
@@ -28,17 +28,19 @@ class CacheSwapUtils(torch.nn.Module):
     def forward(self, srcs: torch.tensor, dsts: torch.tensor, caches: list[torch.tensor]):
         """ Internal method wrapped in HPU/t.compile graphs"""
         htorch.core.mark_step()
-        srcs = ((srcs * self.block_size).unsqueeze(-1) + self.block_slots).flatten()
-        dsts = ((dsts * self.block_size).unsqueeze(-1) + self.block_slots).flatten()
+        src_slots = ((srcs * self.block_size).unsqueeze(-1) + self.block_slots).flatten()
+        dst_slots = ((dsts * self.block_size).unsqueeze(-1) + self.block_slots).flatten()
         for cache in caches:
-            prev_srcs = cache.index_select(0, srcs)
-            prev_dsts = cache.index_select(0, dsts)
-            cache.index_copy_(0, dsts, prev_srcs)
-            cache.index_copy_(0, srcs, prev_dsts)
+            # Head-major caches are indexed by block_id instead of slot
+            src_ids, dst_ids = (srcs, dsts) if cache.dim() == 4 else (src_slots, dst_slots)
+            prev_srcs = cache.index_select(0, src_ids)
+            prev_dsts = cache.index_select(0, dst_ids)
+            cache.index_copy_(0, dst_ids, prev_srcs)
+            cache.index_copy_(0, src_ids, prev_dsts)
             prev_srcs = None
             prev_dsts = None
-        srcs = None
-        dsts = None
+        src_slots = None
+        dst_slots = None
         htorch.core.mark_step()
 
     def swap(self, to_swap, threshold):
@@ -65,6 +67,9 @@ class OnlineDefragmenter:
         self.bwd_mapping_table = []
         config = get_config()
         self.enabled = with_default(config.VLLM_DEFRAG, False)
+        # Keep all used blocks in [1, num_used] to minimize padding fetched by contiguous PA
+        self.compact = self.enabled and with_default(config.defrag_compaction, False)
+        self.num_swapped = 0
         self.graphed = with_default(config.VLLM_DEFRAG_WITH_GRAPHS, config.bridge_mode == 'eager')
         self.cache_utils: Optional[CacheSwapUtils] = None
         self.debug = init_debug_logger('defrag')
@@ -156,6 +161,16 @@ class OnlineDefragmenter:
         for candidate in itertools.count(last):
             yield candidate
 
+    def padding(self) -> int:
+        """ Number of unused blocks fetched by contiguous PA, which reads all blocks up to max used block_id """
+        if len(self.used_blocks) == 0:
+            return 0
+        return max(self.used_blocks.keys()) + 1 - len(self.used_blocks)
+
+    def is_compact(self) -> bool:
+        """ Check if all used blocks occupy the lowest block_ids (block 0 is reserved) """
+        return len(self.used_blocks) == 0 or max(self.used_blocks.keys()) <= len(self.used_blocks)
+
     def defragment(self):
         """ Check block usage and defragment if necessary """
         if not self.enabled:
@@ -165,8 +180,22 @@ class OnlineDefragmenter:
         max_used = max(self.used_blocks.keys())
         num_used = len(self.used_blocks)
         pre_max_used = max_used
-        if max_used - self.threshold <= num_used:
+        if self.compact:
+            # Swap at most threshold blocks per step, compaction is spread over several steps
+            if not self.is_compact():
+                self._swap_blocks()
+        elif max_used - self.threshold <= num_used:
             return
+        else:
+            self._swap_blocks()
+        if self.debug:
+            max_used = max(self.used_blocks.keys())
+            num_used = len(self.used_blocks)
+            post_status = f'max_id_used={pre_max_used}->{max_used} num_used={num_used}'
+            self.debug(f'defragmentation done {post_status} padding={self.padding()} total_swapped={self.num_swapped}')
+
+    def _swap_blocks(self):
+        """ Move up to threshold blocks with the highest ids into the lowest free ones """
         free = self.free_blocks()
         used = sorted(self.used_blocks.keys(), reverse=True)
 
@@ -179,8 +208,8 @@ class OnlineDefragmenter:
             to_swap.append((used_block, free_block))
 
         for used_block, free_block in to_swap:
-            self.free_block(used_block)
-            self.use_block(free_block)
+            # Move all references, blocks can be shared between requests with prefix caching
+            self.used_blocks[free_block] = self.used_blocks.pop(used_block)
             orig_used_block = self.unresolve(used_block)
             orig_free_block = self.unresolve(free_block)
             self.update_mapping(orig_used_block, free_block)
@@ -188,8 +217,4 @@ class OnlineDefragmenter:
 
         assert self.cache_utils is not None
         self.cache_utils.swap(to_swap, self.threshold)
-        if self.debug:
-            max_used = max(self.used_blocks.keys())
-            num_used = len(self.used_blocks)
-            post_status = f'max_id_used={pre_max_used}->{max_used} num_used={num_used}'
-            self.debug(f'defragmentation done {post_status}')
+        self.num_swapped += len(to_swap)
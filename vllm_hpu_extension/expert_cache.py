@@ -0,0 +1,98 @@
+###############################################################################
+# Copyright (C) 2025 Habana Labs, Ltd. an Intel Company
+#
+# This source code is licensed under the Apache 2.0 license found in the
+# LICENSE file in the root directory of this source tree.
+###############################################################################
+
+import collections
+from typing import Callable, Hashable, Iterable, Optional
+
+import torch
+
+from vllm_hpu_extension.runtime import get_config
+
+
+def _num_bytes(tensor: torch.Tensor) -> int:
+    return tensor.numel() * tensor.element_size()
+
+
+class ExpertDequantCache:
+    """
+    Cache of dequantized expert weights bounded by a memory budget.
+    Each owner (e.g. MoE layer) can pin its hot experts, pinned entries
+    are never evicted but still count towards the budget. MoE ops touch all
+    experts in the same order every forward, which makes plain LRU thrash,
+    so a full cache only evicts (least recently used unpinned entries first)
+    to make room for pinned experts. Entries are stored with the version of
+    the weights they were built from and rebuilt when the version changes,
+    e.g. after the weights were replaced or modified in-place.
+    """
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self.used_bytes = 0
+        self.entries: collections.OrderedDict[Hashable, tuple[Hashable, torch.Tensor]] = collections.OrderedDict()
+        self.pinned: dict[Hashable, set[Hashable]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def is_pinned(self, key: Hashable) -> bool:
+        return any(key in keys for keys in self.pinned.values())
+
+    def pin(self, owner: Hashable, keys: Iterable[Hashable]):
+        """ Replace set of keys pinned by owner """
+        self.pinned[owner] = set(keys)
+
+    def _evict_for(self, num_bytes: int) -> bool:
+        """ Evict least recently used unpinned entries until num_bytes fit into the budget """
+        candidates = (k for k in list(self.entries) if not self.is_pinned(k))
+        while self.used_bytes + num_bytes > self.budget_bytes:
+            victim = next(candidates, None)
+            if victim is None:
+                return False
+            self.used_bytes -= _num_bytes(self.entries.pop(victim)[1])
+            self.evictions += 1
+        return True
+
+    def invalidate(self, key: Hashable):
+        """ Drop cached value of key, if any """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.used_bytes -= _num_bytes(entry[1])
+
+    def get(self, key: Hashable, build_fn: Callable[[], torch.Tensor], version: Hashable = None) -> torch.Tensor:
+        """ Return value cached for key and version or build it, caching the result if there's room for it """
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+        self.invalidate(key)
+        self.misses += 1
+        value = build_fn()
+        num_bytes = _num_bytes(value)
+        fits = self.used_bytes + num_bytes <= self.budget_bytes
+        if fits or (self.is_pinned(key) and num_bytes <= self.budget_bytes and self._evict_for(num_bytes)):
+            self.entries[key] = (version, value)
+            self.used_bytes += num_bytes
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.used_bytes = 0
+
+
+_EXPERT_DEQUANT_CACHE = None
+
+
+def get_expert_dequant_cache() -> Optional[ExpertDequantCache]:
+    """ Return global dequantized expert weight cache or None if it's disabled """
+    global _EXPERT_DEQUANT_CACHE
+    budget_mb = get_config().moe_dequant_cache_mb
+    if not budget_mb:
+        return None
+    if _EXPERT_DEQUANT_CACHE is None:
+        _EXPERT_DEQUANT_CACHE = ExpertDequantCache(budget_mb * 2**20)
+    return _EXPERT_DEQUANT_CACHE
@@ -0,0 +1,104 @@
+###############################################################################
+# Copyright (C) 2025 Habana Labs, Ltd. an Intel Company
+#
+# This source code is licensed under the Apache 2.0 license found in the
+# LICENSE file in the root directory of this source tree.
+###############################################################################
+
+from abc import ABC, abstractmethod
+from typing import List, Optional, Tuple
+
+import torch
+import torch.distributed as dist
+
+
+class ExpertParallelComm(ABC):
+    """ Collectives needed to exchange tokens between expert parallel ranks """
+
+    rank: int
+    world_size: int
+
+    @abstractmethod
+    def all_to_all(self, tensor: torch.Tensor, output_splits: List[int], input_splits: List[int]) -> torch.Tensor:
+        """ Send input_splits[r] rows of tensor to rank r and receive output_splits[r] rows from it """
+        raise NotImplementedError()
+
+
+class LocalComm(ExpertParallelComm):
+    """ Single rank owning all experts """
+
+    rank = 0
+    world_size = 1
+
+    def all_to_all(self, tensor, output_splits, input_splits):
+        return tensor
+
+
+class TorchDistributedComm(ExpertParallelComm):
+    """ torch.distributed based collectives, e.g. gloo for testing on CPU """
+
+    def __init__(self, group: Optional[dist.ProcessGroup] = None):
+        self.group = group
+        self.rank = dist.get_rank(group)
+        self.world_size = dist.get_world_size(group)
+
+    def all_to_all(self, tensor, output_splits, input_splits):
+        output = tensor.new_empty((sum(output_splits), *tensor.shape[1:]))
+        dist.all_to_all_single(output, tensor.contiguous(), output_splits, input_splits, group=self.group)
+        return output
+
+
+def local_expert_range(num_experts: int, comm: ExpertParallelComm) -> Tuple[int, int]:
+    """ Return [experts_min, experts_max] owned by the current rank """
+    assert num_experts % comm.world_size == 0, 'Experts must be evenly split between ranks'
+    experts_per_rank = num_experts // comm.world_size
+    experts_min = comm.rank * experts_per_rank
+    return experts_min, experts_min + experts_per_rank - 1
+
+
+class ExpertParallelMoE(torch.nn.Module):
+    """
+    Expert parallel wrapper of a MoE op owning experts local_expert_range() of the current rank.
+    Every token is sent once to each rank owning at least one of its experts together with
+    its whole routing, the owning ranks run their local experts (other experts are ignored
+    by the op) and the partial results are sent back and summed up.
+    """
+
+    def __init__(self, moe_op: torch.nn.Module, num_experts: int, comm: ExpertParallelComm):
+        super().__init__()
+        self.moe_op = moe_op
+        self.num_experts = num_experts
+        self.comm = comm
+        experts_min, _ = local_expert_range(num_experts, comm)
+        assert moe_op.experts_min == experts_min and moe_op.num_experts == num_experts // comm.world_size
+        self.experts_per_rank = num_experts // comm.world_size
+
+    def dispatch(self, topk_ids: torch.Tensor) -> Tuple[torch.Tensor, List[int], List[int]]:
+        """ Return tokens to send sorted by destination rank and send/receive row counts per rank """
+        world_size = self.comm.world_size
+        num_tokens = topk_ids.size(0)
+        # Dropped assignments (e.g. over expert capacity) are out of range and go to an extra, unused rank
+        dest = topk_ids.long() // self.experts_per_rank
+        dest = dest.masked_fill((topk_ids < 0) | (topk_ids >= self.num_experts), world_size)
+        send_mask = torch.zeros(world_size + 1, num_tokens, dtype=torch.bool, device=topk_ids.device)
+        send_mask[dest.t(), torch.arange(num_tokens, device=topk_ids.device)] = True
+        send_mask = send_mask[:world_size]
+        send_tokens = send_mask.nonzero()[:, 1]
+        input_counts = send_mask.sum(-1).to(torch.int64)
+        output_counts = self.comm.all_to_all(input_counts, [1] * world_size, [1] * world_size)
+        return send_tokens, input_counts.tolist(), output_counts.tolist()
+
+    def forward(self, hidden_states, topk_ids, topk_weights, *args, shared_experts=None, **kwargs):
+        # Shared experts only need local tokens and must be applied once per token
+        shared_output = shared_experts(hidden_states) if shared_experts is not None else None
+        send_tokens, input_splits, output_splits = self.dispatch(topk_ids)
+        recv_states, recv_ids, recv_weights = (
+            self.comm.all_to_all(t[send_tokens], output_splits, input_splits)
+            for t in (hidden_states, topk_ids, topk_weights))
+        if recv_states.size(0) > 0:
+            local_out = self.moe_op(recv_states, recv_ids, recv_weights, *args, **kwargs)
+        else:
+            local_out = recv_states
+        out = self.comm.all_to_all(local_out, input_splits, output_splits)
+        combined = shared_output.clone() if shared_output is not None else torch.zeros_like(hidden_states)
+        return combined.index_add_(0, send_tokens, out)
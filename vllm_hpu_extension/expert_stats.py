@@ -0,0 +1,109 @@
+###############################################################################
+# Copyright (C) 2025 Habana Labs, Ltd. an Intel Company
+#
+# This source code is licensed under the Apache 2.0 license found in the
+# LICENSE file in the root directory of this source tree.
+###############################################################################
+
+from typing import Hashable, Optional
+
+import torch
+
+from vllm_hpu_extension.runtime import get_config
+
+
+class ExpertLoadStats:
+    """
+    Per-layer per-expert routed token counts. Counts are accumulated on device
+    and only every `interval` steps copied to host, added to `counts` and exported
+    as counters of the given profiler, if any. A step ends when the first recorded
+    layer is seen again.
+    """
+
+    def __init__(self, interval: int, profiler=None):
+        self.interval = interval
+        self.profiler = profiler
+        self.layer_names: dict[Hashable, str] = {}
+        self.device_counts: dict[str, torch.Tensor] = {}
+        self.counts: dict[str, torch.Tensor] = {}
+        self.device_overflow: dict[str, torch.Tensor] = {}
+        self.overflow: dict[str, torch.Tensor] = {}
+        self.num_steps = 0
+
+    def _layer_name(self, layer: Hashable) -> str:
+        if layer not in self.layer_names:
+            self.layer_names[layer] = f'moe{len(self.layer_names)}'
+        return self.layer_names[layer]
+
+    def record(self, layer: Hashable, topk_ids: torch.Tensor, num_experts: int, experts_min: int = 0):
+        """ Accumulate tokens routed to experts [experts_min, experts_min + num_experts) of layer """
+        name = self._layer_name(layer)
+        if name == 'moe0' and name in self.device_counts:
+            self.num_steps += 1
+            if self.num_steps % self.interval == 0:
+                self.flush()
+        # Experts outside of the local range are counted in an extra bin which is dropped
+        local_ids = topk_ids.flatten().long() - experts_min
+        local_ids = torch.where((local_ids >= 0) & (local_ids < num_experts), local_ids, num_experts)
+        counts = torch.bincount(local_ids, minlength=num_experts + 1)[:num_experts]
+        if name in self.device_counts:
+            self.device_counts[name] += counts
+        else:
+            self.device_counts[name] = counts
+
+    def record_overflow(self, layer: Hashable, num_dropped: torch.Tensor, num_rerouted: torch.Tensor):
+        """ Accumulate numbers of assignments dropped or rerouted due to expert capacity """
+        name = self._layer_name(layer)
+        overflow = torch.stack([num_dropped, num_rerouted])
+        if name in self.device_overflow:
+            self.device_overflow[name] += overflow
+        else:
+            self.device_overflow[name] = overflow
+
+    def flush(self):
+        """ Move device counts to host and export load summary of each layer """
+        counters = {}
+        for name, device_counts in self.device_counts.items():
+            counts = device_counts.cpu()
+            self.device_counts[name] = torch.zeros_like(device_counts)
+            self.counts[name] = counts if name not in self.counts else self.counts[name] + counts
+            counters.update({f'{name}_{key}': value for key, value in load_summary(counts).items()})
+        for name, device_overflow in self.device_overflow.items():
+            overflow = device_overflow.cpu()
+            self.device_overflow[name] = torch.zeros_like(device_overflow)
+            self.overflow[name] = overflow if name not in self.overflow else self.overflow[name] + overflow
+            counters.update({f'{name}_dropped': overflow[0].item(), f'{name}_rerouted': overflow[1].item()})
+        # Counters go to the runner's profiler, creating another one would split its trace
+        if self.profiler is not None:
+            self.profiler.record_counter(self.profiler.get_timestamp_us(), counters)
+
+
+def load_summary(counts: torch.Tensor) -> dict:
+    """ Number of tokens, active experts and max to mean load ratio """
+    num_tokens = counts.sum().item()
+    mean_load = num_tokens / max(1, counts.numel())
+    return {
+        'tokens': num_tokens,
+        'active_experts': (counts > 0).sum().item(),
+        'imbalance': counts.max().item() / mean_load if num_tokens else 0.0,
+    }
+
+
+_EXPERT_LOAD_STATS = None
+
+
+def get_expert_load_stats(profiler=None) -> Optional[ExpertLoadStats]:
+    """
+    Return global expert load statistics or None if they're disabled.
+    Runner should pass its HabanaHighLevelProfiler to export counters,
+    without it counts are only accumulated on host.
+    """
+    global _EXPERT_LOAD_STATS
+    config = get_config()
+    if not config.moe_expert_stats:
+        return None
+    if _EXPERT_LOAD_STATS is None:
+        _EXPERT_LOAD_STATS = ExpertLoadStats(config.VLLM_MOE_EXPERT_STATS_INTERVAL or 100)
+    if profiler is not None:
+        _EXPERT_LOAD_STATS.profiler = profiler
+    return _EXPERT_LOAD_STATS
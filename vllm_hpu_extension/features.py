@@ -5,7 +5,7 @@
 # LICENSE file in the root directory of this source tree.
 ###############################################################################
 
-from vllm_hpu_extension.config import Not, Hardware, VersionRange, ModelType, Kernel, FirstEnabled, All, Value, ValueFromList, Env, Disabled, Engine, boolean, to_dict, split_values_and_flags, list_of
+from vllm_hpu_extension.config import Not, Hardware, VersionRange, ModelType, Kernel, FirstEnabled, All, Eq, Value, ValueFromList, Env, Disabled, Engine, boolean, to_dict, split_values_and_flags, list_of
 from vllm_hpu_extension.kernels import fsdpa, block_softmax_adjustment
 from vllm_hpu_extension.validation import for_all, choice
 
@@ -51,6 +51,8 @@ def get_experimental_flags():
         Env('VLLM_DEFRAG_THRESHOLD', int),
         Env('VLLM_DEFRAG_WITH_GRAPHS', boolean),
         Env('VLLM_DEBUG', list_of(str), check=for_all(choice('steps', 'defrag'))),
+        Env('VLLM_PROMPT_ATTN_TUNING_FILE', str),
+        Env('VLLM_MOE_EXPERT_STATS_INTERVAL', int),
     ]
     return to_dict(flags)
 
@@ -71,14 +73,36 @@ def get_features():
                                 Not(ModelType('mllama'))), env_var='VLLM_PROMPT_USE_FUSEDSDPA'),
         Value('naive_impl', True),
         ValueFromList('prompt_attn_impl', supported_attn_impls),
+        Value('prompt_attn_split_context', False),
+        Value('prompt_attn_autotune', False),
         Value('skip_warmup', False),
         Value('merged_prefill', False),
-        Value('use_contiguous_pa', Disabled('prefix_caching'), env_var='VLLM_CONTIGUOUS_PA'),
+        Value('mla_split_qk', False),
+        Value('decode_topk_blocks', 0, env_var_type=int),
+        Value('decode_recent_blocks', 2, env_var_type=int),
+        Value('kv_cache_layout', 'nhd', env_var_type=str, check=choice('nhd', 'hnd')),
+        # Contiguous PA maps each block to a single sequence, prefix caching shares blocks between them.
+        # Top-k block selection builds its own sparse block list which contiguous PA can't index
+        Value('use_contiguous_pa', All(Disabled('prefix_caching'), Eq('decode_topk_blocks', 0)),
+              env_var='VLLM_CONTIGUOUS_PA', requires=All(Disabled('prefix_caching'), Eq('decode_topk_blocks', 0))),
         Value('use_delayed_sampling', Engine('v0'), env_var='VLLM_DELAYED_SAMPLING'),
         Value('use_bucketing', True, env_var='VLLM_ENABLE_BUCKETING'),
         Value('exponential_bucketing', True),
         Value('linear_bucketing', True),
         ValueFromList('bucketing_strategy', bucketing_strategies),
+        Value('moe_capacity_factor', 0.0, env_var_type=float),
+        Value('moe_capacity_policy', 'drop', env_var_type=str, check=choice('drop', 'reroute')),
+        Value('max_experts_per_slice', -1, env_var='MAX_EXPERTS_PER_SLICE', env_var_type=int),
+        # Slices follow the routing of each forward, which costs a host sync per MoE layer.
+        # They can't be reused between forwards, stale slices would drop tokens of newly routed experts
+        Value('moe_adaptive_slicing', False),
+        Value('moe_dequant_cache_mb', 0, env_var_type=int),
+        Value('moe_input_scale_margin', 1.0, env_var_type=float),
+        Value('moe_dequant_cache_pinned', 0, env_var_type=int),
+        Value('moe_expert_stats', False),
+        # Overlap shared experts with routed ones by running them on a separate stream
+        Value('moe_shared_experts_stream', False),
         Value('defrag', False),
+        Value('defrag_compaction', False),
     ]
     return split_values_and_flags(features)
@@ -15,7 +15,7 @@ def _kernel(name):
             try:
                 return fn()
             except (ImportError, AttributeError):
-                from .utils import logger
+                from .logger import logger
                 logger().warning(f"Could not import HPU {name} kernel. "
                                  "vLLM will use native implementation")
         return loader_impl
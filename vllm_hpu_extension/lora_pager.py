@@ -0,0 +1,125 @@
+###############################################################################
+# Copyright (C) 2025 Habana Labs, Ltd. an Intel Company
+#
+# This source code is licensed under the Apache 2.0 license found in the
+# LICENSE file in the root directory of this source tree.
+###############################################################################
+
+import collections
+from typing import Hashable, Iterable, Optional
+
+import torch
+
+from vllm_hpu_extension.logger import logger
+from vllm_hpu_extension.ops import LoraContext
+
+
+# Per-layer (lora_a [rank, h_in], lora_b [h_out, rank]) pairs of a single adapter
+AdapterWeights = list[tuple[torch.Tensor, torch.Tensor]]
+
+
+class HostAdapterStore:
+    """ Host-side storage of all known adapters """
+
+    def __init__(self):
+        self.adapters: dict[Hashable, AdapterWeights] = {}
+
+    def add(self, adapter_id: Hashable, weights: AdapterWeights, pin_memory: bool = False):
+        if pin_memory:
+            weights = [(a.pin_memory(), b.pin_memory()) for a, b in weights]
+        self.adapters[adapter_id] = weights
+
+    def load(self, adapter_id: Hashable, path: str):
+        """ Register adapter saved with torch.save as a list of (lora_a, lora_b) pairs, memory-mapped """
+        self.adapters[adapter_id] = torch.load(path, mmap=True, weights_only=True)
+
+    def get(self, adapter_id: Hashable) -> AdapterWeights:
+        return self.adapters[adapter_id]
+
+    def __contains__(self, adapter_id: Hashable) -> bool:
+        return adapter_id in self.adapters
+
+
+class LoraAdapterPager:
+    """
+    Keeps a bounded number of adapters in device slots of stacked LoRA weights
+    consumed by dispatch_bgmv_linear. Adapters are copied from the host store
+    on demand and the least recently used ones not needed by the current batch
+    are evicted. Slot weights are updated in-place, which invalidates
+    entries of ops.LORA_WEIGHT_CACHE.
+    """
+
+    def __init__(self, store: HostAdapterStore, stacked_weights: list[tuple[torch.Tensor, torch.Tensor]]):
+        self.store = store
+        self.stacked_weights = stacked_weights
+        self.num_slots = stacked_weights[0][0].size(0)
+        self.rank = stacked_weights[0][0].size(2)
+        self.slots: collections.OrderedDict[Hashable, int] = collections.OrderedDict()
+        self.free_slots = list(range(self.num_slots))
+        self.in_use: set[Hashable] = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _evict(self) -> Optional[int]:
+        """ Free slot of the least recently used adapter not needed by the current batch """
+        victim = next((a for a in self.slots if a not in self.in_use), None)
+        if victim is None:
+            return None
+        self.evictions += 1
+        return self.slots.pop(victim)
+
+    def _load(self, adapter_id: Hashable, slot: int):
+        for (lora_a, lora_b), (wa_t_all, wb_t_all) in zip(self.store.get(adapter_id), self.stacked_weights):
+            wa_t_all[slot, 0].copy_(lora_a, non_blocking=True)
+            wb_t_all[slot, 0].copy_(lora_b, non_blocking=True)
+        self.slots[adapter_id] = slot
+
+    def _ensure(self, adapter_id: Hashable) -> Optional[int]:
+        """ Return slot holding adapter_id, loading it if needed, or None if no slot can be freed """
+        if adapter_id in self.slots:
+            self.slots.move_to_end(adapter_id)
+            return self.slots[adapter_id]
+        slot = self.free_slots.pop() if self.free_slots else self._evict()
+        if slot is not None:
+            self._load(adapter_id, slot)
+        return slot
+
+    def acquire(self, adapter_ids: Iterable[Hashable]) -> dict[Hashable, int]:
+        """ Make sure all adapters used by the next batch are resident and return their slots """
+        adapter_ids = list(dict.fromkeys(adapter_ids))
+        if len(adapter_ids) > self.num_slots:
+            raise RuntimeError(f'Batch uses {len(adapter_ids)} adapters, but only {self.num_slots} slots are available')
+        self.in_use = set(adapter_ids)
+        mapping = {}
+        for adapter_id in adapter_ids:
+            if adapter_id in self.slots:
+                self.hits += 1
+            else:
+                self.misses += 1
+            mapping[adapter_id] = self._ensure(adapter_id)
+        return mapping
+
+    def prefetch(self, adapter_ids: Iterable[Hashable]):
+        """ Load adapters of queued requests ahead of time without evicting ones used by the current batch """
+        for adapter_id in adapter_ids:
+            if adapter_id in self.slots:
+                continue
+            if self._ensure(adapter_id) is None:
+                logger().debug(f'LoRA pager: no slot available to prefetch adapter {adapter_id}')
+                break
+
+    def build_context(self, token_adapter_ids: list[Optional[Hashable]],
+                      device: Optional[torch.device] = None,
+                      dtype: Optional[torch.dtype] = None) -> LoraContext:
+        """ Acquire adapters for a batch and build per-token slot indices and mask (None means no LoRA) """
+        mapping = self.acquire(a for a in token_adapter_ids if a is not None)
+        device = device or self.stacked_weights[0][0].device
+        dtype = dtype or self.stacked_weights[0][0].dtype
+        lora_indices = torch.tensor([mapping[a] if a is not None else -1 for a in token_adapter_ids],
+                                    dtype=torch.long)
+        cols = lora_indices.clamp(min=0).unsqueeze(-1) * self.rank + torch.arange(self.rank)
+        mask = torch.zeros(lora_indices.numel(), self.num_slots * self.rank, dtype=dtype)
+        mask.scatter_(1, cols, 1).masked_fill_((lora_indices < 0).unsqueeze(-1), 0)
+        return LoraContext(mask=mask.to(device, non_blocking=True),
+                           lora_indices=lora_indices.to(device, non_blocking=True))
@@ -9,8 +9,17 @@ import habana_frameworks.torch as htorch
 import torch
 import torch.nn.functional as F
 import math
+import functools
+import itertools
+import collections
+from contextlib import contextmanager
+from dataclasses import dataclass
+from torch.utils.weak import WeakIdKeyDictionary
 import habana_frameworks.torch.core as htcore
 from vllm_hpu_extension.runtime import get_config
+from vllm_hpu_extension.autotuner import get_prompt_attn_autotuner
+from vllm_hpu_extension.expert_cache import get_expert_dequant_cache
+from vllm_hpu_extension.expert_stats import get_expert_load_stats
 import habana_frameworks.torch.utils.experimental as htexp
 from vllm_hpu_extension.logger import logger
 
@@ -21,9 +30,6 @@ FP8_MAX = torch.finfo(torch.float8_e4m3fn).max
 if is_hpu_gaudi2:
     FP8_MAX = torch.finfo(torch.float8_e4m3fnuz).max
 
-import os
-# MAX_EXPERTS_PER_SLICE is needed for 1.20, up to 64 experts per slice
-MAX_EXPERTS_PER_SLICE = int(os.environ.get("MAX_EXPERTS_PER_SLICE", -1))
 
 def get_inc_quant_method(layer):
     return layer
@@ -49,9 +55,17 @@ def block2batch(tensor, block_mapping, matmul_op=torch.matmul):
     return b2b_impl(tensor, block_mapping.t(), matmul_op)
 
 
+def is_head_major(cache: torch.Tensor) -> bool:
+    """Check if cache uses blocked head-major layout, see utils.kv_cache_shape"""
+    return cache.dim() == 4
+
+
 def pipelined_pa(attn, value, block_bias, block_groups, block_mapping, batch_size,
-                 matmul_av_op, batch2block_matmul_op, block2batch_matmul_op):
-    fused_block_softmax_adjustment_requirements = get_config().fused_block_softmax_adjustment and attn.dtype != torch.float16
+                 matmul_av_op, batch2block_matmul_op, block2batch_matmul_op, allow_fused_ops=True,
+                 return_lse=False):
+    # log-sum-exp of each block's group is only available in the unfused path
+    allow_fused_ops = allow_fused_ops and not return_lse
+    fused_block_softmax_adjustment_requirements = allow_fused_ops and get_config().fused_block_softmax_adjustment and attn.dtype != torch.float16
     # When fp32_softmax is enabled attn is left in fp32 after Q@K
     # We can return to native dtype after we renormalize and calculate the adjustments
     if block_bias is not None and attn.dtype != block_bias.dtype:
@@ -102,6 +116,9 @@ def pipelined_pa(attn, value, block_bias, block_groups, block_mapping, batch_siz
         # Post processing for the attention scores
         rescale = block_adjustment.div(group_sum_adjusted)
     attn = attn.mul(rescale)
+    if return_lse:
+        lse = group_max.view(*adjustment_target_shape).float() + group_sum_adjusted.float().log()
+        return attn, lse
     return attn
 
 def flat_pa_mla(query, key_cache, value_cache, block_list, block_mapping,
@@ -115,9 +132,12 @@ def flat_pa_mla(query, key_cache, value_cache, block_list, block_mapping,
     query = batch2block(scale * query, block_mapping,
                             batch2block_matmul_op).unsqueeze(-2)
     key = keys_fetch_func(key_cache.unflatten(0, (-1, block_size)), block_list)
+    split_qk = False
     if value_cache is not None:
         value = values_fetch_func(value_cache.unflatten(0, (-1, block_size)), block_list)
-        key = torch.concat((value, key), dim=-1)
+        split_qk = get_config().mla_split_qk
+        if not split_qk:
+            key = torch.concat((value, key), dim=-1)
     elif kv_lora_rank is not None:
         value = key[..., :kv_lora_rank]
     else:
@@ -135,7 +155,14 @@ def flat_pa_mla(query, key_cache, value_cache, block_list, block_mapping,
     else:
         key = key.transpose(2, 3)
 
-    attn = matmul_qk_op(query, key)
+    if split_qk:
+        # Q.[latent|rope] is computed as a sum of two matmuls,
+        # so that latent cache doesn't have to be concatenated with rope cache
+        latent_dim = value.size(-1)
+        attn = matmul_qk_op(query[..., :latent_dim], value.transpose(-2, -1))
+        attn = attn + matmul_qk_op(query[..., latent_dim:], key)
+    else:
+        attn = matmul_qk_op(query, key)
     if get_config().fp32_softmax:
         attn = attn.float()
         htcore.mark_step()
@@ -155,31 +182,129 @@ def flat_pa_mla(query, key_cache, value_cache, block_list, block_mapping,
         attn = attn.flatten(1, 2)
     return attn
 
+def absorb_mla_weights(q_weight: torch.Tensor,
+                       kv_b_weight: torch.Tensor,
+                       o_weight: torch.Tensor,
+                       num_heads: int,
+                       qk_nope_head_dim: int,
+                       v_head_dim: int,
+                       kv_lora_rank: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Fold W_UK and W_UV from MLA kv_b_proj into query and output projections,
+    so that decode attends directly to the latent cache with flat_pa_mla.
+    Expected (out_features, in_features) layouts:
+    - q_weight: [num_heads * (qk_nope_head_dim + qk_rope_head_dim), q_in]
+    - kv_b_weight: [num_heads * (qk_nope_head_dim + v_head_dim), kv_lora_rank]
+    - o_weight: [hidden, num_heads * v_head_dim]
+    Returns query weight of [num_heads * (kv_lora_rank + qk_rope_head_dim), q_in]
+    and output weight of [hidden, num_heads * kv_lora_rank].
+    """
+    dtype = q_weight.dtype
+    q_weight = q_weight.float().unflatten(0, (num_heads, -1))
+    q_nope, q_rope = q_weight.split([qk_nope_head_dim, q_weight.size(1) - qk_nope_head_dim], dim=1)
+    kv_b_weight = kv_b_weight.float().view(num_heads, qk_nope_head_dim + v_head_dim, kv_lora_rank)
+    w_uk, w_uv = kv_b_weight.split([qk_nope_head_dim, v_head_dim], dim=1)
+    q_latent = torch.matmul(w_uk.transpose(1, 2), q_nope)
+    q_weight = torch.concat((q_latent, q_rope), dim=1).flatten(0, 1)
+    o_weight = o_weight.float().unflatten(1, (num_heads, v_head_dim)).transpose(0, 1)
+    o_weight = torch.matmul(o_weight, w_uv).transpose(0, 1).flatten(1)
+    return q_weight.to(dtype), o_weight.to(dtype)
+
+
+def _add_alibi_bias(attn: torch.Tensor, alibi_slopes: torch.Tensor,
+                    rel_pos: torch.Tensor, head_dims: Tuple[int, ...]) -> torch.Tensor:
+    """
+    Add ALiBi bias `slope * (key_pos - query_pos)` to attention scores. `rel_pos`
+    has to be broadcastable to scores, the bias itself is never materialized.
+    """
+    dtype = torch.float32 if get_config().fp32_alibi_biases else attn.dtype
+    if attn.dtype != dtype:
+        attn = attn.to(dtype=dtype)
+    num_trailing = attn.dim() - 1 - len(head_dims)
+    slopes = alibi_slopes.to(dtype=dtype).view(1, *head_dims, *[1] * num_trailing)
+    return attn.addcmul_(slopes, rel_pos.to(dtype=dtype))
+
+
 def flat_pa(query, key_cache, value_cache, block_list, block_mapping,
             block_bias, block_groups, block_size, scale, matmul_qk_op,
             position_bias, matmul_av_op, batch2block_matmul_op,
             block2batch_matmul_op, keys_fetch_func, values_fetch_func,
-            **ignored_args):
-    batch_size, _, hidden_size = query.shape
-    _, kv_heads, head_size = key_cache.shape
+            alibi_slopes=None, block_indices=None, block_seq_lens=None,
+            prefix_block_list=None, return_lse=False, block_summary=None, block_tables=None,
+            seq_lens=None, **ignored_args):
+    config = get_config()
+    topk_metadata = (block_summary, block_tables, seq_lens)
+    if config.decode_topk_blocks > 0 and all(t is not None for t in topk_metadata):
+        num_selected = config.decode_topk_blocks + config.decode_recent_blocks
+        # Short sequences fall back to exact attention over all blocks
+        if block_tables.size(1) > num_selected:
+            sparse_metadata = select_topk_blocks(query, block_summary, block_tables, seq_lens, block_size,
+                                                 config.decode_topk_blocks, config.decode_recent_blocks,
+                                                 dtype=block_mapping.dtype)
+            block_list, block_groups, block_mapping, block_bias, block_indices, block_seq_lens = \
+                _get_all(sparse_metadata, 'block_list', 'block_groups', 'block_mapping', 'block_bias',
+                         'block_indices', 'block_seq_lens')
+    if prefix_block_list is not None:
+        return cascade_flat_pa(query=query, key_cache=key_cache, value_cache=value_cache,
+                               block_list=block_list, block_mapping=block_mapping, block_bias=block_bias,
+                               block_groups=block_groups, block_size=block_size, scale=scale,
+                               matmul_qk_op=matmul_qk_op, position_bias=position_bias,
+                               matmul_av_op=matmul_av_op, batch2block_matmul_op=batch2block_matmul_op,
+                               block2batch_matmul_op=block2batch_matmul_op, keys_fetch_func=keys_fetch_func,
+                               values_fetch_func=values_fetch_func, alibi_slopes=alibi_slopes,
+                               prefix_block_list=prefix_block_list, **ignored_args)
+    # Multiple query tokens per sequence (e.g. speculative decoding verification)
+    # are passed as [batch_size, num_query_tokens, hidden_size], causal masking
+    # between them has to be encoded in block_bias, see make_block_bias
+    batch_size, num_query_tokens, hidden_size = query.shape
+    kv_heads, head_size = key_cache.size(1), key_cache.size(2)
     q_heads = hidden_size // head_size
-
-    query_shape = (-1, q_heads, 1, head_size)
-    query = batch2block(scale * query, block_mapping, batch2block_matmul_op).view(query_shape)
-    key = keys_fetch_func(key_cache.unflatten(0, (-1, block_size)), block_list).transpose(1, 2)
-    value = values_fetch_func(value_cache.unflatten(0, (-1, block_size)), block_list).transpose(1, 2)
-    block_bias = block_bias.view(key.size(0), 1, 1, -1)
-    if kv_heads != q_heads:
-        query = query.unflatten(1, (kv_heads, -1))
-        key = key.unflatten(1, (kv_heads, 1))
-        value = value.unflatten(1, (kv_heads, 1))
+    head_major = is_head_major(key_cache)
+    head_dims = (kv_heads, q_heads // kv_heads) if head_major or kv_heads != q_heads else (q_heads,)
+    # Head-major decode stacks queries of a kv head as rows, scores then lack the query token dim
+    stacked_queries = head_major and num_query_tokens == 1
+    # Fused block softmax needs 5D scores with GQA, the token dim is restored as a free view for it
+    unstack_queries = stacked_queries and kv_heads != q_heads and config.fused_block_softmax
+
+    if head_major:
+        # Blocks are already stored as [kv_heads, head_size, block_size] for keys
+        # and [kv_heads, block_size, head_size] for values. Queries that share
+        # a kv head are stacked as rows so that no broadcasting is needed.
+        key = keys_fetch_func(key_cache, block_list)
+        value = values_fetch_func(value_cache, block_list)
+        if num_query_tokens == 1:
+            query_shape = (-1, kv_heads, q_heads // kv_heads, head_size)
+            query = batch2block(scale * query, block_mapping, batch2block_matmul_op).view(query_shape)
+        else:
+            query_shape = (-1, num_query_tokens, kv_heads, q_heads // kv_heads, head_size)
+            query = batch2block(scale * query, block_mapping, batch2block_matmul_op).view(query_shape)
+            query = query.permute(0, 2, 3, 1, 4)
+            key = key.unsqueeze(2)
+            value = value.unsqueeze(2)
         if position_bias is not None:
             position_bias = position_bias.unflatten(1, (kv_heads, -1))
-        if block_bias is not None:
-            block_bias = block_bias.unsqueeze(2)
-    key = key.transpose(-2, -1)
+            if not stacked_queries or unstack_queries:
+                position_bias = position_bias.unsqueeze(-2)
+    else:
+        query_shape = (-1, num_query_tokens, q_heads, head_size)
+        query = batch2block(scale * query, block_mapping, batch2block_matmul_op).view(query_shape).transpose(1, 2)
+        key = keys_fetch_func(key_cache.unflatten(0, (-1, block_size)), block_list).transpose(1, 2)
+        value = values_fetch_func(value_cache.unflatten(0, (-1, block_size)), block_list).transpose(1, 2)
+        if kv_heads != q_heads:
+            query = query.unflatten(1, (kv_heads, -1))
+            key = key.unflatten(1, (kv_heads, 1))
+            value = value.unflatten(1, (kv_heads, 1))
+            if position_bias is not None:
+                position_bias = position_bias.unflatten(1, (kv_heads, -1))
+        key = key.transpose(-2, -1)
+        if position_bias is not None:
+            position_bias = position_bias.unsqueeze(-2)
 
     attn = matmul_qk_op(query, key)
+    if unstack_queries:
+        attn = attn.unsqueeze(-2)
+        value = value.unsqueeze(2)
+        stacked_queries = False
     if get_config().fp32_softmax:
         attn = attn.float()
         htcore.mark_step()
@@ -188,12 +313,37 @@ def flat_pa(query, key_cache, value_cache, block_list, block_mapping,
     if position_bias is not None:
         if attn.dtype != position_bias.dtype:
             attn = attn.to(dtype=position_bias.dtype)
-        attn.add_(position_bias.unsqueeze(-2))
-
+        attn.add_(position_bias)
+    if alibi_slopes is not None:
+        # ALiBi bias is computed per block from distance between keys and the queries
+        slots = torch.arange(block_size, device=block_indices.device)
+        tokens = torch.arange(num_query_tokens, device=block_indices.device)
+        key_pos = (block_indices.unsqueeze(-1) * block_size + slots).unsqueeze(1)
+        query_pos = (block_seq_lens.unsqueeze(-1) - num_query_tokens + tokens).unsqueeze(-1)
+        rel_pos = (key_pos - query_pos).view(-1, *[1] * (attn.dim() - 3), num_query_tokens, block_size)
+        attn = _add_alibi_bias(attn, alibi_slopes, rel_pos, head_dims)
+    block_bias = block_bias.view(key.size(0), *[1] * (attn.dim() - 3), -1, block_size)
+
+    # Fused block softmax kernels expect a single query token per sequence
     attn = pipelined_pa(attn, value, block_bias, block_groups, block_mapping,
                         batch_size=batch_size, matmul_av_op=matmul_av_op,
-                        batch2block_matmul_op=batch2block_matmul_op, block2batch_matmul_op=block2batch_matmul_op)
+                        batch2block_matmul_op=batch2block_matmul_op, block2batch_matmul_op=block2batch_matmul_op,
+                        allow_fused_ops=num_query_tokens == 1, return_lse=return_lse)
+    if return_lse:
+        attn, block_lse = attn
+        # Every block of a sequence holds the same value, sequences without blocks get -inf
+        lse = torch.full([batch_size + 1, *block_lse.shape[1:]], -math.inf,
+                         dtype=block_lse.dtype, device=block_lse.device)
+        lse = lse.index_reduce_(0, block_groups, block_lse, 'amax')[:batch_size]
     attn = block2batch(attn, block_mapping, block2batch_matmul_op)
+    if num_query_tokens > 1 or return_lse:
+        # [batch_size, *heads, num_query_tokens, head_size] -> [batch_size, num_query_tokens, q_heads, head_size]
+        def to_token_major(t):
+            if stacked_queries:
+                t = t.unsqueeze(-2)
+            return t.movedim(-2, 1).flatten(2, -2)
+        attn = to_token_major(attn)
+        return (attn, to_token_major(lse)) if return_lse else attn
     attn = attn.squeeze(-2)
 
     if kv_heads != q_heads:
@@ -201,25 +351,254 @@ def flat_pa(query, key_cache, value_cache, block_list, block_mapping,
     return attn
 
 
+def select_topk_blocks(query: torch.Tensor, block_summary: torch.Tensor, block_tables: torch.Tensor,
+                       seq_lens: torch.Tensor, block_size: int, num_topk: int, num_recent: int,
+                       dtype: torch.dtype = torch.bfloat16) -> dict:
+    """
+    Approximate decode attention by selecting `num_topk` blocks with the highest upper bound
+    of q.k, computed from channel-wise key min/max kept in `block_summary`
+    (see utils.kv_cache_summary_shape), plus `num_recent` last blocks of each sequence.
+    `block_tables` is a padded [batch_size, max_blocks] tensor. Returns flat_pa metadata
+    with a static number of blocks per sequence, unused entries point to dummy block 0.
+    """
+    batch_size, max_blocks = block_tables.shape
+    num_selected = min(num_topk + num_recent, max_blocks)
+    kv_heads, head_size = block_summary.size(2), block_summary.size(3)
+    query = query.view(batch_size, kv_heads, -1, head_size).to(block_summary.dtype)
+    summary = block_summary.index_select(0, block_tables.flatten()).view(batch_size, max_blocks, 2, kv_heads, head_size)
+    key_min, key_max = summary.permute(2, 0, 3, 4, 1).unbind(0)
+    # max(q * k) over keys within [min, max] is reached at one of the bounds for each channel
+    scores = torch.matmul(query.clamp(min=0), key_max) + torch.matmul(query.clamp(max=0), key_min)
+    scores = scores.amax(dim=(1, 2))
+
+    block_idx = torch.arange(max_blocks, device=block_tables.device)
+    num_seq_blocks = torch.div(seq_lens + block_size - 1, block_size, rounding_mode='floor').unsqueeze(-1)
+    scores = scores.masked_fill(block_idx >= num_seq_blocks - num_recent, math.inf)
+    scores = scores.masked_fill(block_idx >= num_seq_blocks, -math.inf)
+    block_indices = scores.topk(num_selected, dim=-1).indices
+    valid = block_indices < num_seq_blocks
+
+    block_list = block_tables.gather(1, block_indices).masked_fill(~valid, 0)
+    block_groups = torch.arange(batch_size, device=block_tables.device).unsqueeze(-1).expand(-1, num_selected)
+    block_groups = block_groups.masked_fill(~valid, batch_size).flatten()
+    block_seq_lens = seq_lens.unsqueeze(-1).expand(-1, num_selected).flatten()
+    block_indices = block_indices.flatten()
+    return dict(
+        block_list=block_list.flatten(),
+        block_groups=block_groups,
+        block_mapping=torch.nn.functional.one_hot(block_groups, batch_size + 1)[:, :batch_size].to(dtype),
+        block_bias=make_block_bias(block_indices, block_seq_lens, block_size, dtype=dtype),
+        block_indices=block_indices,
+        block_seq_lens=block_seq_lens,
+    )
+
+
+def cascade_flat_pa(query, prefix_block_list, prefix_block_groups, prefix_block_mapping,
+                    prefix_block_bias, prefix_query_index, prefix_row_index, **kwargs):
+    """
+    Cascade attention for decode batches where groups of sequences share prefix blocks.
+    Shared blocks are fetched and scored once per group with queries of all group members
+    stacked as rows (see `make_cascade_metadata`), remaining blocks of each sequence are
+    handled by regular flat_pa. Both partial results are merged using their log-sum-exp.
+    """
+    assert kwargs.get('position_bias') is None and kwargs.get('alibi_slopes') is None, \
+        'Position bias is not supported with cascade attention'
+    num_groups, group_size = prefix_query_index.shape
+    prefix_query = query.flatten(0, 1).index_select(0, prefix_query_index.flatten())
+    prefix_args = dict(kwargs, block_list=prefix_block_list, block_groups=prefix_block_groups,
+                       block_mapping=prefix_block_mapping, block_bias=prefix_block_bias)
+    prefix_out, prefix_lse = flat_pa(query=prefix_query.view(num_groups, group_size, -1),
+                                     return_lse=True, **prefix_args)
+    suffix_out, suffix_lse = flat_pa(query=query, return_lse=True, **kwargs)
+
+    # Sequences without shared prefix have negative row index and get no prefix contribution
+    has_prefix = (prefix_row_index >= 0).view(-1, 1, 1, 1)
+    row_index = prefix_row_index.clamp(min=0)
+    prefix_out = prefix_out.flatten(0, 1).index_select(0, row_index).unsqueeze(1)
+    prefix_lse = prefix_lse.flatten(0, 1).index_select(0, row_index).unsqueeze(1)
+    prefix_lse = prefix_lse.masked_fill(~has_prefix, -math.inf)
+    out, _ = _merge_attn_states(prefix_out, prefix_lse, suffix_out, suffix_lse)
+    return out.squeeze(1)
+
+
+def make_cascade_metadata(block_tables: List[List[int]], seq_lens: List[int], block_size: int,
+                          device: torch.device = 'cpu',
+                          dtype: torch.dtype = torch.bfloat16) -> dict:
+    """
+    Split decode block tables into blocks shared between sequences and per-sequence suffixes.
+    Sequences are grouped by their first block, shared prefix of a group is the longest
+    common run of full blocks not containing the last token of any member.
+    Returns flat_pa arguments for suffix blocks together with prefix_* arguments
+    used by `cascade_flat_pa`.
+    """
+    groups = collections.defaultdict(list)
+    for seq_idx, block_table in enumerate(block_tables):
+        if block_table:
+            groups[block_table[0]].append(seq_idx)
+    prefixes = []
+    for members in groups.values():
+        if len(members) < 2:
+            continue
+        max_len = min((seq_lens[i] - 1) // block_size for i in members)
+        prefix_len = 0
+        while prefix_len < max_len and len({block_tables[i][prefix_len] for i in members}) == 1:
+            prefix_len += 1
+        if prefix_len > 0:
+            prefixes.append((members, prefix_len))
+
+    prefix_lens = [0] * len(block_tables)
+    prefix_row_index = [-1] * len(block_tables)
+    group_size = max((len(members) for members, _ in prefixes), default=1)
+    prefix_query_index, prefix_block_list, prefix_block_groups = [], [], []
+    for group_idx, (members, prefix_len) in enumerate(prefixes):
+        for row, seq_idx in enumerate(members):
+            prefix_lens[seq_idx] = prefix_len
+            prefix_row_index[seq_idx] = group_idx * group_size + row
+        prefix_query_index.append(members + [members[0]] * (group_size - len(members)))
+        prefix_block_list.extend(block_tables[members[0]][:prefix_len])
+        prefix_block_groups.extend([group_idx] * prefix_len)
+
+    suffix_tables = [bt[p:] for bt, p in zip(block_tables, prefix_lens)]
+    block_groups = [i for i, bt in enumerate(suffix_tables) for _ in bt]
+    block_indices = [p + j for bt, p in zip(suffix_tables, prefix_lens) for j in range(len(bt))]
+    block_groups = torch.tensor(block_groups, dtype=torch.long, device=device)
+    block_seq_lens = torch.tensor(seq_lens, dtype=torch.long, device=device)[block_groups]
+    prefix_block_groups = torch.tensor(prefix_block_groups, dtype=torch.long, device=device)
+    num_prefix_blocks = len(prefix_block_list)
+    metadata = dict(
+        block_list=torch.tensor(sum(suffix_tables, []), dtype=torch.long, device=device),
+        block_groups=block_groups,
+        block_mapping=torch.nn.functional.one_hot(block_groups, len(block_tables)).to(dtype),
+        block_bias=make_block_bias(torch.tensor(block_indices, dtype=torch.long, device=device),
+                                   block_seq_lens, block_size, dtype=dtype),
+    )
+    if not prefixes:
+        return metadata
+    return dict(
+        metadata,
+        prefix_block_list=torch.tensor(prefix_block_list, dtype=torch.long, device=device),
+        prefix_block_groups=prefix_block_groups,
+        prefix_block_mapping=torch.nn.functional.one_hot(prefix_block_groups, len(prefixes)).to(dtype),
+        prefix_block_bias=torch.zeros(num_prefix_blocks, block_size, dtype=dtype, device=device),
+        prefix_query_index=torch.tensor(prefix_query_index, dtype=torch.long, device=device).view(-1, group_size),
+        prefix_row_index=torch.tensor(prefix_row_index, dtype=torch.long, device=device),
+    )
+
+
+def select_window_blocks(block_table: List[int], seq_len: int, block_size: int,
+                         window_size: int, num_sink_tokens: int = 0) -> Tuple[List[int], List[int]]:
+    """
+    Select blocks that can be attended to by the last token of a sequence
+    using sliding window attention. Token at position `p` is visible if
+    `seq_len - 1 - p < window_size` or `p < num_sink_tokens`.
+    Returns block ids together with their logical indices within the sequence,
+    the latter are needed by `make_block_bias` to mask slots partially
+    outside of the window.
+    """
+    num_blocks = math.ceil(seq_len / block_size)
+    first_block = max(seq_len - window_size, 0) // block_size
+    num_sink_blocks = min(math.ceil(num_sink_tokens / block_size), first_block)
+    indices = list(range(num_sink_blocks)) + list(range(first_block, num_blocks))
+    return [block_table[i] for i in indices], indices
+
+
+def make_block_bias(block_indices: torch.Tensor,
+                    block_seq_lens: torch.Tensor,
+                    block_size: int,
+                    window_size: Optional[int] = None,
+                    num_sink_tokens: int = 0,
+                    num_query_tokens: int = 1,
+                    dtype: torch.dtype = torch.bfloat16) -> torch.Tensor:
+    """
+    Build additive block_bias of shape [num_blocks, block_size] for flat_pa.
+    `block_indices` holds logical index of each block within its sequence
+    and `block_seq_lens` length of the sequence each block belongs to.
+    Slots past the end of the sequence are always masked, with `window_size`
+    also slots outside of the window (except for the first `num_sink_tokens`).
+    With `num_query_tokens` > 1 the last tokens of each sequence are queries
+    and the bias has shape [num_blocks, num_query_tokens, block_size] with causal
+    masking between them. Masked slots are set to the lowest finite value
+    so that blocks fully masked for some query don't produce NaNs.
+    """
+    slots = torch.arange(block_size, device=block_indices.device)
+    positions = block_indices.unsqueeze(-1) * block_size + slots
+    query_pos = (block_seq_lens - 1).unsqueeze(-1)
+    if num_query_tokens > 1:
+        tokens = torch.arange(num_query_tokens, device=block_indices.device)
+        positions = positions.unsqueeze(1)
+        query_pos = (query_pos - num_query_tokens + 1 + tokens).unsqueeze(-1)
+    mask = positions > query_pos
+    if window_size is not None:
+        outside_window = (query_pos - positions) >= window_size
+        if num_sink_tokens > 0:
+            outside_window &= positions >= num_sink_tokens
+        mask |= outside_window
+    bias = torch.zeros(mask.shape, dtype=dtype, device=block_indices.device)
+    return bias.masked_fill_(mask, torch.finfo(dtype).min)
+
+
+def _flex_mask_mod(q_offset: int, window_size: Optional[int] = None,
+                   doc_ids: Optional[torch.Tensor] = None) -> Callable:
+    def mask_mod(
+        batch: torch.Tensor,
+        head: torch.Tensor,
+        token_q: torch.Tensor,
+        token_kv: torch.Tensor,
+    ) -> torch.Tensor:
+        token_q = token_q + q_offset
+        mask = token_q >= token_kv
+        if window_size is not None:
+            mask = mask & (token_q - token_kv < window_size)
+        if doc_ids is not None:
+            mask = mask & (doc_ids[token_q] == doc_ids[token_kv])
+        return mask
+    return mask_mod
+
+
+@functools.lru_cache(maxsize=64)
+def _flex_block_mask(q_len: int, kv_len: int, device: torch.device,
+                     window_size: Optional[int] = None, varlen: bool = False):
+    """
+    Create BlockMask for causal prompt attention, optionally limited to a sliding
+    window. Masks are cached per bucket shape so that tiles that are fully masked
+    are skipped without recomputing the mask on every call.
+    With varlen the mask also keeps documents packed into a single sequence apart.
+    Document ids are read from the returned buffer that has to be filled before
+    each call, which lets a single mask serve all batches of a bucket.
+    """
+    from torch.nn.attention.flex_attention import create_block_mask, BlockMask
+    q_offset = kv_len - q_len
+    block_mask = create_block_mask(_flex_mask_mod(q_offset, window_size), None, None, q_len, kv_len, device=device)
+    if not varlen:
+        return block_mask, None
+    doc_ids = torch.zeros(kv_len, dtype=torch.int64, device=device)
+    # Document boundaries differ between batches, so every tile has to go through mask_mod
+    partial_blocks = block_mask.to_dense()
+    kv_indices = partial_blocks.argsort(dim=-1, descending=True, stable=True).to(torch.int32)
+    block_mask = BlockMask.from_kv_blocks(partial_blocks.sum(dim=-1).to(torch.int32), kv_indices,
+                                          BLOCK_SIZE=block_mask.BLOCK_SIZE,
+                                          mask_mod=_flex_mask_mod(q_offset, window_size, doc_ids),
+                                          seq_lengths=(q_len, kv_len))
+    return block_mask, doc_ids
+
+
 def _flex_prompt_attention(
     query: torch.Tensor,
     key: torch.Tensor,
     value: torch.Tensor,
     scale: float,
+    window_size: Optional[int] = None,
+    cu_seqlens: Optional[List[int]] = None,
     **ignored_args,
 ) -> torch.Tensor:
     query = query.transpose(1, 2)
     key = key.transpose(1, 2)
     value = value.transpose(1, 2)
 
-    def _causal(
-        score: torch.Tensor,
-        batch: torch.Tensor,
-        head: torch.Tensor,
-        token_q: torch.Tensor,
-        token_kv: torch.Tensor,
-    ) -> torch.Tensor:
-        return torch.where(token_q >= token_kv, score, float("-inf"))
+    block_mask, doc_ids = _flex_block_mask(query.size(2), key.size(2), query.device,
+                                           window_size, cu_seqlens is not None)
+    if doc_ids is not None:
+        doc_ids.copy_(_doc_ids(cu_seqlens, key.size(2), query.device))
 
     from torch.nn.attention.flex_attention import flex_attention
 
@@ -227,10 +606,10 @@ def _flex_prompt_attention(
         query,
         key,
         value,
-        score_mod=_causal,
+        score_mod=None,
         enable_gqa=True,
         return_lse=False,
-        block_mask=None,
+        block_mask=block_mask,
         scale=scale,
     )
 
@@ -238,6 +617,26 @@ def _flex_prompt_attention(
     return attn_weights
 
 
+def _doc_ids(cu_seqlens: List[int], length: int, device: torch.device) -> torch.Tensor:
+    """ Index of the packed sequence each of the `length` tokens belongs to """
+    bounds = torch.as_tensor(cu_seqlens[1:], device=device)
+    return torch.bucketize(torch.arange(length, device=device), bounds, right=True)
+
+
+def _varlen_causal_mask(cu_seqlens: List[int], q_len: int, kv_len: int,
+                        device: torch.device) -> torch.Tensor:
+    """
+    Boolean mask of shape [q_len, kv_len] that is True for masked out positions.
+    Tokens attend causally only within their own sequence, sequences are
+    packed one after another as described by cumulative lengths `cu_seqlens`.
+    """
+    kv_pos = torch.arange(kv_len, device=device)
+    q_pos = kv_pos[kv_len - q_len:]
+    doc_ids = _doc_ids(cu_seqlens, kv_len, device)
+    causal_mask = q_pos.unsqueeze(-1) < kv_pos.unsqueeze(0)
+    return causal_mask | (doc_ids[kv_len - q_len:].unsqueeze(-1) != doc_ids.unsqueeze(0))
+
+
 def _naive_prompt_attention(
         query: torch.Tensor,
         key: torch.Tensor,
@@ -248,6 +647,8 @@ def _naive_prompt_attention(
         matmul_qk_op=torch.matmul,
         softmax_op=torch.softmax,
         matmul_av_op=torch.matmul,
+        cu_seqlens: Optional[List[int]] = None,
+        alibi_slopes: Optional[torch.Tensor] = None,
         **ignored_args
 ) -> torch.Tensor:
     query = query.transpose(1, 2)
@@ -255,6 +656,10 @@ def _naive_prompt_attention(
     value = value.transpose(1, 2)
     query_heads = query.size(1)
     kv_heads = key.size(1)
+    head_dims = (kv_heads, query_heads // kv_heads) if query_heads != kv_heads else (query_heads,)
+    varlen_mask = None
+    if cu_seqlens is not None:
+        varlen_mask = _varlen_causal_mask(cu_seqlens, query.size(2), key.size(2), query.device)
     if query_heads != kv_heads:
         query = query.unflatten(1, (kv_heads, -1))
         key = key.unflatten(1, (kv_heads, 1))
@@ -276,10 +681,17 @@ def _naive_prompt_attention(
             attn_weights = attn_weights.to(dtype=position_bias.dtype)
             htcore.mark_step()
         attn_weights.add_(position_bias)
+    if alibi_slopes is not None:
+        q_len, kv_len = query.size(-2), key.size(-2)
+        kv_pos = torch.arange(kv_len, device=query.device)
+        rel_pos = kv_pos.unsqueeze(0) - kv_pos[kv_len - q_len:].unsqueeze(-1)
+        attn_weights = _add_alibi_bias(attn_weights, alibi_slopes, rel_pos, head_dims)
     if attn_bias is not None:
         if attn_weights.dtype != attn_bias.dtype:
             attn_bias = attn_bias.to(dtype=attn_weights.dtype)
         attn_weights.add_(attn_bias)
+    if varlen_mask is not None:
+        attn_weights.masked_fill_(varlen_mask, -math.inf)
     if get_config().fp32_softmax:
         attn_weights = torch.softmax(attn_weights, dim=-1)
     else:
@@ -338,32 +750,197 @@ def _fsdpa_prompt_attention(
     return attn_weights
 
 
+def _partial_attention(
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        attn_bias: Optional[torch.Tensor],
+        matmul_qk_op=torch.matmul,
+        matmul_av_op=torch.matmul,
+        alibi_slopes: Optional[torch.Tensor] = None,
+        rel_pos: Optional[torch.Tensor] = None,
+        head_dims: Optional[Tuple[int, ...]] = None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Attention over a subset of keys, returns normalized output and its log-sum-exp"""
+    attn = matmul_qk_op(query, key.transpose(-1, -2))
+    if get_config().fp32_softmax:
+        attn = attn.float()
+    if alibi_slopes is not None:
+        attn = _add_alibi_bias(attn, alibi_slopes, rel_pos, head_dims)
+    if attn_bias is not None:
+        attn.add_(attn_bias.to(dtype=attn.dtype))
+    # Rows without any visible key would produce NaNs, clamp their max to a finite value
+    attn_max = attn.amax(dim=-1, keepdim=True).clamp(min=torch.finfo(attn.dtype).min)
+    attn = attn.sub(attn_max).exp()
+    attn_sum = attn.sum(dim=-1, keepdim=True)
+    out = matmul_av_op(attn.to(value.dtype), value)
+    out = out.div(attn_sum.clamp(min=torch.finfo(attn_sum.dtype).tiny).to(out.dtype))
+    return out, attn_max + attn_sum.log()
+
+
+def _merge_attn_states(
+        out_a: torch.Tensor,
+        lse_a: torch.Tensor,
+        out_b: torch.Tensor,
+        lse_b: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Combine two partial attention results computed over disjoint sets of keys"""
+    lse = torch.logaddexp(lse_a, lse_b)
+    out = out_a * (lse_a - lse).exp().to(out_a.dtype) + out_b * (lse_b - lse).exp().to(out_b.dtype)
+    return out, lse
+
+
+def _split_context_prompt_attention(
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        scale: float,
+        past_key: torch.Tensor,
+        past_value: torch.Tensor,
+        attn_bias: torch.Tensor,
+        position_bias: Optional[torch.Tensor] = None,
+        alibi_slopes: Optional[torch.Tensor] = None,
+        matmul_qk_op=torch.matmul,
+        matmul_av_op=torch.matmul,
+        **ignored_args
+) -> torch.Tensor:
+    """
+    Prompt attention for chunks with cached context. Past and current tokens
+    are attended to separately and merged using log-sum-exp, which avoids
+    concatenating past and current key/values. attn_bias has to mask padding
+    of the context, valid_seq_lengths are therefore not needed. ALiBi and
+    position bias are applied to both parts, with positions counted over the
+    padded context like in the concatenated path.
+    """
+    query = query.transpose(1, 2)
+    key = key.transpose(1, 2)
+    value = value.transpose(1, 2)
+    past_key = past_key.transpose(1, 2)
+    past_value = past_value.transpose(1, 2)
+    query_heads = query.size(1)
+    kv_heads = key.size(1)
+    head_dims = (kv_heads, query_heads // kv_heads) if query_heads != kv_heads else (query_heads,)
+    past_len = past_key.size(2)
+    seq_len = query.size(2)
+    kv_pos = torch.arange(past_len + seq_len, device=query.device)
+    rel_pos = kv_pos.unsqueeze(0) - kv_pos[past_len:].unsqueeze(-1)
+    if position_bias is not None:
+        attn_bias = attn_bias + position_bias.to(attn_bias.dtype)
+    if query_heads != kv_heads:
+        query = query.unflatten(1, (kv_heads, -1))
+        key = key.unflatten(1, (kv_heads, 1))
+        value = value.unflatten(1, (kv_heads, 1))
+        past_key = past_key.unflatten(1, (kv_heads, 1))
+        past_value = past_value.unflatten(1, (kv_heads, 1))
+        attn_bias = attn_bias.unflatten(1, (kv_heads, -1)) if attn_bias.size(1) > 1 else attn_bias.unsqueeze(2)
+    query = query * scale
+    past_out, past_lse = _partial_attention(query, past_key, past_value, attn_bias[..., :past_len],
+                                            matmul_qk_op, matmul_av_op,
+                                            alibi_slopes, rel_pos[:, :past_len], head_dims)
+    current_out, current_lse = _partial_attention(query, key, value, attn_bias[..., past_len:],
+                                                  matmul_qk_op, matmul_av_op,
+                                                  alibi_slopes, rel_pos[:, past_len:], head_dims)
+    attn_weights, _ = _merge_attn_states(past_out, past_lse, current_out, current_lse)
+    attn_weights = attn_weights.to(query.dtype)
+
+    if query_heads != kv_heads:
+        attn_weights = attn_weights.flatten(1, 2)
+    attn_weights = attn_weights.transpose(1, 2)
+    return attn_weights
+
+
 def prompt_attention(
         impl: str,
         **args,
 ) -> torch.Tensor:
+    # Split context replaces impl, it relies on attn_bias to mask padding of the context and
+    # doesn't support packed sequences, otherwise context is concatenated and impl is used.
+    # Sliding window is left to impl as well, padding would shift the window of shorter contexts
+    use_split_context = (get_config().prompt_attn_split_context and _has_past(args)
+                         and args.get('attn_bias') is not None and args.get('cu_seqlens') is None
+                         and args.get('window_size') is None)
+    if use_split_context:
+        args['past_key'] = _fetch_past('key', 'keys_fetch_func', 'key_cache', args)
+        args['past_value'] = _fetch_past('value', 'values_fetch_func', 'value_cache', args)
+        return _split_context_prompt_attention(**args)
     _get_context(args)
-    impl_mapping = {
-        'naive_impl': _naive_prompt_attention,
-        'fsdpa_impl': _fsdpa_prompt_attention,
-        'flex_impl': _flex_prompt_attention,
-    }
-    assert impl in impl_mapping, f'Unsupported implementation: {impl}'
-    return impl_mapping[impl](**args)
+    if args.get('cu_seqlens') is not None:
+        assert args.get('attn_bias') is None, 'cu_seqlens and attn_bias are mutually exclusive'
+    if (autotuner := get_prompt_attn_autotuner()) is not None:
+        # Only consider implementations honoring all masks and biases the caller prepared for `impl`
+        supported = _supported_prompt_attn_impls(args) | {impl}
+        impl_fns = {}
+        if autotuner.is_tuning:
+            impl_fns = {k: functools.partial(_run_prompt_attn_impl, k, args) for k in supported}
+        tuned = autotuner.select(impl, args, impl_fns)
+        impl = tuned if tuned in supported else impl
+    return _run_prompt_attn_impl(impl, args)
+
+
+_PROMPT_ATTN_IMPLS = {
+    'naive_impl': _naive_prompt_attention,
+    'fsdpa_impl': _fsdpa_prompt_attention,
+    'flex_impl': _flex_prompt_attention,
+}
+
+
+def _run_prompt_attn_impl(impl: str, args: dict) -> torch.Tensor:
+    assert impl in _PROMPT_ATTN_IMPLS, f'Unsupported implementation: {impl}'
+    if impl == 'fsdpa_impl' and args.get('cu_seqlens') is not None:
+        # FusedSDPA needs an explicit mask for packed sequences
+        query, key = args['query'], args['key']
+        mask = _varlen_causal_mask(args['cu_seqlens'], query.size(1), key.size(1), query.device)
+        attn_bias = torch.zeros(mask.shape, dtype=query.dtype, device=query.device)
+        args = dict(args, attn_bias=attn_bias.masked_fill_(mask, -math.inf).view(1, 1, *mask.shape))
+    return _PROMPT_ATTN_IMPLS[impl](**args)
+
+
+def _supported_prompt_attn_impls(args: dict) -> set:
+    """
+    Implementations that handle every mask and bias present in prompt_attention args:
+    flex is always causal and ignores explicit biases, naive has no implicit causal
+    mask nor sliding window and FusedSDPA supports neither position bias nor ALiBi.
+    """
+    def given(*keys):
+        return any(args.get(k) is not None for k in keys)
+    supported = set()
+    if not given('attn_bias', 'position_bias', 'alibi_slopes'):
+        supported.add('flex_impl')
+    if given('attn_bias', 'cu_seqlens') and not given('window_size'):
+        supported.add('naive_impl')
+    if (given('fsdpa_op') and given('attn_bias', 'valid_seq_lengths', 'cu_seqlens')
+            and not given('position_bias', 'alibi_slopes')):
+        supported.add('fsdpa_impl')
+    return supported
 
 
 def _get_all(data, *keys):
     return [data.get(k, None) for k in keys]
 
 
-def _include_past(tensor_str, fn_str, cache_str, args):
+def _has_past(args):
+    keys = ('key_cache', 'value_cache', 'keys_fetch_func', 'values_fetch_func', 'block_list', 'block_size')
+    return all(t is not None for t in _get_all(args, *keys))
+
+
+def _fetch_past(tensor_str, fn_str, cache_str, args):
     all_tensors = _get_all(args, tensor_str, fn_str,
                            cache_str, 'block_list', 'block_size')
     if all(t is not None for t in all_tensors):
         current, fn, cache, block_list, block_size = all_tensors
-        past = fn(cache.unflatten(0, (-1, block_size)), block_list)
-        past = past.reshape(current.size(0), -1, past.shape[2], past.shape[3])
-        current = torch.concat((past, current), dim=1)
+        if is_head_major(cache):
+            past = fn(cache, block_list)
+            past = past.permute(0, 3, 1, 2) if tensor_str == 'key' else past.transpose(1, 2)
+        else:
+            past = fn(cache.unflatten(0, (-1, block_size)), block_list)
+        return past.reshape(current.size(0), -1, past.shape[2], past.shape[3])
+    return None
+
+
+def _include_past(tensor_str, fn_str, cache_str, args):
+    past = _fetch_past(tensor_str, fn_str, cache_str, args)
+    if past is not None:
+        current = torch.concat((past, args[tensor_str]), dim=1)
         args[tensor_str] = current
 
 
@@ -372,7 +949,57 @@ def _get_context(args):
     _include_past('value', 'values_fetch_func', 'value_cache', args)
 
 
+@dataclass
+class LoraContext:
+    """ Per-batch LoRA state passed explicitly to dispatch functions """
+    mask: Optional[torch.Tensor] = None
+    lora_indices: Optional[torch.Tensor] = None
+
+
+def _relayout_lora_a(wa_t_all: torch.Tensor) -> torch.Tensor:
+    wa = wa_t_all[:, 0, :, :]
+    return wa.reshape(wa.shape[0] * wa.shape[1], wa.shape[2]).transpose(0, 1)
+
+
+def _relayout_lora_b(wb_t_all: torch.Tensor) -> torch.Tensor:
+    wb = wb_t_all[:, 0, :, :].transpose(1, 2)
+    return wb.reshape(wb.shape[0] * wb.shape[1], wb.shape[2])
+
+
+class LoraWeightCache:
+    """
+    Keeps stacked LoRA weights of each layer re-laid-out for bgmv dispatch:
+    `wa` of shape (h_in, max_loras * lora_rank) and `wb` of shape
+    (max_loras * lora_rank, h_out). Entries are rebuilt when stacked weights
+    are modified in-place, i.e. when adapters are loaded or swapped.
+    """
+
+    def __init__(self):
+        self.entries = WeakIdKeyDictionary()
+
+    def _get(self, weight: torch.Tensor, relayout_fn: Callable) -> torch.Tensor:
+        version = (weight._version, weight.data_ptr())
+        entry = self.entries.get(weight)
+        if entry is None or entry[0] != version:
+            entry = (version, relayout_fn(weight).contiguous())
+            self.entries[weight] = entry
+        return entry[1]
+
+    def get_a(self, wa_t_all: torch.Tensor) -> torch.Tensor:
+        return self._get(wa_t_all, _relayout_lora_a)
+
+    def get_b(self, wb_t_all: torch.Tensor) -> torch.Tensor:
+        return self._get(wb_t_all, _relayout_lora_b)
+
+    def invalidate(self):
+        self.entries.clear()
+
+
+LORA_WEIGHT_CACHE = LoraWeightCache()
+
+
 class LoraMask:
+    """ Global mask kept for backward compatibility, prefer passing LoraContext """
     lora_mask = None
 
     @staticmethod
@@ -391,6 +1018,7 @@ def dispatch_bgmv_linear(
     wb_t_all: torch.Tensor,
     layer_idx: int,
     scale: float,
+    lora_context: Optional[LoraContext] = None,
 ):
     """
     `wa_t_all` and `wb_t_all` contains all LoRA A and LoRA B weight matrices
@@ -401,16 +1029,13 @@ def dispatch_bgmv_linear(
 
     Matmul input `x` with `wa`. Multiply `x` with a mask to zero-out inputs of
     inactive LoRA indices. Matmul masked output with `wb` and scale it to get
-    the final output.
+    the final output. `wa` and `wb` are cached in LORA_WEIGHT_CACHE.
     """
 
     assert layer_idx == 0, f'layer_idx should be 0, but got {layer_idx}'
-    mask = LoraMask.getLoraMask()
-
-    wa = wa_t_all[:, 0, :, :]
-    wb = wb_t_all[:, 0, :, :].transpose(1, 2)
-    wa = wa.reshape(wa.shape[0] * wa.shape[1], wa.shape[2]).transpose(0, 1)
-    wb = wb.reshape(wb.shape[0] * wb.shape[1], wb.shape[2])
+    mask = lora_context.mask if lora_context is not None else LoraMask.getLoraMask()
+    wa = LORA_WEIGHT_CACHE.get_a(wa_t_all)
+    wb = LORA_WEIGHT_CACHE.get_b(wb_t_all)
 
     out = x @ wa
     assert (out.shape == mask.shape)
@@ -424,11 +1049,13 @@ def dispatch_bgmv_embedding(
     x: torch.Tensor,
     wb_t_all: torch.Tensor,
     layer_idx: int,
+    lora_context: Optional[LoraContext] = None,
 ):
     """
     `wb_t_all` contains all LoRA-B weight matrices stacked at dimension 0 into
     a single tensor, assuming same rank. `wb` is the transposed and reshaped
-    version of `wb_t_all` of shape (num_loras * lora_rank, embedding_dim).
+    version of `wb_t_all` of shape (num_loras * lora_rank, embedding_dim),
+    cached in LORA_WEIGHT_CACHE.
 
     Output of LoRA-A embedding (tensor x) is repeated max_loras times to match
     the shape of `wb`. Multiply `x` with a mask to zero-out inputs of inactive
@@ -439,18 +1066,87 @@ def dispatch_bgmv_embedding(
     assert layer_idx == 0, f'layer_idx should be 0, but got {layer_idx}'
     max_loras = wb_t_all.size(0)
 
+    mask = lora_context.mask if lora_context is not None else LoraMask.getLoraMask()
     x = x.repeat(1, max_loras)
-    x = x * LoraMask.getLoraMask()
-    wb = wb_t_all[:, 0, :, :].transpose(1, 2)
-    wb = wb.reshape(wb.shape[0] * wb.shape[1], wb.shape[2])
-    out = x @ wb
+    x = x * mask
+    out = x @ LORA_WEIGHT_CACHE.get_b(wb_t_all)
     y += out
 
 
-class MoeMatmul(torch.nn.Module):
+def _lora_segments(lora_indices: torch.Tensor):
+    """ Sort tokens by adapter index, returns sorting order and (adapter, start, end) of each active segment """
+    sorted_indices, order = lora_indices.sort()
+    adapters, counts = torch.unique_consecutive(sorted_indices, return_counts=True)
+    ends = counts.cumsum(0)
+    segments = [(a, e - c, e) for a, c, e in zip(adapters.tolist(), counts.tolist(), ends.tolist()) if a >= 0]
+    return order, segments
 
-    def __init__(self):
-        super().__init__()
+
+def dispatch_sgmv_linear(
+    y: torch.Tensor,
+    x: torch.Tensor,
+    wa_t_all: torch.Tensor,
+    wb_t_all: torch.Tensor,
+    lora_indices: torch.Tensor,
+    layer_idx: int,
+    scale: float,
+):
+    """
+    Segmented alternative to `dispatch_bgmv_linear`. Tokens are grouped by
+    their adapter index from `lora_indices` (-1 for tokens without LoRA) and
+    each group is multiplied only by its own LoRA A and B weights, sliced
+    from `wa_t_all`/`wb_t_all` without any copies. Cost depends on the number
+    of active adapters instead of max_loras, at the price of data-dependent
+    shapes, so it's meant for eager execution.
+    """
+
+    assert layer_idx == 0, f'layer_idx should be 0, but got {layer_idx}'
+    order, segments = _lora_segments(lora_indices)
+    x = x.index_select(0, order)
+    out = torch.zeros(x.size(0), y.size(-1), dtype=y.dtype, device=y.device)
+    for adapter, start, end in segments:
+        wa = wa_t_all[adapter, 0].transpose(0, 1)
+        wb = wb_t_all[adapter, 0].transpose(0, 1)
+        out[start:end] = (x[start:end] @ wa) @ wb
+    y.index_add_(0, order, out, alpha=scale)
+
+
+def dispatch_sgmv_embedding(
+    y: torch.Tensor,
+    x: torch.Tensor,
+    wb_t_all: torch.Tensor,
+    lora_indices: torch.Tensor,
+    layer_idx: int,
+):
+    """
+    Segmented alternative to `dispatch_bgmv_embedding`, output of LoRA-A
+    embedding of each token is multiplied only by LoRA B of its own adapter.
+    """
+
+    assert layer_idx == 0, f'layer_idx should be 0, but got {layer_idx}'
+    order, segments = _lora_segments(lora_indices)
+    x = x.index_select(0, order)
+    out = torch.zeros(x.size(0), y.size(-1), dtype=y.dtype, device=y.device)
+    for adapter, start, end in segments:
+        out[start:end] = x[start:end] @ wb_t_all[adapter, 0].transpose(0, 1)
+    y.index_add_(0, order, out)
+
+
+class WeightUpdateNotifier:
+    """
+    Mixin calling `on_weight_update` whenever one of WEIGHT_ATTRS is assigned,
+    either through a setter or directly, e.g. to drop stacked weights of the owning op
+    """
+    WEIGHT_ATTRS: Tuple[str, ...] = ('weight',)
+    on_weight_update = None
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in self.WEIGHT_ATTRS and self.on_weight_update is not None:
+            self.on_weight_update()
+
+
+class MoeMatmul(WeightUpdateNotifier, torch.nn.Module):
 
     def set_weight(self, w):
         self.weight = w
@@ -459,39 +1155,234 @@ class MoeMatmul(torch.nn.Module):
         raise NotImplementedError()
 
 
-class VllmMixtureOfExpertsOp(torch.nn.Module):
+class ExpertModuleList(torch.nn.ModuleList):
+    """ ModuleList of per-expert matmuls calling `on_module_update` when an expert is replaced, e.g. patched by INC """
+    on_module_update = None
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if isinstance(value, torch.nn.Module) and self.on_module_update is not None:
+            self.on_module_update()
+
+
+class StackedExpertWeights:
+    """
+    Mixin keeping expert weights as stacked [num_experts, ...] tensors. Per-expert
+    views passed to torch.ops.hpu.mixture_of_experts are built once in
+    `set_stacked_weights` instead of walking w13_list/w2_list in every forward.
+    Per-expert modules keep referencing the same storage, e.g. for INC. In-place
+    updates are therefore visible in both, while assigning a new weight or scale
+    to any expert or replacing an expert module drops the stacked weights.
+    """
+    stacked_weights = None
+
+    def set_stacked_weights(self, w13_weight, w2_weight, w13_scale=None, w2_scale=None):
+        for index in range(self.num_experts):
+            self.w13_list[index].set_weight(w13_weight[index])
+            self.w2_list[index].set_weight(w2_weight[index])
+            if w13_scale is not None:
+                self.w13_list[index].set_scale_inv_fp8(w13_scale[index])
+            if w2_scale is not None:
+                self.w2_list[index].set_scale_inv_fp8(w2_scale[index])
+        self.stacked_weights = (w13_weight, w2_weight, w13_scale, w2_scale)
+        self.w13_views = [w.squeeze() for w in w13_weight.unbind(0)]
+        self.w2_views = [w.squeeze() for w in w2_weight.unbind(0)]
+        self.w13_scale_views = [s.squeeze() for s in w13_scale.unbind(0)] if w13_scale is not None else None
+        self.w2_scale_views = [s.squeeze() for s in w2_scale.unbind(0)] if w2_scale is not None else None
+        for module in [*self.w13_list, *self.w2_list]:
+            module.on_weight_update = self.invalidate_stacked_weights
+        self.w13_list.on_module_update = self.invalidate_stacked_weights
+        self.w2_list.on_module_update = self.invalidate_stacked_weights
+
+    def invalidate_stacked_weights(self):
+        """ Fall back to per-expert weights, e.g. after an expert got new weights """
+        self.stacked_weights = None
+
+    def get_expert_weights(self):
+        """ Return per-expert w13 and w2 weights """
+        if self.stacked_weights is not None:
+            return self.w13_views, self.w2_views
+        experts_range = range(self.num_experts)
+        w13_list = [self.w13_list[i].weight.squeeze() for i in experts_range]
+        w2_list = [self.w2_list[i].weight.squeeze() for i in experts_range]
+        return w13_list, w2_list
+
+    def get_expert_scales(self):
+        """ Return per-expert w13 and w2 weight scales """
+        if self.stacked_weights is not None and self.w13_scale_views is not None:
+            return self.w13_scale_views, self.w2_scale_views
+        experts_range = range(self.num_experts)
+        w13_scales = [self.w13_list[i].scale_inv_fp8.squeeze() for i in experts_range]
+        w2_scales = [self.w2_list[i].scale_inv_fp8.squeeze() for i in experts_range]
+        return w13_scales, w2_scales
+
+
+MOE_ACTIVATIONS = {
+    'silu': F.silu,
+    'gelu': F.gelu,
+    'relu': F.relu,
+}
+
+
+def reference_mixture_of_experts(hidden_states, expert_routing_table, router_weights, w12, w3,
+                                 permuted_weights=True, activation="silu", experts_min=0, experts_max=None):
+    """
+    Pure torch counterpart of torch.ops.hpu.mixture_of_experts. Token-expert pairs
+    are sorted by expert so that each expert processes its contiguous segment of
+    tokens with a single pair of matmuls, experts without tokens are skipped and
+    the weighted results are scattered back to their tokens at once.
+    Pairs routed outside of [experts_min, experts_min + len(w12)) are ignored.
+    """
+    num_tokens, topk = expert_routing_table.shape
+    expert_ids = expert_routing_table.flatten().long() - experts_min
+    token_ids = torch.arange(num_tokens, device=hidden_states.device).repeat_interleave(topk)
+    weights = router_weights.flatten()
+    local = (expert_ids >= 0) & (expert_ids < len(w12))
+    expert_ids, token_ids, weights = expert_ids[local], token_ids[local], weights[local]
+
+    order = expert_ids.argsort(stable=True)
+    token_ids, weights = token_ids[order], weights[order]
+    counts = torch.bincount(expert_ids, minlength=len(w12)).tolist()
+    offsets = [0, *itertools.accumulate(counts)]
+
+    act_fn = MOE_ACTIVATIONS[activation]
+    sorted_states = hidden_states[token_ids]
+    sorted_out = torch.empty_like(sorted_states)
+    for expert, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+        if start == end:
+            continue
+        w_up, w_down = (w12[expert].t(), w3[expert].t()) if permuted_weights else (w12[expert], w3[expert])
+        gate, up = torch.matmul(sorted_states[start:end], w_up).chunk(2, dim=-1)
+        sorted_out[start:end] = torch.matmul(act_fn(gate) * up, w_down)
+
+    out = torch.zeros(hidden_states.shape, dtype=torch.float32, device=hidden_states.device)
+    out.index_add_(0, token_ids, sorted_out.float() * weights.float().unsqueeze(-1))
+    return out.to(hidden_states.dtype)
+
+
+def mixture_of_experts(**kwargs):
+    """ Run torch.ops.hpu.mixture_of_experts on HPU and the pure torch reference elsewhere """
+    if kwargs['hidden_states'].device.type == 'hpu':
+        return torch.ops.hpu.mixture_of_experts(**kwargs)
+    return reference_mixture_of_experts(**kwargs)
+
+
+_SHARED_EXPERTS_STREAM = None
+
+
+def _shared_experts_stream(device: torch.device):
+    """ Side stream for shared experts or None if they run on the current stream """
+    global _SHARED_EXPERTS_STREAM
+    if device.type != 'hpu' or not get_config().moe_shared_experts_stream:
+        return None
+    if _SHARED_EXPERTS_STREAM is None:
+        _SHARED_EXPERTS_STREAM = torch.hpu.Stream()
+    return _SHARED_EXPERTS_STREAM
+
+
+def _launch_shared_experts(shared_experts, hidden_states):
+    """
+    Issue shared experts before routed ones. With moe_shared_experts_stream they run
+    on a side stream and overlap with routed experts, _add_shared_output joins them.
+    """
+    if shared_experts is None:
+        return None
+    stream = _shared_experts_stream(hidden_states.device)
+    if stream is None:
+        return shared_experts(hidden_states)
+    stream.wait_stream(torch.hpu.current_stream())
+    with torch.hpu.stream(stream):
+        return shared_experts(hidden_states)
+
+
+def _add_shared_output(routed_output, shared_output):
+    """ Sum outputs of routed and shared experts """
+    if shared_output is None:
+        return routed_output
+    stream = _shared_experts_stream(routed_output.device)
+    if stream is not None:
+        torch.hpu.current_stream().wait_stream(stream)
+    return routed_output + shared_output
+
+
+def partition_experts(expert_load: List[int], max_experts_per_slice: int) -> List[Tuple[int, int]]:
+    """
+    Cover experts with routed tokens with the minimal number of contiguous [start, end)
+    slices of at most max_experts_per_slice experts. Each slice starts at the first not yet
+    covered expert with routed tokens and ends after the last one fitting into it, so
+    experts without tokens at slice edges and slices without any tokens are skipped.
+    """
+    routed = [expert for expert, load in enumerate(expert_load) if load > 0]
+    slices = []
+    for expert in routed:
+        if slices and expert < slices[-1][0] + max_experts_per_slice:
+            slices[-1] = (slices[-1][0], expert + 1)
+        else:
+            slices.append((expert, expert + 1))
+    return slices
+
+
+class ExpertSlicing:
+    """
+    Mixin splitting experts into slices processed by separate mixture_of_experts calls.
+    By default experts are split into moe_n_slice equal groups of at most
+    max_experts_per_slice experts. With moe_adaptive_slicing slices are chosen in
+    every forward to cover only experts with routed tokens, which costs a host sync.
+    """
+
+    def init_slicing(self):
+        max_expert_per_slice = get_config().max_experts_per_slice
+        if max_expert_per_slice <= 0:
+            max_expert_per_slice = self.num_experts
+        self.max_expert_per_slice = max_expert_per_slice
+        self.moe_n_slice = 1 if self.num_experts <= max_expert_per_slice \
+                else self.num_experts // max_expert_per_slice
+        self.num_expert_per_group = self.num_experts // self.moe_n_slice
+
+    def get_expert_slices(self, expert_routing_table) -> Optional[List[Tuple[int, int]]]:
+        """ Return [start, end) expert slices for the current routing or None if slicing isn't needed """
+        if get_config().moe_adaptive_slicing:
+            if self.num_experts <= self.max_expert_per_slice:
+                return None
+            local_ids = expert_routing_table.flatten() - self.experts_min
+            local_ids = local_ids[(local_ids >= 0) & (local_ids < self.num_experts)]
+            expert_load = torch.bincount(local_ids, minlength=self.num_experts).tolist()
+            return partition_experts(expert_load, self.max_expert_per_slice)
+        if self.moe_n_slice == 1:
+            return None
+        return [(i * self.num_expert_per_group, (i + 1) * self.num_expert_per_group)
+                for i in range(self.moe_n_slice)]
+
+
+class VllmMixtureOfExpertsOp(StackedExpertWeights, ExpertSlicing, torch.nn.Module):
 
     def __init__(self, num_total_experts, experts_min: int = 0, experts_max: int = 8):
         super().__init__()
-        self.w13_list = torch.nn.ModuleList(
+        self.w13_list = ExpertModuleList(
             [MoeMatmul() for _ in range(num_total_experts)])
-        self.w2_list = torch.nn.ModuleList(
+        self.w2_list = ExpertModuleList(
             [MoeMatmul() for _ in range(num_total_experts)])
         self.num_experts = num_total_experts
         self.experts_min = experts_min
         self.experts_max = experts_max
-
-        if MAX_EXPERTS_PER_SLICE > 0:
-            max_expert_per_slice = MAX_EXPERTS_PER_SLICE
-        else:
-            max_expert_per_slice = self.num_experts
-        self.moe_n_slice = 1 if self.num_experts <= max_expert_per_slice \
-                else self.num_experts // max_expert_per_slice
-        self.num_expert_per_group = self.num_experts // self.moe_n_slice
+        self.init_slicing()
 
     def forward(self,
                 hidden_states,
                 expert_routing_table,
                 router_weights,
                 permuted_weights=True,
-                activation="silu"):
+                activation="silu",
+                shared_experts=None):
+        if (stats := get_expert_load_stats()) is not None:
+            stats.record(self, expert_routing_table, self.num_experts, self.experts_min)
         # pre-processing for custom op inputs
-        experts_range = range(self.num_experts)
-        w1_list = [self.w13_list[i].weight.squeeze() for i in experts_range]
-        w2_list = [self.w2_list[i].weight.squeeze() for i in experts_range]
+        w1_list, w2_list = self.get_expert_weights()
+        shared_output = _launch_shared_experts(shared_experts, hidden_states)
 
-        if self.moe_n_slice == 1:
-            return torch.ops.hpu.mixture_of_experts(
+        slices = self.get_expert_slices(expert_routing_table)
+        if slices is None:
+            return _add_shared_output(mixture_of_experts(
                 hidden_states=hidden_states,
                 expert_routing_table=expert_routing_table,
                 router_weights=router_weights,
@@ -500,43 +1391,137 @@ class VllmMixtureOfExpertsOp(torch.nn.Module):
                 permuted_weights=permuted_weights,
                 activation=activation,
                 experts_min=self.experts_min,
-                experts_max=self.experts_max)
-        for i in range(self.moe_n_slice):
-            w1_list_slice = w1_list[i * self.num_expert_per_group:(i + 1) * self.num_expert_per_group]
-            w2_list_slice = w2_list[i * self.num_expert_per_group:(i + 1) * self.num_expert_per_group]
-            min_expert = self.experts_min + i * self.num_expert_per_group
-            max_expert = min_expert + self.num_expert_per_group - 1
-            slice_final_hidden_states = torch.ops.hpu.mixture_of_experts(
+                experts_max=self.experts_max), shared_output)
+        final_hidden_states = None
+        for start, end in slices:
+            slice_final_hidden_states = mixture_of_experts(
                 hidden_states=hidden_states,
                 expert_routing_table=expert_routing_table,
                 router_weights=router_weights,
-                w12=w1_list_slice,
-                w3=w2_list_slice,
+                w12=w1_list[start:end],
+                w3=w2_list[start:end],
                 permuted_weights=permuted_weights,
                 activation=activation,
-                experts_min=min_expert,
-                experts_max=max_expert)
-            if i == 0:
+                experts_min=self.experts_min + start,
+                experts_max=self.experts_min + end - 1)
+            if final_hidden_states is None:
                 final_hidden_states = slice_final_hidden_states
             else:
                 final_hidden_states += slice_final_hidden_states
             htorch.core.mark_step()
-        return final_hidden_states
+        if final_hidden_states is None:
+            # None of the tokens was routed to local experts
+            final_hidden_states = torch.zeros_like(hidden_states)
+        return _add_shared_output(final_hidden_states, shared_output)
+
+
+def moe_routing(router_logits: torch.Tensor,
+                top_k: int,
+                scoring_func: str = "softmax",
+                renormalize: bool = True,
+                num_expert_group: Optional[int] = None,
+                topk_group: Optional[int] = None,
+                e_score_correction_bias: Optional[torch.Tensor] = None,
+                routed_scaling_factor: float = 1.0) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Select top_k experts per token and return their fp32 weights and ids.
+    Scores are computed with softmax or sigmoid in fp32. With num_expert_group
+    experts are split into groups and only topk_group best groups are considered
+    (DeepSeek-V3 style). e_score_correction_bias only affects which experts are
+    selected, weights come from the uncorrected scores.
+    """
+    scores = router_logits.float()
+    scores = scores.softmax(dim=-1) if scoring_func == "softmax" else scores.sigmoid()
+    selection_scores = scores if e_score_correction_bias is None else scores + e_score_correction_bias.float()
+    if num_expert_group is not None and num_expert_group > 1:
+        grouped = selection_scores.unflatten(-1, (num_expert_group, -1))
+        if e_score_correction_bias is None:
+            group_scores = grouped.amax(dim=-1)
+        else:
+            group_scores = grouped.topk(2, dim=-1).values.sum(dim=-1)
+        group_idx = group_scores.topk(topk_group, dim=-1).indices
+        group_mask = torch.zeros_like(group_scores, dtype=torch.bool).scatter_(-1, group_idx, True)
+        selection_scores = grouped.masked_fill(~group_mask.unsqueeze(-1), float('-inf')).flatten(-2)
+    if selection_scores is scores:
+        topk_weights, topk_ids = scores.topk(top_k, dim=-1)
+    else:
+        topk_ids = selection_scores.topk(top_k, dim=-1).indices
+        topk_weights = scores.gather(-1, topk_ids)
+    if renormalize:
+        topk_weights = topk_weights / topk_weights.sum(dim=-1, keepdim=True)
+    if routed_scaling_factor != 1.0:
+        topk_weights = topk_weights * routed_scaling_factor
+    return topk_weights, topk_ids
+
+
+def apply_expert_capacity(topk_weights: torch.Tensor,
+                          topk_ids: torch.Tensor,
+                          num_experts: int,
+                          capacity_factor: float,
+                          policy: str = "drop",
+                          router_scores: Optional[torch.Tensor] = None):
+    """
+    Limit number of tokens routed to each expert to capacity_factor * average load.
+    Earlier choices of all tokens take precedence over later ones, overflowing
+    assignments are either dropped (id -1 and weight 0, ignored by MoE ops) or with
+    policy == "reroute" moved to the best scored expert not chosen by the token that
+    still has capacity left, keeping their weight. Returns new weights and ids and
+    numbers of dropped and rerouted assignments as device tensors.
+    """
+    num_tokens, top_k = topk_ids.shape
+    capacity = math.ceil(capacity_factor * num_tokens * top_k / num_experts)
+    ids = topk_ids.t().reshape(-1).long()
+    valid = (ids >= 0) & (ids < num_experts)
+    onehot = F.one_hot(ids.clamp(0, num_experts - 1), num_experts).to(torch.int32) * valid.unsqueeze(-1)
+    position = (onehot.cumsum(0) * onehot).sum(-1) - 1
+    overflow = position >= capacity
+    num_rerouted = torch.zeros((), dtype=torch.int64, device=ids.device)
+    if policy == "reroute":
+        load = onehot.sum(0).clamp(max=capacity)
+        chosen = torch.zeros(num_tokens, num_experts, dtype=torch.bool, device=ids.device)
+        chosen.scatter_(1, topk_ids.long().clamp(0, num_experts - 1), valid.view(top_k, num_tokens).t())
+        scores = router_scores.float().masked_fill(chosen | (load >= capacity), float('-inf'))
+        scores = scores.repeat(top_k, 1)
+        alt_ids = scores.argmax(-1)
+        alt_ok = overflow & scores.gather(-1, alt_ids.unsqueeze(-1)).squeeze(-1).isfinite()
+        alt_onehot = F.one_hot(alt_ids, num_experts).to(torch.int32) * alt_ok.unsqueeze(-1)
+        alt_position = load[alt_ids] + (alt_onehot.cumsum(0) * alt_onehot).sum(-1) - 1
+        rerouted = alt_ok & (alt_position < capacity)
+        ids = torch.where(rerouted, alt_ids, ids)
+        overflow = overflow & ~rerouted
+        num_rerouted = rerouted.sum()
+    else:
+        assert policy == "drop", f'Unsupported capacity policy: {policy}'
+    overflow = overflow.view(top_k, num_tokens).t()
+    topk_ids = ids.view(top_k, num_tokens).t().masked_fill(overflow, -1).to(topk_ids.dtype)
+    topk_weights = topk_weights.masked_fill(overflow, 0)
+    return topk_weights, topk_ids, overflow.sum(), num_rerouted
 
 
 class DynamicFusedMOE(torch.nn.Module):
 
-    def __init__(self, num_total_experts):
+    def __init__(self, num_total_experts, scoring_func="softmax", num_expert_group=None,
+                 topk_group=None, e_score_correction_bias=None):
         super().__init__()
         self.MoeOp = VllmMixtureOfExpertsOp(num_total_experts)
-
-    def forward(self, hidden_states, score, topk):
-        htorch.core.mark_step()
-        routing_weights = F.softmax(score, dim=1, dtype=torch.float32)
-        routing_weights, selected_experts = torch.topk(routing_weights,
-                                                       topk,
-                                                       dim=-1)
-        routing_weights /= routing_weights.sum(dim=-1, keepdim=True)
+        self.scoring_func = scoring_func
+        self.num_expert_group = num_expert_group
+        self.topk_group = topk_group
+        self.e_score_correction_bias = e_score_correction_bias
+
+    def forward(self, hidden_states, score, topk, shared_experts=None):
+        routing_weights, selected_experts = moe_routing(score,
+                                                        topk,
+                                                        scoring_func=self.scoring_func,
+                                                        num_expert_group=self.num_expert_group,
+                                                        topk_group=self.topk_group,
+                                                        e_score_correction_bias=self.e_score_correction_bias)
+        if capacity_factor := get_config().moe_capacity_factor:
+            routing_weights, selected_experts, num_dropped, num_rerouted = apply_expert_capacity(
+                routing_weights, selected_experts, self.MoeOp.num_experts, capacity_factor,
+                get_config().moe_capacity_policy, score)
+            if (stats := get_expert_load_stats()) is not None:
+                stats.record_overflow(self.MoeOp, num_dropped, num_rerouted)
         routing_weights = routing_weights.to(hidden_states.dtype)
 
         final_hidden_states = self.MoeOp(
@@ -545,6 +1530,7 @@ class DynamicFusedMOE(torch.nn.Module):
             router_weights=routing_weights,
             permuted_weights=True,
             activation="silu",
+            shared_experts=shared_experts,
         )
 
         return final_hidden_states.view(-1, hidden_states.shape[1])
@@ -775,19 +1761,12 @@ def fp8_block_moe_prepare_weights(layer, force_channel_fp8=False):
                                                 requires_grad=False)
         return fp8_channel_moe_prepare_weights(layer)
 
+    layer.moe_op.set_stacked_weights(layer.w13_weight, layer.w2_weight,
+                                     layer.w13_weight_scale_inv, layer.w2_weight_scale_inv)
     for index in range(layer.moe_op.num_experts):
-        layer.moe_op.w13_list[index].set_weight(layer.w13_weight[index])
-        layer.moe_op.w13_list[index].set_scale_inv_fp8(
-            layer.w13_weight_scale_inv[index]
-        )
         layer.moe_op.w13_list[index].set_weight_block_size(
             layer.quant_config.weight_block_size
         )
-
-        layer.moe_op.w2_list[index].set_weight(layer.w2_weight[index])
-        layer.moe_op.w2_list[index].set_scale_inv_fp8(
-            layer.w2_weight_scale_inv[index]
-        )
         layer.moe_op.w2_list[index].set_weight_block_size(
             layer.quant_config.weight_block_size
         )
@@ -795,32 +1774,19 @@ def fp8_block_moe_prepare_weights(layer, force_channel_fp8=False):
     return layer
 
 
-def fp8_channel_moe_prepare_weights(layer):
-    for index in range(layer.moe_op.num_experts):
-        layer.moe_op.w13_list[index].set_weight(layer.w13_weight[index])
-        if hasattr(layer, "w13_weight_scale_inv"):
-            layer.moe_op.w13_list[index].set_scale_inv_fp8(
-                layer.w13_weight_scale_inv[index]
-            )
-        elif hasattr(layer, "w13_weight_scale"):
-            weight_scale_inv = layer.w13_weight_scale[index]
-            layer.moe_op.w13_list[index].set_scale_inv_fp8(weight_scale_inv)
-        else:
-            weight_scale_inv = torch.ones(layer.w13_weight[index].shape[:-1], dtype=torch.bfloat16, device=layer.w13_weight[index].device)
-            layer.moe_op.w13_list[index].set_scale_inv_fp8(weight_scale_inv)
+def _stacked_channel_scale(layer, prefix):
+    if hasattr(layer, f"{prefix}_weight_scale_inv"):
+        return getattr(layer, f"{prefix}_weight_scale_inv")
+    if hasattr(layer, f"{prefix}_weight_scale"):
+        return getattr(layer, f"{prefix}_weight_scale")
+    weight = getattr(layer, f"{prefix}_weight")
+    return torch.ones(weight.shape[:-1], dtype=torch.bfloat16, device=weight.device)
 
-        layer.moe_op.w2_list[index].set_weight(layer.w2_weight[index])
-        if hasattr(layer, "w2_weight_scale_inv"):
-            layer.moe_op.w2_list[index].set_scale_inv_fp8(
-                layer.w2_weight_scale_inv[index]
-            )
-        elif hasattr(layer, "w2_weight_scale"):
-            weight_scale_inv = layer.w2_weight_scale[index]
-            layer.moe_op.w2_list[index].set_scale_inv_fp8(weight_scale_inv)
-        else:
-            weight_scale_inv = torch.ones(layer.w2_weight[index].shape[:-1], dtype=torch.bfloat16, device=layer.w2_weight[index].device)
-            layer.moe_op.w2_list[index].set_scale_inv_fp8(weight_scale_inv)
-            
+
+def fp8_channel_moe_prepare_weights(layer):
+    layer.moe_op.set_stacked_weights(layer.w13_weight, layer.w2_weight,
+                                     _stacked_channel_scale(layer, "w13"),
+                                     _stacked_channel_scale(layer, "w2"))
     if hasattr(layer, "w13_input_scale"):
         layer.moe_op.w13_input_scale = layer.w13_input_scale
     if hasattr(layer, "w2_input_scale"):
@@ -829,7 +1795,9 @@ def fp8_channel_moe_prepare_weights(layer):
     htorch.core.mark_step()
     return layer
 
-class MoeFP8Matmul(torch.nn.Module):
+class MoeFP8Matmul(WeightUpdateNotifier, torch.nn.Module):
+    WEIGHT_ATTRS = ('weight', 'scale_inv_fp8')
+
     def __init__(
         self,
         block_size: Tuple[int, int] = (128, 128),
@@ -852,6 +1820,12 @@ class MoeFP8Matmul(torch.nn.Module):
     def set_weight_block_size(self, block_size: Tuple[int, int] = (128, 128)):
         self.block_size = block_size
 
+    def get_dequant_version(self):
+        """ Identify inputs of get_dequant_weight, changes when they're replaced or modified in-place """
+        return (self.weight.data_ptr(), self.weight._version,
+                self.scale_inv_fp8.data_ptr(), self.scale_inv_fp8._version,
+                self.block_size, self.high_precision)
+
     def get_dequant_weight(self):
         return dequant_block_fp8_weight_naive(
             self.weight,
@@ -882,28 +1856,77 @@ class MoeFP8Matmul(torch.nn.Module):
         return self.dequant_block_fp8_weight
 
 
-class VllmMixtureOfExpertsOpFP8(torch.nn.Module):
+class VllmMixtureOfExpertsOpFP8(StackedExpertWeights, ExpertSlicing, torch.nn.Module):
+    # Number of forwards between re-selecting hot experts pinned in the dequant cache
+    HOT_EXPERTS_UPDATE_INTERVAL = 128
+
     def __init__(
         self, num_experts: int, experts_min: int = 0, experts_max: int = 8
     ):
         super().__init__()
-        self.w13_list = torch.nn.ModuleList(
+        self.expert_counts = None
+        self.num_forwards = 0
+        self.w13_list = ExpertModuleList(
             [MoeFP8Matmul() for _ in range(num_experts)]
         )
-        self.w2_list = torch.nn.ModuleList(
+        self.w2_list = ExpertModuleList(
             [MoeFP8Matmul() for _ in range(num_experts)]
         )
-        max_expert_per_slice = 32
         self.num_experts = num_experts
         self.experts_min = experts_min
         self.experts_max = experts_max
-        if MAX_EXPERTS_PER_SLICE > 0:
-            max_expert_per_slice = MAX_EXPERTS_PER_SLICE
-        else:
-            max_expert_per_slice = self.num_experts
-        self.moe_n_slice = 1 if self.num_experts <= max_expert_per_slice \
-                else self.num_experts // max_expert_per_slice
-        self.num_expert_per_group = self.num_experts // self.moe_n_slice
+        self.init_slicing()
+
+    def get_dequant_expert_weights(self):
+        """ Return per-expert dequantized w13 and w2 weights """
+        cache = get_expert_dequant_cache()
+        if cache is not None:
+            if self.stacked_weights is not None:
+                # Expert weights are views of the stacked tensors, one version covers all of them
+                version = self.get_stacked_dequant_version()
+                w13_list = [cache.get(m, m.get_dequant_weight, version) for m in self.w13_list]
+                w2_list = [cache.get(m, m.get_dequant_weight, version) for m in self.w2_list]
+                return w13_list, w2_list
+            w13_list = [cache.get(m, m.get_dequant_weight, m.get_dequant_version()) for m in self.w13_list]
+            w2_list = [cache.get(m, m.get_dequant_weight, m.get_dequant_version()) for m in self.w2_list]
+            return w13_list, w2_list
+        if self.stacked_weights is not None:
+            # Dequantize all experts at once instead of one small op per expert
+            w13_weight, w2_weight, w13_scale, w2_scale = self.stacked_weights
+            block_size, dtype = self.w13_list[0].block_size, self.w13_list[0].high_precision
+            w13_list = list(dequant_block_fp8_weight_naive(w13_weight, w13_scale, block_size, dtype).unbind(0))
+            w2_list = list(dequant_block_fp8_weight_naive(w2_weight, w2_scale, block_size, dtype).unbind(0))
+            return w13_list, w2_list
+        w13_list = [self.w13_list[j].get_dequant_weight() for j in range(self.num_experts)]
+        w2_list = [self.w2_list[j].get_dequant_weight() for j in range(self.num_experts)]
+        return w13_list, w2_list
+
+    def get_stacked_dequant_version(self):
+        """
+        Identify inputs of dequantized stacked weights. Views share the version counter
+        of their base tensor, so an in-place update of any expert changes it as well,
+        while replacing weights of an expert drops the stacked weights altogether.
+        """
+        tensors = [t for t in self.stacked_weights if t is not None]
+        return (tuple((t.data_ptr(), t._version) for t in tensors),
+                self.w13_list[0].block_size, self.w13_list[0].high_precision,
+                self.w2_list[0].block_size, self.w2_list[0].high_precision)
+
+    def update_hot_experts(self, topk_ids):
+        """ Count routed tokens per expert and periodically pin the most used ones in the dequant cache """
+        num_pinned = get_config().moe_dequant_cache_pinned
+        if not num_pinned:
+            return
+        # Experts outside of [experts_min, experts_min + num_experts) are counted in an extra bin
+        local_ids = topk_ids.flatten() - self.experts_min
+        local_ids = torch.where((local_ids >= 0) & (local_ids < self.num_experts), local_ids, self.num_experts)
+        counts = torch.bincount(local_ids, minlength=self.num_experts + 1)[:self.num_experts]
+        self.expert_counts = counts if self.expert_counts is None else self.expert_counts + counts
+        self.num_forwards += 1
+        if self.num_forwards % self.HOT_EXPERTS_UPDATE_INTERVAL == 1:
+            hot = self.expert_counts.topk(min(num_pinned, self.num_experts)).indices.tolist()
+            keys = [self.w13_list[i] for i in hot] + [self.w2_list[i] for i in hot]
+            get_expert_dequant_cache().pin(self, keys)
 
     def forward(
         self,
@@ -912,16 +1935,19 @@ class VllmMixtureOfExpertsOpFP8(torch.nn.Module):
         topk_weights,
         permuted_weights=True,
         activation="silu",
+        shared_experts=None,
     ):
-        w13_list = []
-        w2_list = []
-        for j in range(self.num_experts):
-            w13_list.append(self.w13_list[j].get_dequant_weight())
-            w2_list.append(self.w2_list[j].get_dequant_weight())
+        if (stats := get_expert_load_stats()) is not None:
+            stats.record(self, topk_ids, self.num_experts, self.experts_min)
+        if get_expert_dequant_cache() is not None:
+            self.update_hot_experts(topk_ids)
+        w13_list, w2_list = self.get_dequant_expert_weights()
         htorch.core.mark_step()
+        shared_output = _launch_shared_experts(shared_experts, x)
 
-        if self.moe_n_slice == 1:
-            return torch.ops.hpu.mixture_of_experts(
+        slices = self.get_expert_slices(topk_ids)
+        if slices is None:
+            return _add_shared_output(mixture_of_experts(
                 hidden_states=x,
                 expert_routing_table=topk_ids,
                 router_weights=topk_weights,
@@ -930,49 +1956,80 @@ class VllmMixtureOfExpertsOpFP8(torch.nn.Module):
                 permuted_weights=permuted_weights,
                 activation=activation,
                 experts_min=self.experts_min,
-                experts_max=self.experts_max)
-        for i in range(self.moe_n_slice):
-            w13_list_slice = w13_list[i * self.num_expert_per_group:(i + 1) * self.num_expert_per_group]
-            w2_list_slice = w2_list[i * self.num_expert_per_group:(i + 1) * self.num_expert_per_group]
-            min_expert = self.experts_min + i * self.num_expert_per_group
-            max_expert = min_expert + self.num_expert_per_group - 1
-            slice_final_hidden_states = torch.ops.hpu.mixture_of_experts(
+                experts_max=self.experts_max), shared_output)
+        final_hidden_states = None
+        for start, end in slices:
+            slice_final_hidden_states = mixture_of_experts(
                 hidden_states=x,
                 expert_routing_table=topk_ids,
                 router_weights=topk_weights,
-                w12=w13_list_slice,
-                w3=w2_list_slice,
+                w12=w13_list[start:end],
+                w3=w2_list[start:end],
                 permuted_weights=permuted_weights,
                 activation=activation,
-                experts_min=min_expert,
-                experts_max=max_expert,
+                experts_min=self.experts_min + start,
+                experts_max=self.experts_min + end - 1,
             )
             htorch.core.mark_step()
-            if i == 0:
+            if final_hidden_states is None:
                 final_hidden_states = slice_final_hidden_states
             else:
                 final_hidden_states += slice_final_hidden_states
-        return final_hidden_states
+        if final_hidden_states is None:
+            # None of the tokens was routed to local experts
+            final_hidden_states = torch.zeros_like(x)
+        return _add_shared_output(final_hidden_states, shared_output)
 
 
-class VllmMixtureOfExpertsOpFP8PerChannel(torch.nn.Module):
+class VllmMixtureOfExpertsOpFP8PerChannel(StackedExpertWeights, torch.nn.Module):
     def __init__(
         self, num_experts: int, experts_min: int = 0, experts_max: int = 8
     ):
         super().__init__()
-        self.w13_list = torch.nn.ModuleList(
+        self.w13_list = ExpertModuleList(
             [MoeFP8Matmul() for _ in range(num_experts)]
         )
-        self.w2_list = torch.nn.ModuleList(
+        self.w2_list = ExpertModuleList(
             [MoeFP8Matmul() for _ in range(num_experts)]
         )
         self.w13_input_scale = None
         self.w2_input_scale = None
+        # Running max of dynamic input scales is a buffer updated in place, so that
+        # calibration forwards don't change module attributes
+        self.register_buffer('input_scale_max', torch.zeros(()), persistent=False)
+        self.calibrating = False
+        self.static_input_scale = None
 
         self.num_experts = num_experts
         self.experts_min = experts_min
         self.experts_max = experts_max
 
+    @contextmanager
+    def calibrate_input_scale(self):
+        """
+        Track max of dynamic per-token input scales for the duration of the context
+        and use it as static per-tensor input scale afterwards. Calibration has to
+        finish before HPU graphs are captured.
+        """
+        self.static_input_scale = None
+        self.input_scale_max.zero_()
+        self.calibrating = True
+        try:
+            yield self
+        finally:
+            self.calibrating = False
+            self.finalize_input_scale()
+
+    @torch.no_grad()
+    def update_input_scale(self, x_scale):
+        """ Fold dynamic per-token input scales into the running max """
+        torch.maximum(self.input_scale_max, x_scale.max(), out=self.input_scale_max)
+
+    def finalize_input_scale(self):
+        """ Use the calibrated scale widened by moe_input_scale_margin instead of dynamic quantization """
+        if self.input_scale_max.item() > 0:
+            self.static_input_scale = self.input_scale_max * get_config().moe_input_scale_margin
+
     def forward(
         self,
         x,
@@ -980,15 +2037,22 @@ class VllmMixtureOfExpertsOpFP8PerChannel(torch.nn.Module):
         topk_weights,
         permuted_weights=True,
         activation="silu",
+        shared_experts=None,
     ):
-        experts_range = range(self.num_experts)
-        w13_list = [self.w13_list[i].weight.squeeze() for i in experts_range]
-        w2_list = [self.w2_list[i].weight.squeeze() for i in experts_range]
-        w13_weight_scale = [self.w13_list[i].scale_inv_fp8.squeeze() for i in experts_range]
-        w2_weight_scale = [self.w2_list[i].scale_inv_fp8.squeeze() for i in experts_range]
+        if (stats := get_expert_load_stats()) is not None:
+            stats.record(self, topk_ids, self.num_experts, self.experts_min)
+        w13_list, w2_list = self.get_expert_weights()
+        w13_weight_scale, w2_weight_scale = self.get_expert_scales()
+        shared_output = _launch_shared_experts(shared_experts, x)
        
         if self.w13_input_scale is None:
-            x_fp8, x_scale = dynamic_quant(x)
+            if self.static_input_scale is not None:
+                x_scale = self.static_input_scale
+                x_fp8 = torch.ops.hpu.cast_to_fp8_v2(x, 1.0/x_scale, False, False, torch.float8_e4m3fn)[0]
+            else:
+                x_fp8, x_scale = dynamic_quant(x)
+                if self.calibrating:
+                    self.update_input_scale(x_scale)
             final_hidden_states = torch.ops.hpu.mixture_of_experts(
                                     hidden_states=x_fp8,
                                     expert_routing_table=topk_ids.to(torch.int64),
@@ -1021,8 +2085,7 @@ class VllmMixtureOfExpertsOpFP8PerChannel(torch.nn.Module):
                                     experts_min=self.experts_min,
                                     experts_max=self.experts_max)
 
-        
-        return final_hidden_states
+        return _add_shared_output(final_hidden_states, shared_output)
 
 
 # fp8
@@ -0,0 +1,627 @@
+###############################################################################
+# Copyright (C) 2025 Habana Labs, Ltd. an Intel Company
+#
+# This source code is licensed under the Apache 2.0 license found in the
+# LICENSE file in the root directory of this source tree.
+###############################################################################
+
+import math
+
+import pytest
+import torch
+
+import vllm_hpu_extension.runtime as runtime
+import vllm_hpu_extension.ops as ops
+from vllm_hpu_extension.autotuner import PromptAttnAutotuner
+from vllm_hpu_extension.config import Config
+from vllm_hpu_extension.utils import VLLMKVCache, kv_cache_shape, kv_cache_summary_shape
+
+
+BLOCK_SIZE = 4
+HEAD_SIZE = 8
+
+
+@pytest.fixture(autouse=True)
+def cpu_config():
+    prev = runtime.RUNTIME_CONFIG
+    runtime.RUNTIME_CONFIG = Config(fp32_softmax=False,
+                                    fused_block_softmax=False,
+                                    fused_block_softmax_adjustment=False,
+                                    prompt_attn_split_context=False,
+                                    prompt_attn_autotune=False,
+                                    use_contiguous_pa=False,
+                                    kv_cache_layout='nhd',
+                                    mla_split_qk=False,
+                                    fp32_alibi_biases=True,
+                                    decode_topk_blocks=0,
+                                    decode_recent_blocks=2)
+    yield
+    runtime.RUNTIME_CONFIG = prev
+
+
+def fetch(cache, blocks):
+    return cache.index_select(0, blocks)
+
+
+def make_sequences(seq_lens, kv_heads, num_blocks=64):
+    """ Fill paged caches with random sequences, returns caches and per-sequence contiguous k/v """
+    key_cache = torch.zeros(num_blocks * BLOCK_SIZE, kv_heads, HEAD_SIZE)
+    value_cache = torch.zeros(num_blocks * BLOCK_SIZE, kv_heads, HEAD_SIZE)
+    free_blocks = torch.randperm(num_blocks - 1) + 1
+    block_tables, keys, values = [], [], []
+    for seq_len in seq_lens:
+        num_seq_blocks = math.ceil(seq_len / BLOCK_SIZE)
+        block_table, free_blocks = free_blocks[:num_seq_blocks], free_blocks[num_seq_blocks:]
+        slots = (block_table.unsqueeze(-1) * BLOCK_SIZE + torch.arange(BLOCK_SIZE)).flatten()[:seq_len]
+        key = torch.randn(seq_len, kv_heads, HEAD_SIZE)
+        value = torch.randn(seq_len, kv_heads, HEAD_SIZE)
+        key_cache.index_copy_(0, slots, key)
+        value_cache.index_copy_(0, slots, value)
+        block_tables.append(block_table.tolist())
+        keys.append(key)
+        values.append(value)
+    return key_cache, value_cache, block_tables, keys, values
+
+
+def make_sequences_mla(seq_lens, kv_lora_rank, rope_dim, num_blocks=64):
+    """ Fill latent and rope caches with random sequences """
+    latent_cache = torch.zeros(num_blocks * BLOCK_SIZE, 1, kv_lora_rank)
+    rope_cache = torch.zeros(num_blocks * BLOCK_SIZE, 1, rope_dim)
+    block_tables, latents, ropes = [], [], []
+    for i, seq_len in enumerate(seq_lens):
+        num_seq_blocks = math.ceil(seq_len / BLOCK_SIZE)
+        block_table = torch.arange(num_seq_blocks) + 1 + i * num_blocks // len(seq_lens)
+        slots = (block_table.unsqueeze(-1) * BLOCK_SIZE + torch.arange(BLOCK_SIZE)).flatten()[:seq_len]
+        latent = torch.randn(seq_len, 1, kv_lora_rank)
+        rope = torch.randn(seq_len, 1, rope_dim)
+        latent_cache.index_copy_(0, slots, latent)
+        rope_cache.index_copy_(0, slots, rope)
+        block_tables.append(block_table.tolist())
+        latents.append(latent)
+        ropes.append(rope)
+    return latent_cache, rope_cache, block_tables, latents, ropes
+
+
+def make_decode_metadata(block_tables, block_indices, seq_lens, **bias_args):
+    """ Flatten per-sequence block tables into flat_pa metadata """
+    batch_size = len(block_tables)
+    block_list = torch.tensor(sum(block_tables, []))
+    block_groups = torch.tensor([i for i, bt in enumerate(block_tables) for _ in bt])
+    block_indices = torch.tensor(sum(block_indices, []))
+    block_seq_lens = torch.tensor(seq_lens)[block_groups]
+    block_mapping = torch.nn.functional.one_hot(block_groups, batch_size).to(torch.float32)
+    block_bias = ops.make_block_bias(block_indices, block_seq_lens, BLOCK_SIZE,
+                                     dtype=torch.float32, **bias_args)
+    return dict(block_list=block_list, block_mapping=block_mapping, block_bias=block_bias,
+                block_groups=block_groups)
+
+
+def run_flat_pa(query, key_cache, value_cache, metadata, scale, position_bias=None, **kwargs):
+    return ops.flat_pa(query=query, key_cache=key_cache, value_cache=value_cache,
+                       block_size=BLOCK_SIZE, scale=scale, matmul_qk_op=torch.matmul,
+                       position_bias=position_bias, matmul_av_op=torch.matmul,
+                       batch2block_matmul_op=torch.matmul, block2batch_matmul_op=torch.matmul,
+                       keys_fetch_func=fetch, values_fetch_func=fetch,
+                       **metadata, **kwargs)
+
+
+def banded_bias(seq_len, window_size=None, num_sink_tokens=0):
+    q_pos = torch.arange(seq_len).unsqueeze(-1)
+    k_pos = torch.arange(seq_len).unsqueeze(0)
+    mask = k_pos > q_pos
+    if window_size is not None:
+        mask |= ((q_pos - k_pos) >= window_size) & (k_pos >= num_sink_tokens)
+    return torch.zeros(1, 1, seq_len, seq_len).masked_fill_(mask, -math.inf)
+
+
+def naive_last_token(query, key, value, scale, attn_bias):
+    """ Reference: run prompt attention over the whole sequence, return output for last token """
+    seq_len = key.size(0)
+    full_query = torch.zeros(1, seq_len, *query.shape)
+    full_query[0, -1] = query
+    out = ops._naive_prompt_attention(full_query, key.unsqueeze(0), value.unsqueeze(0),
+                                      scale, attn_bias=attn_bias)
+    return out[0, -1]
+
+
+@pytest.mark.parametrize("q_heads,kv_heads", [(4, 4), (4, 2)])
+@pytest.mark.parametrize("window_size,num_sink_tokens", [(None, 0), (6, 0), (7, 3), (9, 5)])
+def test_flat_pa_sliding_window(q_heads, kv_heads, window_size, num_sink_tokens):
+    torch.manual_seed(0)
+    seq_lens = [3, 13, 21, 8]
+    scale = HEAD_SIZE ** -0.5
+    key_cache, value_cache, block_tables, keys, values = make_sequences(seq_lens, kv_heads)
+    if window_size is None:
+        selected = [(bt, list(range(len(bt)))) for bt in block_tables]
+    else:
+        selected = [ops.select_window_blocks(bt, sl, BLOCK_SIZE, window_size, num_sink_tokens)
+                    for bt, sl in zip(block_tables, seq_lens)]
+    metadata = make_decode_metadata([s[0] for s in selected], [s[1] for s in selected], seq_lens,
+                                    window_size=window_size, num_sink_tokens=num_sink_tokens)
+    if window_size is not None:
+        # Only blocks overlapping with the window or sinks are fetched
+        max_blocks = math.ceil(window_size / BLOCK_SIZE) + 1 + math.ceil(num_sink_tokens / BLOCK_SIZE)
+        assert all(len(s[0]) <= max_blocks for s in selected)
+
+    query = torch.randn(len(seq_lens), 1, q_heads * HEAD_SIZE)
+    out = run_flat_pa(query, key_cache, value_cache, metadata, scale)
+
+    for i, seq_len in enumerate(seq_lens):
+        ref = naive_last_token(query[i, 0].view(q_heads, HEAD_SIZE), keys[i], values[i], scale,
+                               banded_bias(seq_len, window_size, num_sink_tokens))
+        torch.testing.assert_close(out[i].view(q_heads, HEAD_SIZE), ref, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("q_heads,kv_heads", [(4, 4), (4, 2)])
+@pytest.mark.parametrize("variant", ['bias', 'alibi', 'window', 'no_bias'])
+def test_prompt_attention_split_context(q_heads, kv_heads, variant, monkeypatch):
+    torch.manual_seed(0)
+    batch_size, num_past_blocks, seq_len = 2, 3, 5
+    past_len = num_past_blocks * BLOCK_SIZE
+    scale = HEAD_SIZE ** -0.5
+    key_cache, value_cache, block_tables, _, _ = make_sequences([past_len] * batch_size, kv_heads)
+    query = torch.randn(batch_size, seq_len, q_heads, HEAD_SIZE)
+    key = torch.randn(batch_size, seq_len, kv_heads, HEAD_SIZE)
+    value = torch.randn(batch_size, seq_len, kv_heads, HEAD_SIZE)
+    # First sequence has one slot of padding in its context
+    q_pos = torch.arange(seq_len).unsqueeze(-1) + past_len
+    k_pos = torch.arange(past_len + seq_len).unsqueeze(0)
+    mask = (k_pos > q_pos).unsqueeze(0).repeat(batch_size, 1, 1)
+    mask[0, :, past_len - 1] = True
+    attn_bias = torch.zeros(batch_size, 1, seq_len, past_len + seq_len).masked_fill_(mask.unsqueeze(1), -math.inf)
+    args = dict(query=query, key=key, value=value, scale=scale,
+                key_cache=key_cache, value_cache=value_cache,
+                keys_fetch_func=fetch, values_fetch_func=fetch,
+                block_list=torch.tensor(sum(block_tables, [])), block_size=BLOCK_SIZE)
+    if variant == 'alibi':
+        args['alibi_slopes'] = alibi_slopes(q_heads)
+    if variant == 'window':
+        args['window_size'] = past_len // 2
+    ref = ops.prompt_attention('naive_impl', attn_bias=attn_bias, **args)
+
+    override_config(prompt_attn_split_context=True)
+    if variant in ('no_bias', 'window'):
+        # Without attn_bias padding can't be masked and padding would shift the window,
+        # context is concatenated instead
+        monkeypatch.setattr(ops, '_split_context_prompt_attention', None)
+        if variant == 'no_bias':
+            attn_bias = None
+            ref = ops.prompt_attention('naive_impl', attn_bias=attn_bias, **args)
+    out = ops.prompt_attention('naive_impl', attn_bias=attn_bias, **args)
+    torch.testing.assert_close(out, ref, rtol=1e-4, atol=1e-4)
+
+
+def block_diagonal_bias(cu_seqlens, total_len, window_size=None):
+    doc_ids = torch.bucketize(torch.arange(total_len), torch.tensor(cu_seqlens[1:]), right=True)
+    bias = banded_bias(total_len, window_size)
+    return bias.masked_fill_(doc_ids.unsqueeze(-1) != doc_ids.unsqueeze(0), -math.inf)
+
+
+@pytest.mark.parametrize("q_heads,kv_heads", [(4, 4), (4, 2)])
+@pytest.mark.parametrize("window_size,cu_seqlens", [(None, None), (37, None), (None, [0, 100, 150, 250])])
+def test_flex_prompt_attention_block_mask(q_heads, kv_heads, window_size, cu_seqlens):
+    torch.manual_seed(0)
+    seq_len = 256
+    scale = HEAD_SIZE ** -0.5
+    query = torch.randn(1, seq_len, q_heads, HEAD_SIZE)
+    key = torch.randn(1, seq_len, kv_heads, HEAD_SIZE)
+    value = torch.randn(1, seq_len, kv_heads, HEAD_SIZE)
+    if cu_seqlens is not None:
+        attn_bias = block_diagonal_bias(cu_seqlens, seq_len)
+    else:
+        attn_bias = banded_bias(seq_len, window_size)
+    ref = ops._naive_prompt_attention(query, key, value, scale, attn_bias=attn_bias)
+    out = ops._flex_prompt_attention(query, key, value, scale,
+                                     window_size=window_size, cu_seqlens=cu_seqlens)
+    torch.testing.assert_close(out, ref, rtol=1e-4, atol=1e-4)
+
+    # Block masks are cached per shape, packed batches with other boundaries reuse them
+    cache_key = (seq_len, seq_len, query.device, window_size, cu_seqlens is not None)
+    assert ops._flex_block_mask(*cache_key) is ops._flex_block_mask(*cache_key)
+    if cu_seqlens is not None:
+        other_cu_seqlens = [0, 30, 200, 256]
+        misses = ops._flex_block_mask.cache_info().misses
+        ref = ops._naive_prompt_attention(query, key, value, scale,
+                                          attn_bias=block_diagonal_bias(other_cu_seqlens, seq_len))
+        out = ops._flex_prompt_attention(query, key, value, scale, cu_seqlens=other_cu_seqlens)
+        torch.testing.assert_close(out, ref, rtol=1e-4, atol=1e-4)
+        assert ops._flex_block_mask.cache_info().misses == misses
+
+
+def test_flex_prompt_attention_with_context():
+    torch.manual_seed(0)
+    past_len, seq_len, heads = 8, 6, 2
+    scale = HEAD_SIZE ** -0.5
+    query = torch.randn(1, seq_len, heads, HEAD_SIZE)
+    key = torch.randn(1, past_len + seq_len, heads, HEAD_SIZE)
+    value = torch.randn(1, past_len + seq_len, heads, HEAD_SIZE)
+    attn_bias = banded_bias(past_len + seq_len)[..., past_len:, :]
+    ref = ops._naive_prompt_attention(query, key, value, scale, attn_bias=attn_bias)
+    out = ops._flex_prompt_attention(query, key, value, scale)
+    torch.testing.assert_close(out, ref, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("impl", ['naive_impl', 'flex_impl'])
+@pytest.mark.parametrize("q_heads,kv_heads", [(4, 4), (4, 2)])
+def test_prompt_attention_varlen(impl, q_heads, kv_heads):
+    torch.manual_seed(0)
+    # Three packed prompts followed by padding
+    cu_seqlens = [0, 5, 22, 30]
+    seq_len = 32
+    scale = HEAD_SIZE ** -0.5
+    query = torch.randn(1, seq_len, q_heads, HEAD_SIZE)
+    key = torch.randn(1, seq_len, kv_heads, HEAD_SIZE)
+    value = torch.randn(1, seq_len, kv_heads, HEAD_SIZE)
+    ref = ops._naive_prompt_attention(query, key, value, scale,
+                                      attn_bias=block_diagonal_bias(cu_seqlens, seq_len))
+    out = ops.prompt_attention(impl, query=query, key=key, value=value, scale=scale,
+                               cu_seqlens=cu_seqlens)
+    valid = cu_seqlens[-1]
+    torch.testing.assert_close(out[:, :valid], ref[:, :valid], rtol=1e-4, atol=1e-4)
+
+
+def test_prompt_attn_autotuner(tmp_path):
+    torch.manual_seed(0)
+    path = str(tmp_path / 'tuning.json')
+    tuner = PromptAttnAutotuner(['flex_impl', 'naive_impl'], path, num_iters=1)
+    query = torch.randn(1, 64, 2, HEAD_SIZE)
+    key = torch.randn(1, 64, 2, HEAD_SIZE)
+    args = dict(query=query, key=key, value=key, scale=1.0, cu_seqlens=[0, 64])
+    calls = []
+
+    def impl_fn(name):
+        return lambda: calls.append(name)
+
+    impl_fns = {impl: impl_fn(impl) for impl in ['flex_impl', 'fsdpa_impl', 'naive_impl']}
+    # Outside of tuning the configured default is used
+    assert tuner.select('naive_impl', args, impl_fns) == 'naive_impl'
+    assert calls == []
+    with tuner.tuning():
+        selected = tuner.select('naive_impl', args, impl_fns)
+    assert selected in ['flex_impl', 'naive_impl']
+    # Unavailable implementations are never timed
+    assert 'fsdpa_impl' not in calls
+    assert tuner.table == {(1, 64, 0): selected}
+
+    restored = PromptAttnAutotuner(['flex_impl', 'naive_impl'], path)
+    assert restored.lookup((1, 64, 0), 'fsdpa_impl') == selected
+    assert restored.lookup((2, 64, 0), 'fsdpa_impl') == 'fsdpa_impl'
+    restored = PromptAttnAutotuner(['fsdpa_impl'], path)
+    assert restored.lookup((1, 64, 0), 'fsdpa_impl') == 'fsdpa_impl'
+
+
+def test_prompt_attn_autotuner_respects_masks(monkeypatch):
+    torch.manual_seed(0)
+    seq_len, heads = 16, 2
+    query = torch.randn(1, seq_len, heads, HEAD_SIZE)
+    key = torch.randn(1, seq_len, heads, HEAD_SIZE)
+    # Padding mask on top of causal mask, only honored by naive_impl
+    attn_bias = banded_bias(seq_len).view(1, 1, seq_len, seq_len).clone()
+    attn_bias[..., 12:] = -math.inf
+    args = dict(query=query, key=key, value=key, scale=1.0, attn_bias=attn_bias)
+    ref = ops.prompt_attention('naive_impl', **args)
+
+    tuner = PromptAttnAutotuner(['flex_impl', 'naive_impl'], num_iters=1)
+    # Pretend flex was the fastest one for this bucket
+    tuner.table[tuner.get_bucket(args)] = 'flex_impl'
+    monkeypatch.setattr(ops, 'get_prompt_attn_autotuner', lambda: tuner)
+    torch.testing.assert_close(ops.prompt_attention('naive_impl', **args), ref)
+    tuner.table.clear()
+    with tuner.tuning():
+        torch.testing.assert_close(ops.prompt_attention('naive_impl', **args), ref)
+    assert tuner.table == {tuner.get_bucket(args): 'naive_impl'}
+
+    # FusedSDPA style arguments rely on implicit causal masking, which naive_impl lacks
+    fsdpa_args = dict(query=query, key=key, value=key, scale=1.0, fsdpa_op=object(),
+                      is_causal=True, valid_seq_lengths=torch.tensor([seq_len]))
+    assert ops._supported_prompt_attn_impls(fsdpa_args) == {'flex_impl', 'fsdpa_impl'}
+    assert ops._supported_prompt_attn_impls(dict(args, alibi_slopes=torch.ones(heads))) == {'naive_impl'}
+
+
+def to_head_major(key_cache, value_cache):
+    key_cache = key_cache.unflatten(0, (-1, BLOCK_SIZE)).permute(0, 2, 3, 1).contiguous()
+    value_cache = value_cache.unflatten(0, (-1, BLOCK_SIZE)).transpose(1, 2).contiguous()
+    return key_cache, value_cache
+
+
+def test_kv_cache_head_major_store():
+    torch.manual_seed(0)
+    num_blocks, kv_heads = 8, 2
+    caches = {}
+    for layout in ['nhd', 'hnd']:
+        caches[layout] = [torch.zeros(kv_cache_shape(num_blocks, BLOCK_SIZE, kv_heads, HEAD_SIZE, is_key, layout))
+                          for is_key in [True, False]]
+    slot_mapping = torch.tensor([5, 6, 7, 8, 17, 31])
+    key = torch.randn(slot_mapping.numel(), kv_heads, HEAD_SIZE)
+    value = torch.randn(slot_mapping.numel(), kv_heads, HEAD_SIZE)
+    for layout, (key_cache, value_cache) in caches.items():
+        VLLMKVCache(is_key=True)(key, key_cache, slot_mapping)
+        VLLMKVCache(is_key=False)(value, value_cache, slot_mapping)
+    with pytest.raises(AssertionError):
+        VLLMKVCache()(value, caches['hnd'][1], slot_mapping)
+    expected = to_head_major(*caches['nhd'])
+    torch.testing.assert_close(caches['hnd'][0], expected[0])
+    torch.testing.assert_close(caches['hnd'][1], expected[1])
+
+
+@pytest.mark.parametrize("q_heads,kv_heads", [(4, 4), (4, 2), (4, 1)])
+@pytest.mark.parametrize("fused_block_softmax", [False, True])
+def test_flat_pa_head_major(q_heads, kv_heads, fused_block_softmax, monkeypatch):
+    torch.manual_seed(0)
+    override_config(fused_block_softmax=fused_block_softmax)
+    pipelined_pa = ops.pipelined_pa
+    attn_dims = []
+    monkeypatch.setattr(ops, 'pipelined_pa', lambda attn, *args, **kwargs:
+                        attn_dims.append(attn.dim()) or pipelined_pa(attn, *args, **kwargs))
+    seq_lens = [3, 13, 21, 8]
+    scale = HEAD_SIZE ** -0.5
+    key_cache, value_cache, block_tables, _, _ = make_sequences(seq_lens, kv_heads)
+    metadata = make_decode_metadata(block_tables, [list(range(len(bt))) for bt in block_tables], seq_lens)
+    query = torch.randn(len(seq_lens), 1, q_heads * HEAD_SIZE)
+    position_bias = torch.randn(metadata['block_list'].numel(), q_heads, BLOCK_SIZE)
+    ref = run_flat_pa(query, key_cache, value_cache, metadata, scale)
+    out = run_flat_pa(query, *to_head_major(key_cache, value_cache), metadata, scale)
+    torch.testing.assert_close(out, ref, rtol=1e-4, atol=1e-4)
+
+    ref = run_flat_pa(query, key_cache, value_cache, metadata, scale, position_bias=position_bias)
+    out = run_flat_pa(query, *to_head_major(key_cache, value_cache), metadata, scale,
+                      position_bias=position_bias)
+    torch.testing.assert_close(out, ref, rtol=1e-4, atol=1e-4)
+    # GQA scores keep the 5D shape required by the fused block softmax in both layouts
+    if fused_block_softmax and kv_heads != q_heads:
+        assert attn_dims == [5] * 4
+
+
+def test_prompt_attention_context_head_major():
+    torch.manual_seed(0)
+    batch_size, kv_heads, seq_len = 2, 2, 5
+    past_len = 3 * BLOCK_SIZE
+    key_cache, value_cache, block_tables, _, _ = make_sequences([past_len] * batch_size, kv_heads)
+    query = torch.randn(batch_size, seq_len, kv_heads, HEAD_SIZE)
+    key = torch.randn(batch_size, seq_len, kv_heads, HEAD_SIZE)
+    attn_bias = banded_bias(past_len + seq_len)[..., past_len:, :]
+    args = dict(query=query, key=key, value=key, scale=1.0, attn_bias=attn_bias,
+                keys_fetch_func=fetch, values_fetch_func=fetch,
+                block_list=torch.tensor(sum(block_tables, [])), block_size=BLOCK_SIZE)
+    ref = ops.prompt_attention('naive_impl', key_cache=key_cache, value_cache=value_cache, **args)
+    key_cache, value_cache = to_head_major(key_cache, value_cache)
+    out = ops.prompt_attention('naive_impl', key_cache=key_cache, value_cache=value_cache, **args)
+    torch.testing.assert_close(out, ref)
+
+
+@pytest.mark.parametrize("mode", ['concat', 'split_qk', 'shared_cache'])
+def test_flat_pa_mla_absorbed(mode):
+    torch.manual_seed(0)
+    num_heads, nope_dim, rope_dim, v_dim, kv_lora_rank, q_in, hidden = 4, 8, 4, 6, 16, 12, 10
+    seq_lens = [5, 11]
+    scale = (nope_dim + rope_dim) ** -0.5
+    q_weight = torch.randn(num_heads * (nope_dim + rope_dim), q_in)
+    kv_b_weight = torch.randn(num_heads * (nope_dim + v_dim), kv_lora_rank)
+    o_weight = torch.randn(hidden, num_heads * v_dim)
+    latent_cache, rope_cache, block_tables, latents, ropes = make_sequences_mla(seq_lens, kv_lora_rank, rope_dim)
+    x = torch.randn(len(seq_lens), q_in)
+
+    q_weight_absorbed, o_weight_absorbed = ops.absorb_mla_weights(
+        q_weight, kv_b_weight, o_weight, num_heads, nope_dim, v_dim, kv_lora_rank)
+    query = (x @ q_weight_absorbed.t()).view(len(seq_lens), num_heads, kv_lora_rank + rope_dim)
+    metadata = make_decode_metadata(block_tables, [list(range(len(bt))) for bt in block_tables], seq_lens)
+    runtime.RUNTIME_CONFIG = Config(fp32_softmax=False, fused_block_softmax=False,
+                                    fused_block_softmax_adjustment=False,
+                                    mla_split_qk=(mode == 'split_qk'))
+    if mode == 'shared_cache':
+        key_cache, value_cache = torch.concat((latent_cache, rope_cache), dim=-1), None
+    else:
+        key_cache, value_cache = rope_cache, latent_cache
+    attn = ops.flat_pa_mla(query, key_cache, value_cache, block_size=BLOCK_SIZE, scale=scale,
+                           matmul_qk_op=torch.matmul, matmul_av_op=torch.matmul,
+                           batch2block_matmul_op=torch.matmul, block2batch_matmul_op=torch.matmul,
+                           keys_fetch_func=fetch, values_fetch_func=fetch,
+                           kv_lora_rank=kv_lora_rank, **metadata)
+    out = attn.flatten(1) @ o_weight_absorbed.t()
+
+    # Reference: regular attention with keys and values decompressed from latent cache
+    kv_b = kv_b_weight.view(num_heads, nope_dim + v_dim, kv_lora_rank)
+    for i in range(len(seq_lens)):
+        q = (x[i] @ q_weight.t()).view(num_heads, nope_dim + rope_dim)
+        kv = torch.einsum('hdl,tl->htd', kv_b, latents[i][:, 0])
+        k = torch.concat((kv[..., :nope_dim], ropes[i][:, 0].expand(num_heads, -1, -1)), dim=-1)
+        v = kv[..., nope_dim:]
+        probs = torch.softmax(q.unsqueeze(1) @ k.transpose(1, 2) * scale, dim=-1)
+        ref = (probs @ v).flatten() @ o_weight.t()
+        torch.testing.assert_close(out[i], ref, rtol=1e-3, atol=1e-3)
+
+
+def alibi_slopes(num_heads):
+    return torch.tensor([2 ** (-8 * (i + 1) / num_heads) for i in range(num_heads)])
+
+
+@pytest.mark.parametrize("q_heads,kv_heads", [(4, 4), (4, 2)])
+@pytest.mark.parametrize("layout", ['nhd', 'hnd'])
+def test_flat_pa_alibi(q_heads, kv_heads, layout):
+    torch.manual_seed(0)
+    seq_lens = [3, 13, 21, 8]
+    scale = HEAD_SIZE ** -0.5
+    key_cache, value_cache, block_tables, _, _ = make_sequences(seq_lens, kv_heads)
+    block_indices = [list(range(len(bt))) for bt in block_tables]
+    metadata = make_decode_metadata(block_tables, block_indices, seq_lens)
+    block_indices = torch.tensor(sum(block_indices, []))
+    block_seq_lens = torch.tensor(seq_lens)[metadata['block_groups']]
+    slopes = alibi_slopes(q_heads)
+    # Explicit bias of shape [num_blocks, q_heads, block_size]
+    rel_pos = block_indices.unsqueeze(-1) * BLOCK_SIZE + torch.arange(BLOCK_SIZE) - (block_seq_lens - 1).unsqueeze(-1)
+    position_bias = slopes.view(1, -1, 1) * rel_pos.unsqueeze(1)
+    if layout == 'hnd':
+        key_cache, value_cache = to_head_major(key_cache, value_cache)
+    query = torch.randn(len(seq_lens), 1, q_heads * HEAD_SIZE)
+    ref = run_flat_pa(query, key_cache, value_cache, metadata, scale, position_bias=position_bias)
+    out = run_flat_pa(query, key_cache, value_cache, metadata, scale, alibi_slopes=slopes,
+                      block_indices=block_indices, block_seq_lens=block_seq_lens)
+    torch.testing.assert_close(out, ref, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("q_heads,kv_heads", [(4, 4), (4, 2)])
+def test_naive_prompt_attention_alibi(q_heads, kv_heads):
+    torch.manual_seed(0)
+    past_len, seq_len = 3, 7
+    scale = HEAD_SIZE ** -0.5
+    query = torch.randn(2, seq_len, q_heads, HEAD_SIZE)
+    key = torch.randn(2, past_len + seq_len, kv_heads, HEAD_SIZE)
+    value = torch.randn(2, past_len + seq_len, kv_heads, HEAD_SIZE)
+    attn_bias = banded_bias(past_len + seq_len)[..., past_len:, :]
+    slopes = alibi_slopes(q_heads)
+    kv_pos = torch.arange(past_len + seq_len)
+    rel_pos = kv_pos.unsqueeze(0) - kv_pos[past_len:].unsqueeze(-1)
+    position_bias = (slopes.view(-1, 1, 1) * rel_pos).unsqueeze(0)
+    ref = ops._naive_prompt_attention(query, key, value, scale, attn_bias=attn_bias,
+                                      position_bias=position_bias)
+    out = ops._naive_prompt_attention(query, key, value, scale, attn_bias=attn_bias,
+                                      alibi_slopes=slopes)
+    torch.testing.assert_close(out, ref, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("q_heads,kv_heads", [(4, 4), (4, 2)])
+@pytest.mark.parametrize("layout", ['nhd', 'hnd'])
+@pytest.mark.parametrize("window_size", [None, 6])
+def test_flat_pa_multi_query(q_heads, kv_heads, layout, window_size):
+    torch.manual_seed(0)
+    num_query_tokens = 3
+    seq_lens = [3, 13, 21, 8]
+    scale = HEAD_SIZE ** -0.5
+    key_cache, value_cache, block_tables, keys, values = make_sequences(seq_lens, kv_heads)
+    metadata = make_decode_metadata(block_tables, [list(range(len(bt))) for bt in block_tables], seq_lens,
+                                    window_size=window_size, num_query_tokens=num_query_tokens)
+    if layout == 'hnd':
+        key_cache, value_cache = to_head_major(key_cache, value_cache)
+    query = torch.randn(len(seq_lens), num_query_tokens, q_heads * HEAD_SIZE)
+    out = run_flat_pa(query, key_cache, value_cache, metadata, scale)
+    assert out.shape == (len(seq_lens), num_query_tokens, q_heads, HEAD_SIZE)
+
+    for i, seq_len in enumerate(seq_lens):
+        full_query = torch.zeros(1, seq_len, q_heads, HEAD_SIZE)
+        full_query[0, -num_query_tokens:] = query[i].view(num_query_tokens, q_heads, HEAD_SIZE)
+        ref = ops._naive_prompt_attention(full_query, keys[i].unsqueeze(0), values[i].unsqueeze(0),
+                                          scale, attn_bias=banded_bias(seq_len, window_size))
+        torch.testing.assert_close(out[i], ref[0, -num_query_tokens:], rtol=1e-4, atol=1e-4)
+
+
+def test_flat_pa_multi_query_alibi():
+    torch.manual_seed(0)
+    q_heads, kv_heads, num_query_tokens = 4, 2, 3
+    seq_lens = [5, 13, 21, 8]
+    scale = HEAD_SIZE ** -0.5
+    key_cache, value_cache, block_tables, keys, values = make_sequences(seq_lens, kv_heads)
+    block_indices = [list(range(len(bt))) for bt in block_tables]
+    metadata = make_decode_metadata(block_tables, block_indices, seq_lens, num_query_tokens=num_query_tokens)
+    block_indices = torch.tensor(sum(block_indices, []))
+    block_seq_lens = torch.tensor(seq_lens)[metadata['block_groups']]
+    slopes = alibi_slopes(q_heads)
+    query = torch.randn(len(seq_lens), num_query_tokens, q_heads * HEAD_SIZE)
+    out = run_flat_pa(query, key_cache, value_cache, metadata, scale, alibi_slopes=slopes,
+                      block_indices=block_indices, block_seq_lens=block_seq_lens)
+
+    for i, seq_len in enumerate(seq_lens):
+        full_query = torch.zeros(1, seq_len, q_heads, HEAD_SIZE)
+        full_query[0, -num_query_tokens:] = query[i].view(num_query_tokens, q_heads, HEAD_SIZE)
+        ref = ops._naive_prompt_attention(full_query, keys[i].unsqueeze(0), values[i].unsqueeze(0),
+                                          scale, attn_bias=banded_bias(seq_len), alibi_slopes=slopes)
+        torch.testing.assert_close(out[i], ref[0, -num_query_tokens:], rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("q_heads,kv_heads", [(4, 4), (4, 2)])
+@pytest.mark.parametrize("layout", ['nhd', 'hnd'])
+def test_flat_pa_cascade(q_heads, kv_heads, layout):
+    torch.manual_seed(0)
+    scale = HEAD_SIZE ** -0.5
+    key_cache, value_cache, block_tables, _, _ = make_sequences([5, 3, 6, 2, 7, 9, 13], kv_heads)
+    # Two groups sharing 2 blocks each, the last sequence doesn't share anything
+    shared_a, shared_b = block_tables[0][:1] + block_tables[1], block_tables[2][:2]
+    block_tables = [shared_a + block_tables[0][1:], shared_a + block_tables[3],
+                    shared_a + block_tables[4], shared_b + block_tables[5], shared_b + block_tables[6][:2],
+                    block_tables[6][2:]]
+    seq_lens = [len(bt) * BLOCK_SIZE - i % 3 for i, bt in enumerate(block_tables)]
+    if layout == 'hnd':
+        key_cache, value_cache = to_head_major(key_cache, value_cache)
+    metadata = ops.make_cascade_metadata(block_tables, seq_lens, BLOCK_SIZE, dtype=torch.float32)
+    assert metadata['prefix_block_list'].tolist() == shared_a + shared_b
+    assert metadata['prefix_row_index'].tolist() == [0, 1, 2, 3, 4, -1]
+
+    query = torch.randn(len(seq_lens), 1, q_heads * HEAD_SIZE)
+    out = run_flat_pa(query, key_cache, value_cache, metadata, scale)
+    ref_metadata = make_decode_metadata(block_tables, [list(range(len(bt))) for bt in block_tables], seq_lens)
+    ref = run_flat_pa(query, key_cache, value_cache, ref_metadata, scale)
+    torch.testing.assert_close(out, ref, rtol=1e-4, atol=1e-4)
+
+
+def write_summary(key_cache, block_tables, keys, num_blocks=64):
+    """ Write keys through VLLMKVCache in two steps (prompt and decode) collecting block summary """
+    block_summary = torch.zeros(kv_cache_summary_shape(num_blocks, key_cache.size(1), HEAD_SIZE))
+    for block_table, key in zip(block_tables, keys):
+        slots = (torch.tensor(block_table).unsqueeze(-1) * BLOCK_SIZE + torch.arange(BLOCK_SIZE)).flatten()
+        slots = slots[:key.size(0)]
+        VLLMKVCache(is_key=True)(key[:-1], key_cache, slots[:-1], block_summary=block_summary)
+        VLLMKVCache(is_key=True)(key[-1:], key_cache, slots[-1:], block_summary=block_summary)
+    return block_summary
+
+
+@pytest.mark.parametrize("layout", ['nhd', 'hnd'])
+def test_kv_cache_block_summary(layout):
+    torch.manual_seed(0)
+    seq_lens = [3, 13, 21, 8]
+    key_cache, _, block_tables, keys, _ = make_sequences(seq_lens, 2)
+    if layout == 'hnd':
+        key_cache = to_head_major(key_cache, key_cache)[0]
+    block_summary = write_summary(key_cache, block_tables, keys)
+    for block_table, key in zip(block_tables, keys):
+        for i, block in enumerate(block_table):
+            block_keys = key[i * BLOCK_SIZE:(i + 1) * BLOCK_SIZE]
+            torch.testing.assert_close(block_summary[block, 0], block_keys.amin(0))
+            torch.testing.assert_close(block_summary[block, 1], block_keys.amax(0))
+
+
+def override_config(**kwargs):
+    runtime.RUNTIME_CONFIG = Config(runtime.RUNTIME_CONFIG.get_all(), **kwargs)
+
+
+def pad_block_tables(block_tables):
+    max_blocks = max(len(bt) for bt in block_tables)
+    return torch.tensor([bt + [0] * (max_blocks - len(bt)) for bt in block_tables])
+
+
+@pytest.mark.parametrize("q_heads,kv_heads", [(4, 4), (4, 2)])
+def test_flat_pa_topk_blocks(q_heads, kv_heads):
+    torch.manual_seed(0)
+    seq_lens = [61, 37, 6]
+    scale = HEAD_SIZE ** -0.5
+    needles = [[3, 9], [0, 5], [0]]
+    query = torch.randn(len(seq_lens), 1, q_heads * HEAD_SIZE)
+    key_cache, value_cache, block_tables, keys, _ = make_sequences(seq_lens, kv_heads)
+    for i, seq_needles in enumerate(needles):
+        # Keys of needle blocks are aligned with the query so that they are selected
+        direction = query[i].view(kv_heads, -1, HEAD_SIZE).sum(1)
+        for n in seq_needles:
+            keys[i][n * BLOCK_SIZE:(n + 1) * BLOCK_SIZE] += 4 * direction
+            key_cache.view(-1, BLOCK_SIZE, kv_heads, HEAD_SIZE)[block_tables[i][n]] += 4 * direction
+    block_summary = write_summary(key_cache.clone(), block_tables, keys)
+
+    override_config(decode_topk_blocks=2)
+    metadata = make_decode_metadata(block_tables, [list(range(len(bt))) for bt in block_tables], seq_lens)
+    out = run_flat_pa(query, key_cache, value_cache, metadata, scale, block_summary=block_summary,
+                      block_tables=pad_block_tables(block_tables), seq_lens=torch.tensor(seq_lens))
+
+    # Reference is exact attention over needle blocks and last two blocks of each sequence
+    selected = [sorted(set(n) | {len(bt) - 2, len(bt) - 1}) for n, bt in zip(needles, block_tables)]
+    ref_metadata = make_decode_metadata([[bt[i] for i in s] for bt, s in zip(block_tables, selected)],
+                                        selected, seq_lens)
+    ref = run_flat_pa(query, key_cache, value_cache, ref_metadata, scale)
+    torch.testing.assert_close(out, ref, rtol=1e-4, atol=1e-4)
+
+    # Sequences fitting into the selection budget use all blocks
+    override_config(decode_topk_blocks=16)
+    out = run_flat_pa(query, key_cache, value_cache, metadata, scale, block_summary=block_summary,
+                      block_tables=pad_block_tables(block_tables), seq_lens=torch.tensor(seq_lens))
+    torch.testing.assert_close(out, run_flat_pa(query, key_cache, value_cache, metadata, scale))
+
+    # Without block tables there is nothing to select from, all blocks are used as well
+    override_config(decode_topk_blocks=2)
+    out = run_flat_pa(query, key_cache, value_cache, metadata, scale, block_summary=block_summary)
+    torch.testing.assert_close(out, run_flat_pa(query, key_cache, value_cache, metadata, scale))
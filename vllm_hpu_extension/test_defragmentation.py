@@ -0,0 +1,89 @@
+###############################################################################
+# Copyright (C) 2025 Habana Labs, Ltd. an Intel Company
+#
+# This source code is licensed under the Apache 2.0 license found in the
+# LICENSE file in the root directory of this source tree.
+###############################################################################
+
+import random
+
+import pytest
+
+import vllm_hpu_extension.runtime as runtime
+from vllm_hpu_extension.config import Config
+from vllm_hpu_extension.defragmentation import OnlineDefragmenter
+
+
+class FakeCacheUtils:
+    """ Tracks which original block is stored under each block_id """
+
+    def __init__(self):
+        self.content = {}
+
+    def swap(self, to_swap, threshold):
+        assert len(to_swap) <= threshold
+        for src, dst in to_swap:
+            self.content[src], self.content[dst] = self.content.get(dst, dst), self.content.get(src, src)
+
+
+@pytest.fixture
+def defragmenter(request):
+    prev = runtime.RUNTIME_CONFIG
+    runtime.RUNTIME_CONFIG = Config(VLLM_DEFRAG_THRESHOLD=4,
+                                    VLLM_DEFRAG=True,
+                                    VLLM_DEFRAG_WITH_GRAPHS=False,
+                                    VLLM_DEBUG=None,
+                                    bridge_mode='lazy',
+                                    defrag_compaction=request.param)
+    defrag = OnlineDefragmenter()
+    defrag.cache_utils = FakeCacheUtils()
+    yield defrag
+    runtime.RUNTIME_CONFIG = prev
+
+
+@pytest.mark.parametrize("defragmenter", [True], indirect=True)
+def test_compaction_with_shared_blocks(defragmenter):
+    rng = random.Random(0)
+    free = list(range(1, 200))
+    rng.shuffle(free)
+    shared_prefix = [free.pop() for _ in range(3)]
+    req_blocks = {}
+    for step in range(50):
+        new_blocks = {}
+        for i in range(3):
+            # Every request starts with the same prefix-cached blocks
+            blocks = shared_prefix + [free.pop() for _ in range(rng.randint(1, 5))]
+            new_blocks[f'{step}-{i}'] = blocks
+            req_blocks[f'{step}-{i}'] = blocks
+        finished = [r for r in req_blocks if r not in new_blocks and rng.random() < 0.5]
+        defragmenter.update_state(new_blocks, finished)
+        for req_id in finished:
+            free.extend(b for b in req_blocks.pop(req_id) if b not in shared_prefix)
+        num_swapped = defragmenter.num_swapped
+        defragmenter.defragment()
+        # Each step swaps at most one batch of threshold blocks, compaction finishes in later steps
+        assert defragmenter.num_swapped - num_swapped <= defragmenter.threshold
+        while not defragmenter.is_compact():
+            defragmenter.defragment()
+
+        assert defragmenter.padding() == 1
+        live = {b for blocks in req_blocks.values() for b in blocks}
+        resolved = {defragmenter.resolve(b) for b in live}
+        assert max(resolved) == len(live)
+        assert defragmenter.used_blocks[defragmenter.resolve(shared_prefix[0])] == len(req_blocks)
+        content = defragmenter.cache_utils.content
+        assert all(content.get(defragmenter.resolve(b), defragmenter.resolve(b)) == b for b in live)
+    assert defragmenter.num_swapped > 0
+
+
+@pytest.mark.parametrize("defragmenter", [False], indirect=True)
+def test_threshold_defragmentation(defragmenter):
+    defragmenter.update_state({'a': list(range(1, 11)), 'b': list(range(11, 21))}, [])
+    defragmenter.update_state({}, ['a'])
+    defragmenter.defragment()
+    # Fragmentation below threshold is left alone unless compaction is enabled
+    defragmenter.update_state({'c': [25]}, [])
+    defragmenter.defragment()
+    assert defragmenter.resolve(25) <= 11
+    assert not defragmenter.is_compact()
+
@@ -7,7 +7,7 @@
 
 import os
 import pytest
-from vllm_hpu_extension.config import VersionRange, Config, Kernel, Env, boolean, All, Not, Eq, Enabled, FirstEnabled
+from vllm_hpu_extension.config import VersionRange, Config, Kernel, Env, Value, boolean, All, Not, Eq, Enabled, Disabled, FirstEnabled
 from vllm_hpu_extension.validation import choice, regex
 
 
@@ -190,3 +190,19 @@ def test_regex_with_hint():
     check = regex(r'^[a-z]+$', hint='Only lowercase letters allowed')
     result = check('ABC')
     assert result == "'ABC' doesn't match pattern '^[a-z]+$'! Only lowercase letters allowed"
+
+
+def test_value_requires():
+    value = Value('use_contiguous_pa', Disabled('prefix_caching'), requires=Disabled('prefix_caching'))
+    assert value(Config(VLLM_USE_CONTIGUOUS_PA=None, prefix_caching=False)) is True
+    assert value(Config(VLLM_USE_CONTIGUOUS_PA=None, prefix_caching=True)) is False
+    assert value(Config(VLLM_USE_CONTIGUOUS_PA=False, prefix_caching=True)) is False
+    # Forcing the value on without its requirements fails at validation
+    with pytest.raises(RuntimeError):
+        value(Config(VLLM_USE_CONTIGUOUS_PA=True, prefix_caching=True))
+
+    requirements = All(Disabled('prefix_caching'), Eq('decode_topk_blocks', 0))
+    value = Value('use_contiguous_pa', requirements, requires=requirements)
+    assert value(Config(VLLM_USE_CONTIGUOUS_PA=None, prefix_caching=False, decode_topk_blocks=4)) is False
+    with pytest.raises(RuntimeError):
+        value(Config(VLLM_USE_CONTIGUOUS_PA=True, prefix_caching=False, decode_topk_blocks=4))
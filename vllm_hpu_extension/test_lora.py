@@ -0,0 +1,126 @@
+###############################################################################
+# Copyright (C) 2025 Habana Labs, Ltd. an Intel Company
+#
+# This source code is licensed under the Apache 2.0 license found in the
+# LICENSE file in the root directory of this source tree.
+###############################################################################
+
+import pytest
+import torch
+
+import vllm_hpu_extension.ops as ops
+from vllm_hpu_extension.lora_pager import HostAdapterStore, LoraAdapterPager
+
+
+MAX_LORAS = 8
+RANK = 4
+H_IN = 16
+H_OUT = 24
+
+
+def make_mask(lora_indices, max_loras, rank):
+    """ Dense LoraMask consumed by bgmv dispatch """
+    mask = torch.zeros(lora_indices.numel(), max_loras * rank)
+    for token, adapter in enumerate(lora_indices.tolist()):
+        if adapter >= 0:
+            mask[token, adapter * rank:(adapter + 1) * rank] = 1
+    return mask
+
+
+@pytest.fixture
+def lora_indices():
+    torch.manual_seed(0)
+    return torch.tensor([3, -1, 0, 3, 5, 5, 3, -1, 0, 7])
+
+
+def test_sgmv_linear(lora_indices):
+    x = torch.randn(lora_indices.numel(), H_IN)
+    wa_t_all = torch.randn(MAX_LORAS, 1, RANK, H_IN)
+    wb_t_all = torch.randn(MAX_LORAS, 1, H_OUT, RANK)
+    y_ref = torch.randn(lora_indices.numel(), H_OUT)
+    y = y_ref.clone()
+    ops.LoraMask.setLoraMask(make_mask(lora_indices, MAX_LORAS, RANK))
+    ops.dispatch_bgmv_linear(y_ref, x, wa_t_all, wb_t_all, 0, 0.5)
+    ops.dispatch_sgmv_linear(y, x, wa_t_all, wb_t_all, lora_indices, 0, 0.5)
+    torch.testing.assert_close(y, y_ref)
+
+
+def test_sgmv_embedding(lora_indices):
+    x = torch.randn(lora_indices.numel(), RANK)
+    wb_t_all = torch.randn(MAX_LORAS, 1, H_OUT, RANK)
+    y_ref = torch.randn(lora_indices.numel(), H_OUT)
+    y = y_ref.clone()
+    ops.LoraMask.setLoraMask(make_mask(lora_indices, MAX_LORAS, RANK))
+    ops.dispatch_bgmv_embedding(y_ref, x, wb_t_all, 0)
+    ops.dispatch_sgmv_embedding(y, x, wb_t_all, lora_indices, 0)
+    torch.testing.assert_close(y, y_ref)
+
+
+def test_lora_weight_cache_invalidation(lora_indices):
+    x = torch.randn(lora_indices.numel(), H_IN)
+    wa_t_all = torch.randn(MAX_LORAS, 1, RANK, H_IN)
+    wb_t_all = torch.randn(MAX_LORAS, 1, H_OUT, RANK)
+    context = ops.LoraContext(mask=make_mask(lora_indices, MAX_LORAS, RANK))
+    y = torch.zeros(lora_indices.numel(), H_OUT)
+    ops.dispatch_bgmv_linear(y, x, wa_t_all, wb_t_all, 0, 1.0, lora_context=context)
+    wa = ops.LORA_WEIGHT_CACHE.get_a(wa_t_all)
+    assert ops.LORA_WEIGHT_CACHE.get_a(wa_t_all) is wa
+
+    # Loading a new adapter into slot 3 updates stacked weights in-place
+    wa_t_all[3].copy_(torch.randn(1, RANK, H_IN))
+    wb_t_all[3].copy_(torch.randn(1, H_OUT, RANK))
+    assert ops.LORA_WEIGHT_CACHE.get_a(wa_t_all) is not wa
+    y = torch.zeros(lora_indices.numel(), H_OUT)
+    ops.dispatch_bgmv_linear(y, x, wa_t_all, wb_t_all, 0, 1.0, lora_context=context)
+    y_ref = torch.zeros(lora_indices.numel(), H_OUT)
+    ops.dispatch_sgmv_linear(y_ref, x, wa_t_all, wb_t_all, lora_indices, 0, 1.0)
+    torch.testing.assert_close(y, y_ref)
+
+
+def make_pager(num_adapters, num_slots, num_layers=2):
+    store = HostAdapterStore()
+    for adapter_id in range(num_adapters):
+        store.add(f'lora{adapter_id}', [(torch.randn(RANK, H_IN), torch.randn(H_OUT, RANK))
+                                        for _ in range(num_layers)])
+    stacked = [(torch.zeros(num_slots, 1, RANK, H_IN), torch.zeros(num_slots, 1, H_OUT, RANK))
+               for _ in range(num_layers)]
+    return LoraAdapterPager(store, stacked)
+
+
+def test_lora_pager_lru_eviction():
+    torch.manual_seed(0)
+    pager = make_pager(num_adapters=6, num_slots=3)
+    first = pager.acquire(['lora0', 'lora1'])
+    pager.acquire(['lora2', 'lora0'])
+    # lora1 is the least recently used one
+    second = pager.acquire(['lora3'])
+    assert second['lora3'] == first['lora1']
+    assert set(pager.slots) == {'lora0', 'lora2', 'lora3'}
+    # Prefetch can't evict adapters of the current batch
+    pager.acquire(['lora0', 'lora2', 'lora3'])
+    pager.prefetch(['lora4'])
+    assert 'lora4' not in pager.slots
+    pager.acquire(['lora0'])
+    pager.prefetch(['lora4', 'lora5'])
+    assert set(pager.slots) == {'lora0', 'lora4', 'lora5'}
+    assert (pager.hits, pager.misses, pager.evictions) == (5, 4, 3)
+    with pytest.raises(RuntimeError):
+        pager.acquire(['lora1', 'lora2', 'lora3', 'lora4'])
+
+
+def test_lora_pager_dispatch():
+    torch.manual_seed(0)
+    pager = make_pager(num_adapters=8, num_slots=4)
+    x = torch.randn(6, H_IN)
+    for batch in [['lora1', None, 'lora5', 'lora1', 'lora7', 'lora2'],
+                  ['lora3', 'lora3', None, 'lora6', 'lora0', 'lora5']]:
+        context = pager.build_context(batch)
+        for layer, (wa_t_all, wb_t_all) in enumerate(pager.stacked_weights):
+            y = torch.zeros(len(batch), H_OUT)
+            ops.dispatch_bgmv_linear(y, x, wa_t_all, wb_t_all, 0, 1.0, lora_context=context)
+            for token, adapter_id in enumerate(batch):
+                expected = torch.zeros(H_OUT)
+                if adapter_id is not None:
+                    lora_a, lora_b = pager.store.get(adapter_id)[layer]
+                    expected = lora_b @ (lora_a @ x[token])
+                torch.testing.assert_close(y[token], expected, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,479 @@
+###############################################################################
+# Copyright (C) 2025 Habana Labs, Ltd. an Intel Company
+#
+# This source code is licensed under the Apache 2.0 license found in the
+# LICENSE file in the root directory of this source tree.
+###############################################################################
+
+import contextlib
+import pytest
+import torch
+import torch.distributed as dist
+from types import SimpleNamespace
+
+import vllm_hpu_extension.ops as ops
+import vllm_hpu_extension.runtime as runtime
+from vllm_hpu_extension.config import Config
+import vllm_hpu_extension.expert_cache as expert_cache
+import vllm_hpu_extension.expert_stats as expert_stats
+from vllm_hpu_extension.expert_cache import ExpertDequantCache, get_expert_dequant_cache
+from vllm_hpu_extension.expert_parallel import ExpertParallelMoE, LocalComm, TorchDistributedComm, local_expert_range
+from vllm_hpu_extension.expert_stats import ExpertLoadStats, get_expert_load_stats
+
+
+NUM_EXPERTS = 8
+HIDDEN_SIZE = 16
+INTERMEDIATE_SIZE = 8
+
+
+@pytest.fixture(autouse=True)
+def cpu_config():
+    prev = runtime.RUNTIME_CONFIG
+    runtime.RUNTIME_CONFIG = Config(moe_expert_stats=False,
+                                    VLLM_MOE_EXPERT_STATS_INTERVAL=None,
+                                    moe_dequant_cache_mb=0,
+                                    moe_dequant_cache_pinned=0,
+                                    max_experts_per_slice=-1,
+                                    moe_adaptive_slicing=False,
+                                    moe_capacity_factor=0.0,
+                                    moe_capacity_policy='drop',
+                                    moe_input_scale_margin=1.0,
+                                    moe_shared_experts_stream=False)
+    yield
+    runtime.RUNTIME_CONFIG = prev
+
+
+def override_config(**kwargs):
+    runtime.RUNTIME_CONFIG = Config(runtime.RUNTIME_CONFIG.get_all(), **kwargs)
+
+
+def make_weights(dtype=torch.float32):
+    w13 = torch.randn(NUM_EXPERTS, 2 * INTERMEDIATE_SIZE, HIDDEN_SIZE).to(dtype)
+    w2 = torch.randn(NUM_EXPERTS, HIDDEN_SIZE, INTERMEDIATE_SIZE).to(dtype)
+    return w13, w2
+
+
+def test_stacked_expert_weights():
+    torch.manual_seed(0)
+    w13, w2 = make_weights()
+    op = ops.VllmMixtureOfExpertsOp(NUM_EXPERTS)
+    op.set_stacked_weights(w13, w2)
+    w13_list, w2_list = op.get_expert_weights()
+    assert all(w.data_ptr() == w13[i].data_ptr() for i, w in enumerate(w13_list))
+    assert all(w.data_ptr() == w2[i].data_ptr() for i, w in enumerate(w2_list))
+    assert op.w13_list[3].weight.data_ptr() == w13[3].data_ptr()
+    # Replacing weights of a single expert drops the stale stack
+    new_weight = torch.randn_like(w13[3])
+    op.w13_list[3].set_weight(new_weight)
+    assert op.stacked_weights is None
+    assert op.get_expert_weights()[0][3].data_ptr() == new_weight.data_ptr()
+
+    # So does assigning the weight directly
+    op.set_stacked_weights(w13, w2)
+    op.w2_list[1].weight = torch.randn_like(w2[1])
+    assert op.stacked_weights is None
+    assert op.get_expert_weights()[1][1].data_ptr() == op.w2_list[1].weight.data_ptr()
+
+    # And swapping an expert module, e.g. by INC
+    op.set_stacked_weights(w13, w2)
+    patched = ops.MoeMatmul()
+    patched.weight = torch.randn_like(w13[5])
+    op.w13_list[5] = patched
+    assert op.stacked_weights is None
+    assert op.get_expert_weights()[0][5].data_ptr() == patched.weight.data_ptr()
+
+
+def test_stacked_fp8_block_dequant():
+    torch.manual_seed(0)
+    block_size = (4, 4)
+    w13, w2 = make_weights(torch.float8_e4m3fn)
+    w13_scale = torch.rand(NUM_EXPERTS, w13.size(1) // 4, w13.size(2) // 4)
+    w2_scale = torch.rand(NUM_EXPERTS, w2.size(1) // 4, w2.size(2) // 4)
+    ref_op = ops.VllmMixtureOfExpertsOpFP8(NUM_EXPERTS)
+    op = ops.VllmMixtureOfExpertsOpFP8(NUM_EXPERTS)
+    op.set_stacked_weights(w13, w2, w13_scale, w2_scale)
+    for i in range(NUM_EXPERTS):
+        ref_op.w13_list[i].set_weight(w13[i])
+        ref_op.w13_list[i].set_scale_inv_fp8(w13_scale[i])
+        ref_op.w2_list[i].set_weight(w2[i])
+        ref_op.w2_list[i].set_scale_inv_fp8(w2_scale[i])
+    for m in [*op.w13_list, *op.w2_list, *ref_op.w13_list, *ref_op.w2_list]:
+        m.set_weight_block_size(block_size)
+    for ref, out in zip(ref_op.get_dequant_expert_weights(), op.get_dequant_expert_weights()):
+        for r, o in zip(ref, out):
+            torch.testing.assert_close(o, r)
+
+
+def test_expert_dequant_cache_policy():
+    cache = ExpertDequantCache(budget_bytes=3 * 4 * 16)
+    build = lambda: torch.zeros(16)
+    for key in 'abc':
+        cache.get(key, build)
+    cache.get('a', build)
+    # Unpinned entries are not admitted into a full cache
+    cache.get('d', build)
+    assert list(cache.entries) == ['b', 'c', 'a']
+    # Pinned ones evict the least recently used unpinned entries
+    cache.pin('layer0', ['b', 'd', 'e'])
+    cache.get('d', build)
+    assert list(cache.entries) == ['b', 'a', 'd']
+    cache.get('e', build)
+    assert list(cache.entries) == ['b', 'd', 'e']
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 6, 2)
+    # Values larger than the budget are returned without caching
+    cache.pin('layer1', ['big'])
+    cache.get('big', lambda: torch.zeros(64))
+    assert 'big' not in cache.entries and cache.used_bytes == 3 * 4 * 16
+
+
+def test_fp8_dequant_cache_hot_experts():
+    torch.manual_seed(0)
+    override_config(moe_dequant_cache_mb=1, moe_dequant_cache_pinned=2)
+    try:
+        op = ops.VllmMixtureOfExpertsOpFP8(NUM_EXPERTS)
+        w13, w2 = make_weights(torch.float8_e4m3fn)
+        w13_scale = torch.rand(NUM_EXPERTS, w13.size(1) // 4, w13.size(2) // 4)
+        w2_scale = torch.rand(NUM_EXPERTS, w2.size(1) // 4, w2.size(2) // 4)
+        op.set_stacked_weights(w13, w2, w13_scale, w2_scale)
+        for m in [*op.w13_list, *op.w2_list]:
+            m.set_weight_block_size((4, 4))
+        cache = get_expert_dequant_cache()
+        op.update_hot_experts(torch.tensor([[5, 2], [5, 1], [2, 5]]))
+        assert cache.pinned[op] == {op.w13_list[5], op.w13_list[2], op.w2_list[5], op.w2_list[2]}
+        w13_list, _ = op.get_dequant_expert_weights()
+        # Stacked experts are checked with a single layer-level version
+        with pytest.MonkeyPatch.context() as mp:
+            mp.setattr(ops.MoeFP8Matmul, 'get_dequant_version', None)
+            assert op.get_dequant_expert_weights()[0][3] is w13_list[3]
+        torch.testing.assert_close(w13_list[3], op.w13_list[3].get_dequant_weight())
+        # Updated weights invalidate cached entries, whether modified in-place or replaced
+        w13[3].copy_(w13[4])
+        w13_scale[3].copy_(w13_scale[4])
+        torch.testing.assert_close(op.get_dequant_expert_weights()[0][3], op.w13_list[4].get_dequant_weight())
+        op.w13_list[5].set_weight(w13[6])
+        op.w13_list[5].set_scale_inv_fp8(w13_scale[6])
+        torch.testing.assert_close(op.get_dequant_expert_weights()[0][5], op.w13_list[6].get_dequant_weight())
+    finally:
+        expert_cache._EXPERT_DEQUANT_CACHE = None
+
+
+def dense_moe(hidden_states, topk_ids, topk_weights, w13, w2):
+    """ Per-token loop over routed experts """
+    out = torch.zeros_like(hidden_states)
+    for token, (experts, weights) in enumerate(zip(topk_ids.tolist(), topk_weights)):
+        for expert, weight in zip(experts, weights):
+            gate, up = (w13[expert] @ hidden_states[token]).chunk(2)
+            out[token] += weight * (w2[expert] @ (torch.nn.functional.silu(gate) * up))
+    return out
+
+
+def test_reference_mixture_of_experts():
+    torch.manual_seed(0)
+    w13, w2 = make_weights()
+    hidden_states = torch.randn(6, HIDDEN_SIZE)
+    # Expert 0 and 7 receive no tokens
+    topk_ids = torch.tensor([[1, 3], [3, 2], [5, 1], [3, 6], [2, 4], [1, 3]])
+    topk_weights = torch.rand(6, 2)
+    out = ops.reference_mixture_of_experts(hidden_states, topk_ids, topk_weights,
+                                           list(w13), list(w2))
+    torch.testing.assert_close(out, dense_moe(hidden_states, topk_ids, topk_weights, w13, w2))
+
+    # Experts outside of the local range are skipped
+    local = ops.reference_mixture_of_experts(hidden_states, topk_ids, topk_weights,
+                                             list(w13[2:6]), list(w2[2:6]), experts_min=2)
+    mask = (topk_ids >= 2) & (topk_ids < 6)
+    torch.testing.assert_close(local, dense_moe(hidden_states, topk_ids, topk_weights * mask, w13, w2))
+
+
+def test_sliced_moe_op():
+    torch.manual_seed(0)
+    w13, w2 = make_weights()
+    hidden_states = torch.randn(16, HIDDEN_SIZE)
+    topk_weights, topk_ids = torch.rand(16, NUM_EXPERTS).softmax(-1).topk(2)
+    op = ops.VllmMixtureOfExpertsOp(NUM_EXPERTS)
+    op.set_stacked_weights(w13, w2)
+    out = op(hidden_states, topk_ids, topk_weights)
+    op.moe_n_slice, op.num_expert_per_group = 4, NUM_EXPERTS // 4
+    torch.testing.assert_close(op(hidden_states, topk_ids, topk_weights), out)
+    torch.testing.assert_close(out, dense_moe(hidden_states, topk_ids, topk_weights, w13, w2))
+
+
+class FakeProfiler:
+
+    def __init__(self):
+        self.counters = []
+
+    def get_timestamp_us(self):
+        return len(self.counters)
+
+    def record_counter(self, ts, counter):
+        self.counters.append(counter)
+
+
+def test_expert_load_stats():
+    torch.manual_seed(0)
+    w13, w2 = make_weights()
+    layers = [ops.VllmMixtureOfExpertsOp(NUM_EXPERTS) for _ in range(2)]
+    for layer in layers:
+        layer.set_stacked_weights(w13, w2)
+    override_config(moe_expert_stats=True, VLLM_MOE_EXPERT_STATS_INTERVAL=2)
+    try:
+        stats = get_expert_load_stats(profiler=FakeProfiler())
+        for step in range(5):
+            topk_ids = torch.tensor([[0, 3], [3, 5], [3, 0]])
+            for layer in layers:
+                layer(torch.randn(3, HIDDEN_SIZE), topk_ids, torch.rand(3, 2))
+    finally:
+        expert_stats._EXPERT_LOAD_STATS = None
+    # Steps 0-1 and 2-3 were flushed, step 4 is still on device
+    assert len(stats.profiler.counters) == 2
+    assert stats.counts['moe1'].tolist() == [8, 0, 0, 12, 0, 4, 0, 0]
+    assert stats.profiler.counters[-1] == {'moe0_tokens': 12, 'moe0_active_experts': 3, 'moe0_imbalance': 4.0,
+                                           'moe1_tokens': 12, 'moe1_active_experts': 3, 'moe1_imbalance': 4.0}
+    assert stats.device_counts['moe0'].tolist() == [2, 0, 0, 3, 0, 1, 0, 0]
+
+
+def test_expert_load_stats_without_profiler():
+    stats = ExpertLoadStats(interval=1)
+    stats.record('layer', torch.tensor([[0, 1]]), NUM_EXPERTS)
+    stats.flush()
+    assert stats.profiler is None
+    assert stats.counts['moe0'].tolist() == [1, 1, 0, 0, 0, 0, 0, 0]
+
+
+def test_partition_experts():
+    assert ops.partition_experts([4, 4, 1, 1, 1, 1, 0, 0], 6) == [(0, 6)]
+    assert ops.partition_experts([5, 0, 0, 1, 1, 1, 1, 1, 0, 0], 4) == [(0, 4), (4, 8)]
+    # Experts without routed tokens are skipped
+    assert ops.partition_experts([0, 3, 0, 0, 0, 3, 3, 0], 2) == [(1, 2), (5, 7)]
+    assert ops.partition_experts([0, 0, 0, 0], 2) == []
+
+
+def test_adaptive_moe_slicing():
+    torch.manual_seed(0)
+    w13, w2 = make_weights()
+    hidden_states = torch.randn(16, HIDDEN_SIZE)
+    topk_weights = torch.rand(16, 2)
+    topk_ids = torch.randint(5, 8, (16, 2))
+    override_config(max_experts_per_slice=3, moe_adaptive_slicing=True)
+    op = ops.VllmMixtureOfExpertsOp(NUM_EXPERTS)
+    op.set_stacked_weights(w13, w2)
+    assert op.get_expert_slices(topk_ids) == [(5, 8)]
+    out = op(hidden_states, topk_ids, topk_weights)
+    torch.testing.assert_close(out, dense_moe(hidden_states, topk_ids, topk_weights, w13, w2),
+                               rtol=1e-4, atol=1e-4)
+
+
+def expert_parallel_worker(rank, world_size, init_file, inputs):
+    dist.init_process_group('gloo', init_method=f'file://{init_file}', rank=rank, world_size=world_size)
+    try:
+        w13, w2, hidden_states, topk_ids, topk_weights, expected = inputs
+        comm = TorchDistributedComm()
+        experts_min, experts_max = local_expert_range(NUM_EXPERTS, comm)
+        op = ops.VllmMixtureOfExpertsOp(experts_max - experts_min + 1, experts_min, experts_max)
+        op.set_stacked_weights(w13[experts_min:experts_max + 1], w2[experts_min:experts_max + 1])
+        moe = ExpertParallelMoE(op, NUM_EXPERTS, comm)
+        # Each rank processes its own batch
+        tokens = slice(rank * 4, (rank + 1) * 4)
+        out = moe(hidden_states[tokens], topk_ids[tokens], topk_weights[tokens])
+        torch.testing.assert_close(out, expected[tokens], rtol=1e-4, atol=1e-4)
+    finally:
+        dist.destroy_process_group()
+
+
+def test_expert_parallel_moe(tmp_path):
+    torch.manual_seed(0)
+    w13, w2 = make_weights()
+    hidden_states = torch.randn(8, HIDDEN_SIZE)
+    topk_weights = torch.rand(8, 2)
+    # Last token is routed to experts of rank 0 only
+    topk_ids = torch.tensor([[0, 7], [5, 6], [1, 2], [4, 3], [7, 6], [2, 5], [3, 4], [1, 0]])
+    expected = dense_moe(hidden_states, topk_ids, topk_weights, w13, w2)
+    torch.multiprocessing.spawn(expert_parallel_worker, nprocs=2,
+                                args=(2, tmp_path / 'init', (w13, w2, hidden_states, topk_ids, topk_weights, expected)))
+
+
+def reference_grouped_topk(logits, top_k, num_expert_group, topk_group, bias):
+    """ Per-token DeepSeek-V3 routing """
+    weights, ids = [], []
+    group_size = logits.size(-1) // num_expert_group
+    for token_logits in logits:
+        scores = token_logits.sigmoid()
+        corrected = (scores + bias).tolist()
+        groups = sorted(range(num_expert_group), reverse=True,
+                        key=lambda g: sum(sorted(corrected[g * group_size:(g + 1) * group_size])[-2:]))
+        candidates = [e for g in groups[:topk_group] for e in range(g * group_size, (g + 1) * group_size)]
+        experts = sorted(candidates, key=lambda e: corrected[e], reverse=True)[:top_k]
+        token_weights = scores[experts]
+        weights.append(token_weights / token_weights.sum())
+        ids.append(experts)
+    return torch.stack(weights), torch.tensor(ids)
+
+
+def test_moe_routing_grouped_topk():
+    torch.manual_seed(0)
+    logits = torch.randn(8, 16, dtype=torch.bfloat16)
+    bias = torch.randn(16) * 0.1
+    topk_weights, topk_ids = ops.moe_routing(logits, 4, scoring_func="sigmoid", num_expert_group=4,
+                                             topk_group=2, e_score_correction_bias=bias)
+    ref_weights, ref_ids = reference_grouped_topk(logits.float(), 4, 4, 2, bias)
+    torch.testing.assert_close(topk_ids, ref_ids)
+    torch.testing.assert_close(topk_weights, ref_weights)
+    # Selected experts come from at most topk_group groups
+    assert all(len(set(row)) <= 2 for row in (topk_ids // 4).tolist())
+
+
+def test_moe_routing_softmax():
+    torch.manual_seed(0)
+    logits = torch.randn(8, NUM_EXPERTS)
+    topk_weights, topk_ids = ops.moe_routing(logits, 2)
+    ref_weights, ref_ids = torch.topk(torch.softmax(logits, dim=-1), 2, dim=-1)
+    torch.testing.assert_close(topk_ids, ref_ids)
+    torch.testing.assert_close(topk_weights, ref_weights / ref_weights.sum(dim=-1, keepdim=True))
+
+
+class SharedExperts(torch.nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.up = torch.nn.Linear(HIDDEN_SIZE, 2 * INTERMEDIATE_SIZE, bias=False)
+        self.down = torch.nn.Linear(INTERMEDIATE_SIZE, HIDDEN_SIZE, bias=False)
+
+    def forward(self, x):
+        gate, up = self.up(x).chunk(2, dim=-1)
+        return self.down(torch.nn.functional.silu(gate) * up)
+
+
+def test_moe_shared_experts():
+    torch.manual_seed(0)
+    w13, w2 = make_weights()
+    shared_experts = SharedExperts()
+    hidden_states = torch.randn(16, HIDDEN_SIZE)
+    topk_weights, topk_ids = torch.rand(16, NUM_EXPERTS).softmax(-1).topk(2)
+    op = ops.VllmMixtureOfExpertsOp(NUM_EXPERTS)
+    op.set_stacked_weights(w13, w2)
+    with torch.no_grad():
+        expected = op(hidden_states, topk_ids, topk_weights) + shared_experts(hidden_states)
+        torch.testing.assert_close(op(hidden_states, topk_ids, topk_weights, shared_experts=shared_experts),
+                                   expected)
+        ep_moe = ExpertParallelMoE(op, NUM_EXPERTS, LocalComm())
+        torch.testing.assert_close(ep_moe(hidden_states, topk_ids, topk_weights, shared_experts=shared_experts),
+                                   expected)
+        op.moe_n_slice, op.num_expert_per_group = 4, NUM_EXPERTS // 4
+        torch.testing.assert_close(op(hidden_states, topk_ids, topk_weights, shared_experts=shared_experts),
+                                   expected)
+
+
+
+class FakeStream:
+    """ Records stream synchronization and which stream the shared experts ran on """
+
+    def __init__(self, name, events):
+        self.name, self.events = name, events
+
+    def wait_stream(self, other):
+        self.events.append(f'{self.name} waits {other.name}')
+
+
+def test_moe_shared_experts_stream(monkeypatch):
+    events = []
+    main, side = FakeStream('main', events), FakeStream('side', events)
+    active = [main]
+
+    @contextlib.contextmanager
+    def use_stream(stream):
+        active.append(stream)
+        yield
+        active.pop()
+
+    class RecordingSharedExperts(SharedExperts):
+        def forward(self, x):
+            events.append(f'shared on {active[-1].name}')
+            return super().forward(x)
+
+    monkeypatch.setattr(torch, 'hpu', SimpleNamespace(current_stream=lambda: active[-1], stream=use_stream),
+                        raising=False)
+    monkeypatch.setattr(ops, '_shared_experts_stream', lambda device: side)
+    torch.manual_seed(0)
+    w13, w2 = make_weights()
+    shared_experts = RecordingSharedExperts()
+    hidden_states = torch.randn(16, HIDDEN_SIZE)
+    topk_weights, topk_ids = torch.rand(16, NUM_EXPERTS).softmax(-1).topk(2)
+    op = ops.VllmMixtureOfExpertsOp(NUM_EXPERTS)
+    op.set_stacked_weights(w13, w2)
+    with torch.no_grad():
+        expected = op(hidden_states, topk_ids, topk_weights) + shared_experts.forward(hidden_states)
+        events.clear()
+        output = op(hidden_states, topk_ids, topk_weights, shared_experts=shared_experts)
+    torch.testing.assert_close(output, expected)
+    assert events == ['side waits main', 'shared on side', 'main waits side']
+
+
+def test_expert_capacity_drop():
+    topk_ids = torch.tensor([[0, 1], [0, 2], [0, 1], [3, 0], [0, 1], [2, 1]])
+    topk_weights = torch.full((6, 2), 0.5)
+    # capacity = ceil(1.0 * 6 * 2 / 4) = 3, first choices of all tokens go first
+    weights, ids, num_dropped, num_rerouted = ops.apply_expert_capacity(topk_weights, topk_ids, 4, 1.0)
+    assert ids.tolist() == [[0, 1], [0, 2], [0, 1], [3, -1], [-1, 1], [2, -1]]
+    assert weights[ids < 0].eq(0).all() and weights[ids >= 0].eq(0.5).all()
+    assert (num_dropped.item(), num_rerouted.item()) == (3, 0)
+
+
+def test_expert_capacity_reroute():
+    topk_ids = torch.tensor([[0], [0], [0], [0], [0], [1]])
+    scores = torch.tensor([[5., 3., 1., 0.]]).expand(6, -1)
+    # capacity = 2, experts 0 and 1 are the best ones for all tokens
+    weights, ids, num_dropped, num_rerouted = ops.apply_expert_capacity(
+        torch.ones(6, 1), topk_ids, 4, 1.0, policy="reroute", router_scores=scores)
+    assert ids.flatten().tolist() == [0, 0, 1, -1, -1, 1]
+    assert (num_dropped.item(), num_rerouted.item()) == (2, 1)
+
+    # Rerouted and dropped assignments are skipped by the MoE ops
+    torch.manual_seed(0)
+    w13, w2 = make_weights()
+    hidden_states = torch.randn(6, HIDDEN_SIZE)
+    op = ops.VllmMixtureOfExpertsOp(NUM_EXPERTS)
+    op.set_stacked_weights(w13, w2)
+    torch.testing.assert_close(op(hidden_states, ids, weights),
+                               dense_moe(hidden_states, ids.clamp(min=0), weights, w13, w2))
+
+
+class FakeFP8MoeOps:
+    """ CPU stand-ins for HPU ops, the MoE returns dequantized hidden states """
+
+    def __init__(self):
+        self.scales = []
+
+    @staticmethod
+    def cast_to_fp8_v2(x, inv_scale, *args):
+        return (x * inv_scale).to(torch.float8_e4m3fn), None
+
+    def mixture_of_experts(self, hidden_states, d_scale_hidden_states, **kwargs):
+        self.scales.append(d_scale_hidden_states)
+        return hidden_states.float() * d_scale_hidden_states
+
+
+def test_fp8_per_channel_input_scale_calibration(monkeypatch):
+    torch.manual_seed(0)
+    fake_ops = FakeFP8MoeOps()
+    monkeypatch.setattr(torch.ops, 'hpu', fake_ops, raising=False)
+    override_config(moe_input_scale_margin=1.5)
+    w13, w2 = make_weights(torch.float8_e4m3fn)
+    op = ops.VllmMixtureOfExpertsOpFP8PerChannel(NUM_EXPERTS)
+    op.set_stacked_weights(w13, w2, torch.ones(NUM_EXPERTS, w13.size(1)), torch.ones(NUM_EXPERTS, w2.size(1)))
+    ids = torch.randint(0, NUM_EXPERTS, (4, 2))
+    weights = torch.rand(4, 2)
+    batches = [torch.randn(4, HIDDEN_SIZE) * amax for amax in [0.5, 2.0, 1.0]]
+    # Forwards outside of calibration are not tracked
+    op(batches[0] * 10, ids, weights)
+    with op.calibrate_input_scale():
+        for x in batches:
+            torch.testing.assert_close(op(x, ids, weights), x, rtol=0.1, atol=0.05)
+            assert op.static_input_scale is None
+    expected = max(x.abs().max() for x in batches) / ops.FP8_MAX * 1.5
+    torch.testing.assert_close(op.static_input_scale, expected, rtol=1e-5, atol=0)
+
+    # Static scale is used from now on
+    x = batches[1]
+    torch.testing.assert_close(op(x, ids, weights), x, rtol=0.1, atol=0.05)
+    assert fake_ops.scales[-1] is op.static_input_scale
@@ -39,19 +39,79 @@ class Softmax(torch.nn.Module):
         return torch.softmax(x, dim)
 
 
+def kv_cache_shape(num_blocks: int, block_size: int, kv_heads: int, head_size: int,
+                   is_key: bool, kv_layout: Optional[str] = None) -> tuple[int, ...]:
+    """
+    Return shape of a single key or value cache for given layout:
+    - 'nhd': flat token-major cache of [num_blocks * block_size, kv_heads, head_size]
+    - 'hnd': blocked head-major cache of [num_blocks, kv_heads, block_size, head_size]
+      with key blocks stored pre-transposed as [num_blocks, kv_heads, head_size, block_size]
+    """
+    kv_layout = kv_layout or get_config().kv_cache_layout
+    if kv_layout == 'hnd':
+        if is_key:
+            return (num_blocks, kv_heads, head_size, block_size)
+        return (num_blocks, kv_heads, block_size, head_size)
+    return (num_blocks * block_size, kv_heads, head_size)
+
+
+def kv_cache_summary_shape(num_blocks: int, kv_heads: int, head_size: int) -> tuple[int, ...]:
+    """
+    Return shape of per-block key summary used for top-k block selection in decode,
+    holding channel-wise minimum and maximum of keys written to each block
+    """
+    return (num_blocks, 2, kv_heads, head_size)
+
+
 class VLLMKVCache(torch.nn.Module):
 
-    def __init__(self):
+    def __init__(self, is_key: Optional[bool] = None):
         super(VLLMKVCache, self).__init__()
         self.use_contiguous_pa = get_config().use_contiguous_pa
+        self.is_key = is_key
 
-    def forward(self, input, cache, slot_mapping):
+    def forward(self, input, cache, slot_mapping, block_summary=None):
         # In cross-attention kv cache forward inputs are None in decode
         # We don't want to store them in the cache in such case
         if input is not None:
-            cache.index_copy_(0, slot_mapping, input)
+            if block_summary is not None:
+                self._update_summary(input, cache, block_summary, slot_mapping)
+            if cache.dim() == 4:
+                self._store_head_major(input, cache, slot_mapping)
+            else:
+                cache.index_copy_(0, slot_mapping, input)
         return cache
 
+    def _block_size(self, cache):
+        if cache.dim() == 4:
+            # Key and value blocks can't be told apart by shape when block_size == head_size
+            assert self.is_key is not None, 'Head-major KV caches require is_key to be set'
+            return cache.size(-1) if self.is_key else cache.size(-2)
+        return None
+
+    def _update_summary(self, input, cache, block_summary, slot_mapping):
+        # Summary is reset when the first slot of a block is written,
+        # all other tokens are redirected to dummy block 0 for the reset
+        block_size = self._block_size(cache) or cache.size(0) // block_summary.size(0)
+        block_ids = torch.div(slot_mapping, block_size, rounding_mode='floor')
+        first_slot = torch.remainder(slot_mapping, block_size) == 0
+        reset_ids = torch.where(first_slot, block_ids, torch.zeros_like(block_ids))
+        key_min, key_max = block_summary.unbind(1)
+        key_min.index_fill_(0, reset_ids, float('inf'))
+        key_max.index_fill_(0, reset_ids, float('-inf'))
+        input = input.to(block_summary.dtype)
+        key_min.index_reduce_(0, block_ids, input, 'amin')
+        key_max.index_reduce_(0, block_ids, input, 'amax')
+
+    def _store_head_major(self, input, cache, slot_mapping):
+        block_size = self._block_size(cache)
+        block_ids = torch.div(slot_mapping, block_size, rounding_mode='floor')
+        block_offsets = torch.remainder(slot_mapping, block_size)
+        if self.is_key:
+            cache[block_ids, :, :, block_offsets] = input
+        else:
+            cache[block_ids, :, block_offsets] = input
+
     def fetch_from_cache(self, cache, blocks):
         if self.use_contiguous_pa:
             return cache[:blocks.size(0)]
@@ -61,9 +121,10 @@ class VLLMKVCache(torch.nn.Module):
 
 class VLLMFP8KVCache(VLLMKVCache):
 
-    def __init__(self, input_scale=1.0):
+    def __init__(self, input_scale=1.0, is_key: Optional[bool] = None):
         super(VLLMKVCache, self).__init__()
         self.use_contiguous_pa = get_config().use_contiguous_pa
+        self.is_key = is_key
         self.input_scale = input_scale
         self.output_scale = 1.0 / self.input_scale
 
@@ -73,9 +134,11 @@ class VLLMFP8KVCache(VLLMKVCache):
     def dequant_output(self, output):
         return torch.ops.hpu.cast_from_fp8(output, self.output_scale, torch.bfloat16)
 
-    def forward(self, input, *args, **kwargs):
+    def forward(self, input, cache, slot_mapping, block_summary=None):
+        if input is not None and block_summary is not None:
+            self._update_summary(input, cache, block_summary, slot_mapping)
         qinput = self.quant_input(input)
-        return super().forward(qinput, *args, **kwargs)
+        return super().forward(qinput, cache, slot_mapping)
 
     def fetch_from_cache(self, quant_cache, blocks, permutations=None):
         if permutations: